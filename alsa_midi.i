@@ -12,8 +12,52 @@ void snd_seq_ev_set_direct(snd_seq_event_t *event);
 void snd_seq_ev_set_subs(snd_seq_event_t *event);
 void snd_seq_ev_set_fixed(snd_seq_event_t *event);
 
-// Release the GIL when blocked on an event input.
+// Release the GIL for every call that can block or that goes to the kernel
+// (these are all ioctls or reads/writes on the sequencer device).  Note that
+// this means that python code can call into the same sequencer handle from
+// multiple threads at once: amidi.Sequencer serializes use of the output
+// buffer, which is the only part of the handle that isn't safe for this.
+
+// Event input and output.
 %thread snd_seq_event_input;
+%thread snd_seq_event_input_pending;
+%thread snd_seq_event_output;
+%thread snd_seq_event_output_direct;
+%thread snd_seq_drain_output;
+%thread snd_seq_sync_output_queue;
+
+// Opening and closing.
+%thread snd_seq_open;
+%thread snd_seq_close;
+%thread snd_seq_set_client_name;
+
+// Client, port and subscription queries.
+%thread snd_seq_get_client_info;
+%thread snd_seq_get_any_client_info;
+%thread snd_seq_get_port_info;
+%thread snd_seq_get_any_port_info;
+%thread snd_seq_query_next_client;
+%thread snd_seq_query_next_port;
+%thread snd_seq_query_port_subscribers;
+
+// Port creation and subscription.
+%thread snd_seq_create_port;
+%thread snd_seq_create_simple_port;
+%thread snd_seq_delete_port;
+%thread snd_seq_delete_simple_port;
+%thread snd_seq_subscribe_port;
+%thread snd_seq_unsubscribe_port;
+%thread snd_seq_connect_from;
+%thread snd_seq_connect_to;
+%thread snd_seq_disconnect_from;
+%thread snd_seq_disconnect_to;
+
+// Queues.
+%thread snd_seq_alloc_queue;
+%thread snd_seq_alloc_named_queue;
+%thread snd_seq_free_queue;
+%thread snd_seq_control_queue;
+%thread snd_seq_get_queue_status;
 
 %{
 #include <alsa/asoundlib.h>
@@ -24,6 +68,13 @@ snd_seq_event_t *snd_seq_event_t_new(void) {
     return calloc(sizeof(snd_seq_event_t), 1);
 }
 
+snd_seq_addr_t *snd_seq_addr_t_new(int client, int port) {
+    snd_seq_addr_t *addr = malloc(sizeof(snd_seq_addr_t));
+    addr->client = client;
+    addr->port = port;
+    return addr;
+}
+
 typedef struct pollfd Pollfd;
 
 void snd_seq_event_t_set_ext(snd_seq_event_t *target, char *data, int size) {
@@ -69,6 +120,7 @@ void snd_seq_event_t_set_ext(snd_seq_event_t *target, char *data, int size) {
 %apply snd_seq_t ** { snd_seq_port_info_t ** }
 %apply snd_seq_t ** { snd_seq_port_subscribe_t ** }
 %apply snd_seq_t ** { snd_seq_event_t ** }
+%apply snd_seq_t ** { snd_seq_queue_status_t ** }
 
 // Just including the C definitions works for alsa, as long as we define
 // __attribute__() so swig doesn't choke on it.
@@ -83,6 +135,8 @@ void snd_seq_event_t_set_ext(snd_seq_event_t *target, char *data, int size) {
 
 %newobject snd_seq_event_t_new;
 snd_seq_event_t *snd_seq_event_t_new();
+%newobject snd_seq_addr_t_new;
+snd_seq_addr_t *snd_seq_addr_t_new(int client, int port);
 void snd_seq_event_t_set_ext(snd_seq_event_t *target, char *data, int size);
 
 %extend snd_seq_event {
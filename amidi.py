@@ -3,16 +3,25 @@
 from __future__ import annotations
 
 import alsa_midi # type: ignore (this doesn't work)
+import asyncio
+import errno
+import os
 from midi import Event, NoteOn, NoteOff, PitchWheel, ProgramChange, \
     ControlChange, SysContinue, SysEx, SysStart, SysStop
-from select import POLLIN
+from latency import STAGE_SEND
+from select import POLLIN, POLLOUT, select
 from shorthand import Shorthand
-from typing import Generator
+from threading import Lock
+import time
+from topology import Addr, ClientSnapshot, PortSnapshot, Subscription, \
+    Topology
+from typing import AsyncGenerator, Dict, Generator, Iterable, Optional
 
 ss = Shorthand(alsa_midi, 'snd_seq_')
 ssci = Shorthand(alsa_midi, 'snd_seq_client_info_')
 sspi = Shorthand(alsa_midi, 'snd_seq_port_info_')
 ssps = Shorthand(alsa_midi, 'snd_seq_port_subscribe_')
+ssqs = Shorthand(alsa_midi, 'snd_seq_query_subscribe_')
 SS = Shorthand(alsa_midi, 'SND_SEQ_')
 SSP = Shorthand(alsa_midi, 'SND_SEQ_PORT_')
 SSE = Shorthand(alsa_midi, 'SND_SEQ_EVENT_')
@@ -62,6 +71,20 @@ def makeEvent(rawEvent, time = 0):
 
     return result
 
+def getTimestamp(rawEvent):
+    """Returns the kernel timestamp of a raw event received from the
+    sequencer.
+
+    This is seconds (float) for real-time stamps, ticks (int) for tick stamps
+    and None if the event wasn't timestamped.
+    """
+    if rawEvent.queue == SS.QUEUE_DIRECT:
+        return None
+    if rawEvent.flags & SS.TIME_STAMP_MASK == SS.TIME_STAMP_REAL:
+        realTime = rawEvent.time.time
+        return realTime.tv_sec + realTime.tv_nsec / 1000000000
+    return rawEvent.time.tick
+
 def makeRawEvent(event):
     """Returns a new raw event for the high-level midi event."""
 
@@ -97,6 +120,14 @@ def makeRawEvent(event):
 
     return raw
 
+def _rawAddr(addr):
+    """Returns a raw sequencer address for 'addr', which may be either a raw
+    address or a topology.Addr.
+    """
+    if isinstance(addr, Addr):
+        return ss.addr_t_new(addr.client, addr.port)
+    return addr
+
 class ClientInfo(object):
     """A wrapper for raw midi client info."""
 
@@ -144,6 +175,11 @@ class PortInfo(object):
     def __str__(self):
         return '%s/%s' % (self.client.name, self.name)
 
+def _checkRC(rc: int) -> None:
+    """Raise OSError if 'rc' is a negative errno returned from ALSA."""
+    if rc < 0:
+        raise OSError(-rc, os.strerror(-rc))
+
 class Sequencer(object):
     """An ALSA MIDI sequencer."""
 
@@ -159,6 +195,21 @@ class Sequencer(object):
         if name:
             ss.set_client_name(self.__seq, name)
 
+        # The event loop we're bound to once the asyncio interfaces (events(),
+        # send()) have been used.
+        self.__loop = None
+
+        # Tasks created by sendLater() that haven't completed yet.  The loop
+        # only keeps weak references to tasks.
+        self.__pendingSends = set()
+
+        # The GIL is released during calls into ALSA, so this serializes
+        # access to the sequencer's output buffer.
+        self.__outputLock = Lock()
+
+        # If set to a latency.LatencyTracer, calls to sendEvent() are traced.
+        self.tracer = None
+
     def close(self):
         ss.close(self.__seq)
 
@@ -176,13 +227,77 @@ class Sequencer(object):
             ss.get_any_client_info(self.__seq, clientId, clientInfo)
         return PortInfo(ClientInfo(self, clientInfo), portInfo)
 
-    def createInputPort(self, name):
-        return self.__wrapWithPortInfo(
-            ss.create_simple_port(self.__seq, name,
-                                  SSP.CAP_WRITE | SSP.CAP_SUBS_WRITE,
-                                  SSP.TYPE_MIDI_GENERIC
-                                  )
-        )
+    def createInputPort(self, name, queue = None, realTime = True):
+        """Create an input port.
+
+        Args:
+            name: [str] The port name.
+            queue: [int or None] If provided, this is a queue (see
+                createQueue()) that the kernel will use to timestamp all
+                incoming events as they arrive.  The timestamp is available
+                as the "timestamp" attribute of events returned from
+                getEvent().
+            realTime: [bool] If true, timestamps are real-time (seconds) from
+                the queue's clock, otherwise they are queue ticks.
+        """
+        if queue is None:
+            return self.__wrapWithPortInfo(
+                ss.create_simple_port(self.__seq, name,
+                                      SSP.CAP_WRITE | SSP.CAP_SUBS_WRITE,
+                                      SSP.TYPE_MIDI_GENERIC
+                                      )
+            )
+
+        rc, pinfo = sspi.malloc()
+        assert not rc
+        try:
+            sspi.set_name(pinfo, name)
+            sspi.set_capability(pinfo, SSP.CAP_WRITE | SSP.CAP_SUBS_WRITE)
+            sspi.set_type(pinfo, SSP.TYPE_MIDI_GENERIC | SSP.TYPE_APPLICATION)
+            sspi.set_timestamping(pinfo, 1)
+            sspi.set_timestamp_real(pinfo, 1 if realTime else 0)
+            sspi.set_timestamp_queue(pinfo, queue)
+            rc = ss.create_port(self.__seq, pinfo)
+            if rc < 0:
+                raise Exception('Failed to create port %s, rc = %d' %
+                                (name, rc)
+                                )
+            portNum = sspi.get_port(pinfo)
+        finally:
+            sspi.free(pinfo)
+        return self.__wrapWithPortInfo(portNum)
+
+    def createQueue(self, name = None) -> int:
+        """Allocate a new queue and return its id.
+
+        Queues are used for kernel timestamping of input (see
+        createInputPort()).  The queue must be started with startQueue()
+        before its clock advances.
+        """
+        if name:
+            queue = ss.alloc_named_queue(self.__seq, name)
+        else:
+            queue = ss.alloc_queue(self.__seq)
+        if queue < 0:
+            raise Exception('Failed to allocate queue, rc = %d' % queue)
+        return queue
+
+    def startQueue(self, queue: int):
+        """Start (or restart) the queue's clock from zero."""
+        with self.__outputLock:
+            ss.control_queue(self.__seq, queue, SSE.START, 0, None)
+            ss.drain_output(self.__seq)
+
+    def getQueueTime(self, queue: int) -> float:
+        """Returns the current real-time of the queue's clock in seconds."""
+        rc, status = ss.queue_status_malloc()
+        assert not rc
+        try:
+            ss.get_queue_status(self.__seq, queue, status)
+            realTime = ss.queue_status_get_real_time(status)
+            return realTime.tv_sec + realTime.tv_nsec / 1000000000
+        finally:
+            ss.queue_status_free(status)
 
     def createOutputPort(self, name):
         return self.__wrapWithPortInfo(
@@ -200,12 +315,25 @@ class Sequencer(object):
         """
         ss.delete_simple_port(self.__seq, port.addr.port)
 
-    def getPollHandle(self):
-        """Returns a poll handle for the sequencer."""
+    def getPollHandle(self, events = POLLIN):
+        """Returns a poll handle for the sequencer.
+
+        Args:
+            events: [int] POLLIN to get the input handle, POLLOUT to get the
+                output handle.
+        """
         fds = alsa_midi.PollfdArray(1)
-        assert ss.poll_descriptors(self.__seq, fds.cast(), 1, POLLIN) == 1
+        assert ss.poll_descriptors(self.__seq, fds.cast(), 1, events) == 1
         return fds[0].fd
 
+    def setNonBlocking(self, nonBlocking = True):
+        """Put the sequencer in (or take it out of) non-blocking mode.
+
+        In non-blocking mode, input and output calls return -EAGAIN instead
+        of waiting.
+        """
+        ss.nonblock(self.__seq, 1 if nonBlocking else 0)
+
     def iterClientInfos(self) -> Generator[ClientInfo, None, None]:
         """Iterates over the set of clients."""
         rc, cinfo = ss.client_info_malloc()
@@ -252,6 +380,61 @@ class Sequencer(object):
             for port in self._iterPortsForClient(client):
                 yield port
 
+    def snapshot(self) -> Topology:
+        """Returns an immutable snapshot of all clients, ports and
+        subscriptions.
+
+        This does a single pass over the sequencer, reusing one set of info
+        structures, so it is much cheaper than walking iterPortInfos() and
+        iterSubs() and none of the resulting objects refer back to ALSA.
+        """
+        clients = []
+        ports = []
+        subs = []
+        rc, cinfo = ssci.malloc()
+        assert not rc
+        rc, pinfo = sspi.malloc()
+        assert not rc
+        rc, query = ssqs.malloc()
+        assert not rc
+        try:
+            ssci.set_client(cinfo, -1)
+            while ss.query_next_client(self.__seq, cinfo) >= 0:
+                client = ClientSnapshot(ssci.get_client(cinfo),
+                                        ssci.get_name(cinfo)
+                                        )
+                clients.append(client)
+
+                sspi.set_client(pinfo, client.id)
+                sspi.set_port(pinfo, -1)
+                while ss.query_next_port(self.__seq, pinfo) >= 0:
+                    port = PortSnapshot(client, sspi.get_port(pinfo),
+                                        sspi.get_name(pinfo),
+                                        sspi.get_capability(pinfo),
+                                        sspi.get_type(pinfo)
+                                        )
+                    ports.append(port)
+
+                    # Collect the outbound connections for the port.
+                    ssqs.set_root(query, sspi.get_addr(pinfo))
+                    ssqs.set_type(query, SS.QUERY_SUBS_READ)
+                    index = 0
+                    ssqs.set_index(query, index)
+                    while ss.query_port_subscribers(self.__seq, query) >= 0:
+                        dest = ssqs.get_addr(query)
+                        subs.append(Subscription(port.addr,
+                                                 Addr(dest.client, dest.port)
+                                                 )
+                                    )
+                        index += 1
+                        ssqs.set_index(query, index)
+        finally:
+            ssci.free(cinfo)
+            sspi.free(pinfo)
+            ssqs.free(query)
+
+        return Topology(tuple(clients), tuple(ports), frozenset(subs))
+
     def iterSubs(self, port):
         """Iterate over the subscriptions for the port.
 
@@ -288,19 +471,21 @@ class Sequencer(object):
         """All args are integers."""
         ss.connect_from(self.__seq, port, rmt_client, rmt_port)
 
-    def __createSubscription(self, port1: PortInfo, port2: PortInfo):
+    def __createSubscription(self, port1: PortInfo | PortSnapshot,
+                             port2: PortInfo | PortSnapshot
+                             ):
         """Returns a new subscription object for the two ports."""
         rc, sub = ss.port_subscribe_malloc()
-        ss.port_subscribe_set_sender(sub, port1.addr)
-        ss.port_subscribe_set_dest(sub, port2.addr)
+        ss.port_subscribe_set_sender(sub, _rawAddr(port1.addr))
+        ss.port_subscribe_set_dest(sub, _rawAddr(port2.addr))
         return sub
 
     def connect(self, port1, port2):
         """Connect port1 to port2.
 
         Args:
-            port1: (PortInfo)
-            port2: (PortInfo)
+            port1: (PortInfo or topology.PortSnapshot)
+            port2: (PortInfo or topology.PortSnapshot)
         """
         sub = self.__createSubscription(port1, port2)
         ss.subscribe_port(self.__seq, sub)
@@ -312,6 +497,24 @@ class Sequencer(object):
         ss.unsubscribe_port(self.__seq, sub)
         ss.port_subscribe_free(sub)
 
+    def subscribeAnnouncements(self, port):
+        """Subscribe 'port' to the system announce port.
+
+        The port will receive events whenever clients and ports are created,
+        changed or destroyed and whenever subscriptions change.
+
+        Args:
+            port: [PortInfo] An input port on this sequencer.
+        """
+        rc = ss.connect_from(self.__seq, ss.port_info_get_port(port.rep),
+                             SS.CLIENT_SYSTEM,
+                             SS.PORT_SYSTEM_ANNOUNCE
+                             )
+        if rc:
+            raise Exception('Failed to subscribe to announcements, rc = %d' %
+                            rc
+                            )
+
     def hasEvent(self):
         return ss.event_input_pending(self.__seq, 1)
 
@@ -319,18 +522,33 @@ class Sequencer(object):
         """Waits for an event and returns it.\
 
         Returns:
-            (Event) The event returned has two extra attributes, "source" and
-            "dest" which are not part of normal events.  These are PortInfo
-            objects for the source and destination ports.
+            (Event) The event returned has three extra attributes, "source",
+            "dest" and "timestamp", which are not part of normal events.
+            "source" and "dest" are PortInfo objects for the source and
+            destination ports.  "timestamp" is the time the kernel received
+            the event if the destination port was created with a timestamp
+            queue (seconds as a float for a real-time port, queue ticks
+            otherwise) and None if it wasn't.
         """
         rc, rawEvent = ss.event_input(self.__seq)
         event = makeEvent(rawEvent, time)
+        event.timestamp = getTimestamp(rawEvent)
         event.source = self.__wrapWithPortInfo(rawEvent.source.port,
                                                rawEvent.source.client)
         event.dest = self.__wrapWithPortInfo(rawEvent.dest.port,
                                              rawEvent.dest.client)
         return event
 
+    def __makeOutputEvent(self, event, port):
+        """Returns a raw event for 'event' addressed to the subscribers of
+        'port'.
+        """
+        raw = makeRawEvent(event)
+        ss.ev_set_source(raw, ss.port_info_get_port(port.rep))
+        ss.ev_set_subs(raw)
+        ss.ev_set_direct(raw)
+        return raw
+
     def sendEvent(self, event, port):
         """Send the event to subscribers of the given port.
 
@@ -338,12 +556,128 @@ class Sequencer(object):
             event: (midi.Event)
             port: (PortInfo)
         """
-        raw = makeRawEvent(event)
-        ss.ev_set_source(raw, ss.port_info_get_port(port.rep))
-        ss.ev_set_subs(raw)
-        ss.ev_set_direct(raw)
-        ss.event_output(self.__seq, raw)
-        ss.drain_output(self.__seq)
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        raw = self.__makeOutputEvent(event, port)
+        with self.__outputLock:
+            ss.event_output(self.__seq, raw)
+            ss.drain_output(self.__seq)
+        if tracer is not None:
+            tracer.record(STAGE_SEND, start, tracer.now())
+
+    # asyncio interface.
+    #
+    # These methods let the sequencer be driven from an asyncio event loop
+    # instead of from a dedicated thread.  The first use of any of them puts
+    # the sequencer into non-blocking mode and binds it to the running loop,
+    # so the blocking getEvent()/sendEvent() calls should not be used from
+    # other threads after that point.
+
+    def __getLoop(self) -> asyncio.AbstractEventLoop:
+        if self.__loop is None:
+            self.__loop = asyncio.get_running_loop()
+            self.setNonBlocking(True)
+        return self.__loop
+
+    async def __waitFor(self, fd: int, events: int) -> None:
+        """Wait for 'fd' to become readable (events == POLLIN) or writable
+        (events == POLLOUT).
+        """
+        loop = self.__getLoop()
+        ready = loop.create_future()
+
+        def onReady():
+            if not ready.done():
+                ready.set_result(None)
+
+        if events == POLLIN:
+            loop.add_reader(fd, onReady)
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fd)
+        else:
+            loop.add_writer(fd, onReady)
+            try:
+                await ready
+            finally:
+                loop.remove_writer(fd)
+
+    async def events(self) -> AsyncGenerator[Event, None]:
+        """Asynchronously iterate over incoming events.
+
+        Usage:
+            async for event in seq.events():
+                ...
+
+        Events are the same as those returned from getEvent().
+        """
+        self.__getLoop()
+        handle = self.getPollHandle(POLLIN)
+        while True:
+            while self.hasEvent() > 0:
+                yield self.getEvent()
+            await self.__waitFor(handle, POLLIN)
+
+    async def send(self, event, port):
+        """Send the event to subscribers of the given port.
+
+        This is the asyncio version of sendEvent().  If the sequencer's output
+        buffer is full, it waits for the buffer to drain rather than blocking
+        the loop, so a fast producer is throttled to the rate that ALSA is
+        consuming events.
+
+        Raises OSError if ALSA reports an error.
+
+        Args:
+            event: (midi.Event)
+            port: (PortInfo)
+        """
+        self.__getLoop()
+        raw = self.__makeOutputEvent(event, port)
+        handle = None
+        while True:
+            with self.__outputLock:
+                rc = ss.event_output(self.__seq, raw)
+            if rc != -errno.EAGAIN:
+                _checkRC(rc)
+                break
+            if handle is None:
+                handle = self.getPollHandle(POLLOUT)
+            await self.__waitFor(handle, POLLOUT)
+
+        # drain_output() returns the number of bytes remaining in the buffer
+        # in non-blocking mode.
+        while True:
+            with self.__outputLock:
+                rc = ss.drain_output(self.__seq)
+            if rc != -errno.EAGAIN:
+                _checkRC(rc)
+                if rc == 0:
+                    break
+            if handle is None:
+                handle = self.getPollHandle(POLLOUT)
+            await self.__waitFor(handle, POLLOUT)
+
+    async def __sendAfter(self, delay: float, event, port) -> None:
+        await asyncio.sleep(delay)
+        await self.send(event, port)
+
+    def sendLater(self, delay: float, event, port) -> asyncio.Task:
+        """Send the event to subscribers of the given port after 'delay'
+        seconds.
+
+        The timer is driven by the event loop.  Returns the task doing the
+        send, which can be cancelled and which raises any error from send().
+        The sequencer keeps a reference to the task until it completes.
+        """
+        task = self.__getLoop().create_task(
+            self.__sendAfter(delay, event, port)
+        )
+        self.__pendingSends.add(task)
+        task.add_done_callback(self.__pendingSends.discard)
+        return task
 
     def getPort(self, name):
         """Gets a port of the specified name, None if the port is not defined.
@@ -360,6 +694,71 @@ class Sequencer(object):
 
         return None
 
+class PortWatcher:
+    """Waits for midi ports to appear.
+
+    Rather than polling, this opens its own sequencer client subscribed to
+    the system announce port and only rechecks the set of ports when the
+    kernel tells us that something has changed.  Using a separate client
+    keeps the announcements out of the regular midi input.
+    """
+
+    def __init__(self, name = 'MAWB-watch'):
+        self.__seq = Sequencer(SS.OPEN_INPUT, 0, name = name)
+        self.__seq.subscribeAnnouncements(
+            self.__seq.createInputPort('announce')
+        )
+        self.__handle = self.__seq.getPollHandle()
+        self.__lock = Lock()
+
+    def close(self):
+        self.__seq.close()
+
+    def waitForPorts(self, portNames: Iterable[str], timeout: float,
+                     start: Optional[float] = None
+                     ) -> Dict[str, float]:
+        """Wait for all of the ports in 'portNames' to exist.
+
+        Args:
+            portNames: Port names in "client/port" format.
+            timeout: Maximum number of seconds to wait.
+            start: Reference time (from time.monotonic()) for the times in
+                the result, defaults to now.
+
+        Returns a dictionary mapping each port name to the time (in seconds
+        since 'start') when we first saw it.
+
+        Raises:
+            TimeoutError: If some of the ports didn't show up in time.
+        """
+        now = time.monotonic()
+        if start is None:
+            start = now
+        endTime = now + timeout
+        pending = set(portNames)
+        result = {}
+        with self.__lock:
+            while True:
+                # Discard the announcements that we've seen so far before
+                # checking, then any announcement after this wakes us up.
+                while self.__seq.hasEvent():
+                    self.__seq.getEvent()
+
+                ports = {port.fullName for port in self.__seq.snapshot().ports}
+                now = time.monotonic()
+                for name in pending & ports:
+                    result[name] = now - start
+                pending -= ports
+                if not pending:
+                    return result
+
+                remaining = endTime - now
+                if remaining <= 0:
+                    raise TimeoutError('timed out waiting for %s' %
+                                       ', '.join(sorted(pending))
+                                       )
+                select([self.__handle], [], [], remaining)
+
 _sequencer = None
 def getSequencer(name = None):
     global _sequencer
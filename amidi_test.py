@@ -0,0 +1,202 @@
+"""Tests for amidi that need a real ALSA sequencer (/dev/snd/seq)."""
+
+import asyncio
+from threading import Event as ThreadEvent, Thread
+from unittest import main, TestCase
+import time
+
+from alsa_midi import SND_SEQ_OPEN_OUTPUT, SND_SEQ_OPEN_INPUT
+from amidi import PortWatcher, Sequencer
+from midi import NoteOn, NoteOff
+
+# Number of "UI ticks" to measure and the expected duration of each.
+TICKS = 500
+TICK_SECS = 0.002
+
+# Seconds to wait for the load threads to stop.
+JOIN_TIMEOUT = 5
+
+def measureTickLatency():
+    """Run a fake UI loop and return a sorted list of how late each tick was
+    (in seconds).
+    """
+    lateness = []
+    for i in range(TICKS):
+        start = time.perf_counter()
+        time.sleep(TICK_SECS)
+        lateness.append(time.perf_counter() - start - TICK_SECS)
+    lateness.sort()
+    return lateness
+
+def p99(values):
+    return values[int(len(values) * 0.99)]
+
+class GILReleaseTest(TestCase):
+    """Verify that heavy midi traffic on one thread doesn't stall others."""
+
+    def setUp(self):
+        self.seq = Sequencer(SND_SEQ_OPEN_INPUT | SND_SEQ_OPEN_OUTPUT, 0,
+                             name='amidi_test'
+                             )
+        self.out = self.seq.createOutputPort('out')
+        self.inp = self.seq.createInputPort('in')
+
+        # Loop our output back to our input so that the kernel has to do real
+        # work (and so output blocks when the input pool fills up).
+        self.seq.connect(self.out, self.inp)
+
+        # 'stop' stops the senders, 'stopReceiver' stops the receiver once
+        # they're done so that output never backs up behind a full input
+        # pool.
+        self.stop = ThreadEvent()
+        self.stopReceiver = ThreadEvent()
+        self.senders = []
+        self.receiver = None
+
+    def tearDown(self):
+        try:
+            self.__stopThreads()
+        finally:
+            self.seq.close()
+
+    def __join(self, thread):
+        thread.join(JOIN_TIMEOUT)
+        if thread.is_alive():
+            self.fail('thread %s did not stop' % thread.name)
+
+    def __stopThreads(self):
+        """Stop and join the sender and receiver threads.
+
+        The sequencer can't be closed while a thread is in a call to ALSA.
+        The receiver may be blocked in getEvent(), so once the senders are
+        done we wake it up with one last event.
+        """
+        self.stop.set()
+        for thread in self.senders:
+            self.__join(thread)
+        self.senders = []
+        if self.receiver is not None:
+            self.stopReceiver.set()
+            self.seq.sendEvent(NoteOff(0, 0, 0, 0), self.out)
+            self.__join(self.receiver)
+            self.receiver = None
+
+    def __send(self):
+        note = 0
+        while not self.stop.is_set():
+            self.seq.sendEvent(NoteOn(0, 0, note, 100), self.out)
+            self.seq.sendEvent(NoteOff(0, 0, note, 0), self.out)
+            note = (note + 1) % 128
+
+    def __receive(self):
+        while not self.stopReceiver.is_set():
+            self.seq.getEvent()
+
+    def testUILatencyUnderLoad(self):
+        baseline = measureTickLatency()
+
+        self.senders = [Thread(target=self.__send, daemon=True),
+                        Thread(target=self.__send, daemon=True),
+                        ]
+        self.receiver = Thread(target=self.__receive, daemon=True)
+        for thread in self.senders + [self.receiver]:
+            thread.start()
+        try:
+            loaded = measureTickLatency()
+        finally:
+            self.__stopThreads()
+
+        print('tick lateness p99: baseline = %.3fms, loaded = %.3fms, '
+              'max loaded = %.3fms' %
+              (p99(baseline) * 1000, p99(loaded) * 1000, loaded[-1] * 1000)
+              )
+
+        # With the GIL held across ALSA calls the "UI" thread stalls for
+        # whole blocking writes.  Allow for a few context switches worth of
+        # extra latency but nothing like that.
+        self.assertLess(p99(loaded), p99(baseline) + 0.005)
+
+class AsyncTest(TestCase):
+
+    def setUp(self):
+        self.seq = Sequencer(SND_SEQ_OPEN_INPUT | SND_SEQ_OPEN_OUTPUT, 0,
+                             name='amidi_async_test'
+                             )
+        self.out = self.seq.createOutputPort('out')
+        self.inp = self.seq.createInputPort('in')
+        self.seq.connect(self.out, self.inp)
+
+    def tearDown(self):
+        self.seq.close()
+
+    def testSendLater(self):
+        async def run():
+            start = time.monotonic()
+            tasks = [self.seq.sendLater(0.2, NoteOn(0, 0, 2, 100), self.out),
+                     self.seq.sendLater(0.1, NoteOn(0, 0, 1, 100), self.out),
+                     ]
+            received = []
+            async for event in self.seq.events():
+                received.append((event.note, time.monotonic() - start))
+                if len(received) == 2:
+                    break
+            await asyncio.gather(*tasks)
+            return received
+
+        received = asyncio.run(run())
+        self.assertEqual([note for note, t in received], [1, 2])
+        self.assertGreaterEqual(received[0][1], 0.1)
+        self.assertGreaterEqual(received[1][1], 0.2)
+        self.assertLess(received[1][1], 0.3)
+
+    def testSendLaterError(self):
+        async def fail(event, port):
+            raise OSError('send failed')
+        self.seq.send = fail
+
+        async def run():
+            task = self.seq.sendLater(0.01, NoteOn(0, 0, 1, 100), self.out)
+            with self.assertRaises(OSError):
+                await task
+
+        asyncio.run(run())
+
+class PortWatcherTest(TestCase):
+
+    def setUp(self):
+        self.watcher = PortWatcher()
+
+    def tearDown(self):
+        self.watcher.close()
+
+    def testWaitForPorts(self):
+        seq = Sequencer(SND_SEQ_OPEN_INPUT, 0, name='port_watcher_test')
+        try:
+            def createPorts():
+                time.sleep(0.2)
+                seq.createInputPort('a')
+                time.sleep(0.2)
+                seq.createInputPort('b')
+            thread = Thread(target=createPorts)
+            thread.start()
+            start = time.monotonic()
+            times = self.watcher.waitForPorts(
+                ['port_watcher_test/a', 'port_watcher_test/b'], 5, start
+            )
+            elapsed = time.monotonic() - start
+            thread.join()
+
+            # We should be woken up as soon as the second port shows up.
+            self.assertLess(times['port_watcher_test/a'],
+                            times['port_watcher_test/b']
+                            )
+            self.assertLess(elapsed, 0.45)
+        finally:
+            seq.close()
+
+    def testTimeout(self):
+        with self.assertRaises(TimeoutError):
+            self.watcher.waitForPorts(['no_such_client/port'], 0.1)
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,31 @@
+#include <algorithm>
+#include <deque>
 #include <fstream>
 #include <iostream>
+#include <map>
+#include <set>
+#include <vector>
+
+#include <errno.h>
+#include <fcntl.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/uio.h>
+#include <sys/un.h>
+#include <unistd.h>
+#include <zlib.h>
 
 #include <google/protobuf/io/coded_stream.h>
 
 #include "spug/RCPtr.h"
 #include "spug/Reactable.h"
 #include "spug/Reactor.h"
+#include "spug/Runnable.h"
 #include "spug/Socket.h"
+#include "spug/Time.h"
 
 #include "alsa.h"
 #include "engine.h"
@@ -28,31 +47,352 @@ using namespace mawb;
 using namespace std;
 using namespace spug;
 
-class ConnectionHandler : public Reactable {
+/**
+ * A connected stream socket that a ConnectionHandler talks to a client over.
+ */
+class Connection {
+    public:
+        virtual ~Connection() {}
+        virtual int recv(char *buffer, size_t size) = 0;
+        virtual int handle() = 0;
+
+        // Send the data in 'count' buffers with a single system call (like
+        // writev(), but without raising SIGPIPE if the client is gone).
+        ssize_t sendv(const iovec *iov, int count) {
+            msghdr msg;
+            memset(&msg, 0, sizeof(msg));
+            msg.msg_iov = const_cast<iovec *>(iov);
+            msg.msg_iovlen = count;
+            return sendmsg(handle(), &msg, MSG_NOSIGNAL);
+        }
+};
+
+/**
+ * A TCP connection accepted from a spug Socket.
+ */
+class SocketConnection : public Connection {
     private:
         Socket *socket;
-        string outData, inData;
-        char buffer[4096];
+
+    public:
+        SocketConnection(Socket *socket) : socket(socket) {}
+
+        ~SocketConnection() {
+            delete socket;
+        }
+
+        virtual int recv(char *buffer, size_t size) {
+            return socket->recv(buffer, size);
+        }
+
+        virtual int handle() {
+            return socket->handle();
+        }
+};
+
+/**
+ * A connection on a plain file descriptor (we use this for unix domain
+ * sockets, which spug's Socket doesn't support).  Takes ownership of the
+ * descriptor.
+ */
+class FDConnection : public Connection {
+    private:
+        int fd;
+
+    public:
+        FDConnection(int fd) : fd(fd) {}
+
+        ~FDConnection() {
+            close(fd);
+        }
+
+        virtual int recv(char *buffer, size_t size) {
+            return ::recv(fd, buffer, size, 0);
+        }
+
+        virtual int handle() {
+            return fd;
+        }
+};
+
+class ConnectionHandler;
+
+SPUG_RCPTR(StatePublisher);
+
+/**
+ * Pushes the jack engine state to subscribed connections (see
+ * SubscribeRequest in mawb.proto).  This runs on the reactor at the shortest
+ * interval that any subscriber has asked for.
+ */
+class StatePublisher : public RCBase {
+    private:
+        Reactor &reactor;
+        JackEngine &jackEngine;
+
+        struct Subscription {
+            // Minimum microseconds between pushes.
+            int64 interval;
+
+            // Time of the last push.
+            Time lastPush;
+
+            // The state as of the last push, the next push contains the
+            // fields that differ from this.
+            EngineState last;
+        };
+        typedef map<ConnectionHandler *, Subscription> SubscriptionMap;
+        SubscriptionMap subscriptions;
+
+        // True if a run is scheduled on the reactor.
+        bool scheduled;
+
+        // Runs the publisher from the reactor.  The reactor deletes these
+        // after running them, so we schedule a new one every time.
+        struct Task : public Runnable {
+            StatePublisherPtr publisher;
+            Task(StatePublisher *publisher) : publisher(publisher) {}
+            virtual void run() { publisher->run(); }
+        };
+
+        // Don't push more often than this (in milliseconds).
+        static const int minInterval = 5;
+
+        static int64 toMicros(const TimeDelta &delta) {
+            return static_cast<int64>(delta.getSeconds()) * 1000000 +
+                   delta.getMicroseconds();
+        }
+
+        // Returns the shortest subscription interval in microseconds.
+        int64 getPeriod() const {
+            int64 period = 0;
+            for (SubscriptionMap::const_iterator iter =
+                    subscriptions.begin();
+                 iter != subscriptions.end();
+                 ++iter
+                 ) {
+                if (!period || iter->second.interval < period)
+                    period = iter->second.interval;
+            }
+            return period;
+        }
+
+        void schedule() {
+            if (scheduled || subscriptions.empty())
+                return;
+            int64 period = getPeriod();
+            reactor.schedule(TimeDelta(period / 1000000, period % 1000000),
+                             new Task(this)
+                             );
+            scheduled = true;
+        }
+
+        void run();
+
+    public:
+        StatePublisher(Reactor &reactor, JackEngine &jackEngine) :
+            reactor(reactor),
+            jackEngine(jackEngine),
+            scheduled(false) {
+        }
+
+        // Subscribe a connection (or change its interval).  If 'initial' is
+        // not null, it gets the complete current state and the first push
+        // will be relative to it.  Otherwise the first push is complete.
+        void subscribe(ConnectionHandler *handler, int interval,
+                       EngineState *initial
+                       ) {
+            Subscription &sub = subscriptions[handler];
+            sub.interval =
+                static_cast<int64>(interval < minInterval ? minInterval :
+                                                            interval
+                                   ) * 1000;
+            sub.lastPush = Time::now();
+            sub.last.Clear();
+            if (initial) {
+                jackEngine.getState(*initial);
+                sub.last.CopyFrom(*initial);
+            }
+            schedule();
+        }
+
+        void unsubscribe(ConnectionHandler *handler) {
+            subscriptions.erase(handler);
+        }
+};
+
+SPUG_RCPTR(DaemonMetrics);
+
+/**
+ * Collects the metrics that the jack engine doesn't (see Metrics in
+ * mawb.proto): the RPC queue depths of all connections and the reactor loop
+ * latency, which we measure by running a task on the reactor every
+ * probeInterval and seeing how late it runs.
+ */
+class DaemonMetrics : public RCBase {
+    private:
+        Reactor &reactor;
+        JackEngine &jackEngine;
+        set<ConnectionHandler *> connections;
+
+        // Microseconds between latency probes.
+        static const int probeInterval = 100000;
+
+        // When the last probe was scheduled.
+        Time probeScheduled;
+
+        // Loop latency in microseconds.
+        int64 latencyLast, latencySum, latencyMax;
+        int64 probes;
+
+        struct Task : public Runnable {
+            DaemonMetricsPtr metrics;
+            Task(DaemonMetrics *metrics) : metrics(metrics) {}
+            virtual void run() { metrics->probe(); }
+        };
+
+        void schedule() {
+            probeScheduled = Time::now();
+            reactor.schedule(TimeDelta(0, probeInterval), new Task(this));
+        }
+
+        void probe() {
+            TimeDelta elapsed = Time::now() - probeScheduled;
+            int64 latency = static_cast<int64>(elapsed.getSeconds()) *
+                            1000000 +
+                            elapsed.getMicroseconds() - probeInterval;
+            if (latency < 0)
+                latency = 0;
+            latencyLast = latency;
+            latencySum += latency;
+            if (latency > latencyMax)
+                latencyMax = latency;
+            ++probes;
+            schedule();
+        }
+
+    public:
+        DaemonMetrics(Reactor &reactor, JackEngine &jackEngine) :
+            reactor(reactor),
+            jackEngine(jackEngine),
+            latencyLast(0),
+            latencySum(0),
+            latencyMax(0),
+            probes(0) {
+        }
+
+        // Start measuring the loop latency.
+        void start() {
+            schedule();
+        }
+
+        void addConnection(ConnectionHandler *handler) {
+            connections.insert(handler);
+        }
+
+        void removeConnection(ConnectionHandler *handler) {
+            connections.erase(handler);
+        }
+
+        // Store all of the metrics in 'metrics'.
+        void fill(Metrics &metrics);
+};
+
+// Prefix of the names of the shared memory segments that clients pass
+// payloads in (see ShmDescriptor).
+static const char shmPrefix[] = "/mawb_";
+static const size_t shmPrefixSize = sizeof(shmPrefix) - 1;
+
+class ConnectionHandler : public Reactable {
+    private:
+        Connection *socket;
+
+        // Received data.  The data that hasn't been processed yet is in
+        // [inStart, inEnd), we receive directly into the space after it.
+        vector<char> inData;
+        size_t inStart, inEnd;
+
+        // Framed messages waiting to be sent.  The first 'outOffset' bytes
+        // of the first frame have already been sent.
+        deque<string> outFrames;
+        size_t outOffset;
+
+        // The amount of free space we want for every read.  The input
+        // buffer is shrunk back to this size after receiving large messages.
+        static const size_t readSize = 65536;
+
+        // The largest frame we accept.  Connections that send a bigger one
+        // are closed.  Large payloads should be passed through shared memory
+        // or in chunks.
+        static const size_t maxFrameSize = 64 << 20;
+
+        // Maximum number of frames to send in one call.
+        static const int maxFramesPerSend = 64;
+
         Controller &controller;
         JackEngine &jackEngine;
+        StatePublisherPtr publisher;
+        DaemonMetricsPtr metrics;
+
+        // Progress of a chunked wave transfer.
+        struct ChunkState {
+            // Offset of the next chunk, chunks must be transferred in order
+            // for us to compute the checksum.
+            uint64 next;
+            uLong adler;
+
+            ChunkState() : next(0), adler(adler32(0, Z_NULL, 0)) {}
+        };
+
+        // Wave transfers in progress on this connection, keyed by section
+        // and channel.
+        typedef map<pair<int, int>, ChunkState> ChunkStateMap;
+        ChunkStateMap putStates, getStates;
+
+        // Report an error in a request, in the response if there is one.
+        void reportError(Response *resp, const string &error) {
+            cerr << error << "\r" << endl;
+            if (resp)
+                resp->set_error(error);
+        }
 
     public:
 
-        ConnectionHandler(Socket *socket, Controller &controller,
-                          JackEngine &jackEngine
+        ConnectionHandler(Connection *socket, Controller &controller,
+                          JackEngine &jackEngine,
+                          StatePublisher *publisher,
+                          DaemonMetrics *metrics
                           ) :
             socket(socket),
+            inData(readSize),
+            inStart(0),
+            inEnd(0),
+            outOffset(0),
             controller(controller),
-            jackEngine(jackEngine) {
+            jackEngine(jackEngine),
+            publisher(publisher),
+            metrics(metrics) {
+            metrics->addConnection(this);
         }
 
         ~ConnectionHandler() {
+            publisher->unsubscribe(this);
+            metrics->removeConnection(this);
             delete socket;
         }
 
+        // Returns the number of frames waiting to be sent.
+        size_t getOutputFrames() const {
+            return outFrames.size();
+        }
+
+        // Returns the number of bytes received that haven't been processed.
+        size_t getInputBytes() const {
+            return inEnd - inStart;
+        }
+
         virtual Status getStatus() {
             return static_cast<Reactable::Status>(
-                (outData.size() ? readyToWrite : 0) | readyToRead
+                (outFrames.empty() ? 0 : readyToWrite) | readyToRead
             );
         }
 
@@ -138,27 +478,159 @@ class ConnectionHandler : public Reactable {
                                      );
         }
 
-        // Serialize the message to the output buffer to be sent as soon as
-        // possible.
-        void sendMessage(Message &msg) {
-            // Serialize the message.
-            string serializedMsg;
-            msg.SerializeToString(&serializedMsg);
+        void processPutWaveChunk(const WaveChunk &chunk, Response *resp) {
+            pair<int, int> key(chunk.section(), chunk.channel());
+            if (chunk.has_wave()) {
+                if (!jackEngine.resetWave(chunk.section(), chunk.channel(),
+                                          chunk.wave()
+                                          )) {
+                    reportError(resp, "Unable to store wave (no such "
+                                      "channel, or playing or recording)"
+                                );
+                    return;
+                }
+                putStates[key] = ChunkState();
+            }
+
+            ChunkStateMap::iterator state = putStates.find(key);
+            if (state == putStates.end() ||
+                chunk.offset() != state->second.next) {
+                reportError(resp, "Wave chunk out of order");
+                putStates.erase(key);
+                return;
+            }
+
+            const string &data = chunk.data();
+            if (!jackEngine.writeWaveData(chunk.section(), chunk.channel(),
+                                          chunk.offset(),
+                                          data
+                                          )) {
+                reportError(resp, "Unable to write wave data");
+                putStates.erase(state);
+                return;
+            }
+            state->second.next += data.size();
+            state->second.adler =
+                adler32(state->second.adler,
+                        reinterpret_cast<const Bytef *>(data.data()),
+                        data.size()
+                        );
+
+            if (chunk.last()) {
+                if (chunk.total_size() != state->second.next ||
+                    chunk.adler32() != state->second.adler
+                    )
+                    reportError(resp, "Wave data checksum mismatch");
+                putStates.erase(state);
+            }
+        }
 
-            // Stick the current output buffer into the temporary.
-            ostringstream temp;
-            temp << outData;
+        void processGetWaveChunks(const GetWaveChunksRequest &req,
+                                  Response *resp
+                                  ) {
+            if (!resp) {
+                cerr << "get_wave_chunks without a msg_id\r" << endl;
+                return;
+            }
 
-            // Serialize the size.
-            size_t size = serializedMsg.size();
-            temp << static_cast<byte>(size & 0xff)
-                 << static_cast<byte>((size >> 8) & 0xff)
-                 << static_cast<byte>((size >> 16) & 0xff)
-                 << static_cast<byte>(size >> 24);
+            WaveChunk *chunk = resp->mutable_wave_chunk();
+            Wave wave;
+            size_t size;
+            if (!jackEngine.getWaveInfo(req.section(), req.channel(), wave,
+                                        size
+                                        )) {
+                resp->clear_wave_chunk();
+                reportError(resp, "Unable to get wave (no such channel, or "
+                                  "playing or recording)"
+                            );
+                return;
+            }
+            chunk->set_section(req.section());
+            chunk->set_channel(req.channel());
+            chunk->set_offset(req.offset());
+            chunk->set_total_size(size);
+            if (!req.offset())
+                chunk->mutable_wave()->CopyFrom(wave);
+            if (!req.length())
+                return;
+
+            // Read the data directly into the response.
+            string *data = chunk->mutable_data();
+            data->reserve(req.length());
+            jackEngine.readWaveData(req.section(), req.channel(),
+                                    req.offset(),
+                                    req.length(),
+                                    *data
+                                    );
+
+            // Keep track of the checksum of chunks read in order.
+            pair<int, int> key(req.section(), req.channel());
+            if (!req.offset())
+                getStates[key] = ChunkState();
+            ChunkStateMap::iterator state = getStates.find(key);
+            if (state == getStates.end())
+                return;
+            if (req.offset() != state->second.next) {
+                getStates.erase(state);
+                return;
+            }
+            state->second.next += data->size();
+            state->second.adler =
+                adler32(state->second.adler,
+                        reinterpret_cast<const Bytef *>(data->data()),
+                        data->size()
+                        );
+            if (state->second.next >= size) {
+                chunk->set_adler32(state->second.adler);
+                getStates.erase(state);
+            }
+        }
 
-            // Tack on the message and add it to the buffer to be sent.
-            temp << serializedMsg;
-            outData = temp.str();
+        void processSubscribe(const SubscribeRequest &req, Response *resp) {
+            if (req.interval() > 0)
+                publisher->subscribe(this, req.interval(),
+                                     resp ? resp->mutable_state() : 0
+                                     );
+            else
+                publisher->unsubscribe(this);
+        }
+
+        void processGetMetrics(const GetMetricsRequest &req, Response *resp) {
+            if (!resp) {
+                cerr << "get_metrics without a msg_id\r" << endl;
+                return;
+            }
+            metrics->fill(*resp->mutable_metrics());
+        }
+
+        // Serialize the message to the output buffer to be sent as soon as
+        // possible.
+        void sendMessage(const Message &msg) {
+            // Serialize the size and the message directly into a new frame.
+            uint32 size = msg.ByteSizeLong();
+            outFrames.push_back(string());
+            string &frame = outFrames.back();
+            frame.resize(size + 4);
+            uint8 *data = reinterpret_cast<uint8 *>(&frame[0]);
+            CodedOutputStream::WriteLittleEndian32ToArray(size, data);
+            msg.SerializeWithCachedSizesToArray(data + 4);
+        }
+
+        // Make sure there are at least 'size' free bytes after the
+        // unprocessed data in the input buffer.
+        void reserveInput(size_t size) {
+            if (inData.size() - inEnd >= size)
+                return;
+
+            // Move the unprocessed data to the front of the buffer, then
+            // grow it if that's not enough.
+            if (inStart) {
+                memmove(&inData[0], &inData[inStart], inEnd - inStart);
+                inEnd -= inStart;
+                inStart = 0;
+            }
+            if (inData.size() - inEnd < size)
+                inData.resize(inEnd + size);
         }
 
         void processLoadState(const LoadState &message, Response *resp) {
@@ -171,32 +643,186 @@ class ConnectionHandler : public Reactable {
             cerr << "\r\nloaded file " << message.filename() << "\r" << endl;
         }
 
+        // Processes all of the requests in an RPC message.
+        void processRPC(const mawb::RPC &rpc, Response *resp) {
+            // A payload in shared memory is processed first, as if its
+            // fields were part of this RPC.
+            if (rpc.has_shm_payload())
+                processShmPayload(rpc.shm_payload(), resp);
+
+            if (rpc.echo_size()) {
+                for (int i = 0; i < rpc.echo_size(); ++i)
+                    processEcho(rpc.echo(i));
+            }
+
+            if (rpc.set_ticks_size()) {
+                for (int i = 0; i < rpc.set_ticks_size(); ++i)
+                    processSetTicks(rpc.set_ticks(i));
+            }
+
+            if (rpc.set_initial_state_size()) {
+                for (int i = 0; i < rpc.set_initial_state_size(); ++i)
+                    processSetInitialState(rpc.set_initial_state(i));
+            }
+
+            if (rpc.has_set_input_params()) {
+                const SetInputParams &inputParams = rpc.set_input_params();
+                if (inputParams.has_output_channel())
+                    controller.getInputDispatcher()->setOutputChannel(
+                        inputParams.output_channel()
+                    );
+            }
+
+            if (rpc.has_save_state())
+                processSaveState(rpc.save_state());
+
+            if (rpc.has_load_state())
+                processLoadState(rpc.load_state(), resp);
+
+            if (rpc.has_add_track()) {
+                controller.addTrack(rpc.add_track());
+            }
+
+            // We do this after the state change events so a client can
+            // add a "play" to setup.
+            if (rpc.has_change_sequencer_state())
+                processSetState(rpc.change_sequencer_state());
+
+            if (rpc.has_change_jack_state())
+                processChangeJackState(rpc.change_jack_state());
+
+            if (rpc.has_clear_state())
+                processClearState(rpc.clear_state());
+
+            if (rpc.has_shutdown())
+                processShutdown(rpc.shutdown());
+
+            if (rpc.has_change_section())
+                processChangeSection(rpc.change_section());
+
+            if (rpc.has_new_section())
+                processNewSection(rpc.new_section());
+
+            if (rpc.has_change_channel_attrs())
+                processChangeChannelAttrs(rpc.change_channel_attrs());
+
+            for (int i = 0; i < rpc.put_wave_chunks_size(); ++i)
+                processPutWaveChunk(rpc.put_wave_chunks(i), resp);
+
+            if (rpc.has_get_wave_chunks())
+                processGetWaveChunks(rpc.get_wave_chunks(), resp);
+
+            if (rpc.has_subscribe())
+                processSubscribe(rpc.subscribe(), resp);
+
+            if (rpc.has_get_metrics())
+                processGetMetrics(rpc.get_metrics(), resp);
+        }
+
+        // Processes an RPC message stored in a shared memory segment.  The
+        // client owns the segment, we just map it for long enough to parse
+        // the message.
+        //
+        // We only open segments whose names have the prefix that clients
+        // use (see ShmDescriptor), and the payload can't itself refer to
+        // shared memory.
+        void processShmPayload(const ShmDescriptor &desc, Response *resp) {
+            const string &name = desc.name();
+            if (name.compare(0, shmPrefixSize, shmPrefix) ||
+                name.size() == shmPrefixSize ||
+                name.find('/', 1) != string::npos
+                ) {
+                reportError(resp, "Invalid shared memory name " + name);
+                return;
+            }
+
+            int fd = shm_open(name.c_str(), O_RDONLY, 0);
+            if (fd == -1) {
+                reportError(resp, "Unable to open shared memory " + name +
+                                  ": " + strerror(errno)
+                            );
+                return;
+            }
+
+            // Accessing a mapping beyond the end of the segment would
+            // crash us with a SIGBUS.
+            struct stat st;
+            uint64_t segmentSize = 0;
+            if (fstat(fd, &st) == 0)
+                segmentSize = st.st_size;
+            if (desc.offset() > segmentSize ||
+                desc.size() > segmentSize - desc.offset()
+                ) {
+                close(fd);
+                reportError(resp, "Payload outside of shared memory " + name);
+                return;
+            }
+
+            size_t size = desc.offset() + desc.size();
+            void *addr = mmap(0, size, PROT_READ, MAP_SHARED, fd, 0);
+            close(fd);
+            if (addr == MAP_FAILED) {
+                reportError(resp, "Unable to map shared memory " + name +
+                                  ": " + strerror(errno)
+                            );
+                return;
+            }
+
+            mawb::RPC payload;
+            if (!payload.ParseFromArray(static_cast<char *>(addr) +
+                                         desc.offset(),
+                                        desc.size()
+                                        ))
+                reportError(resp, "Invalid RPC in shared memory " + name);
+            else if (payload.has_shm_payload())
+                reportError(resp, "Nested shared memory payload in " + name);
+            else
+                processRPC(payload, resp);
+            munmap(addr, size);
+        }
+
         // Processes the message, returns 'true' if the message is so far
         // still viable, false if the reactor should terminate the connection.
         bool processMessage() {
             // Make sure we have at least 4 bytes, which will give us the
             // length of the payload.
-            while (inData.size() >= 4) {
+            while (inEnd - inStart >= 4) {
 
                 // Get the size of the data.
-                CodedInputStream src(
-                    reinterpret_cast<const uint8 *>(inData.data()),
-                    inData.size()
-                );
+                const uint8 *frame =
+                    reinterpret_cast<const uint8 *>(&inData[inStart]);
                 uint32 size;
-                if (!src.ReadLittleEndian32(&size))
+                CodedInputStream::ReadLittleEndian32FromArray(frame, &size);
+                size_t frameSize = static_cast<size_t>(size) + 4;
+                if (frameSize > maxFrameSize) {
+                    cerr << "RPC message of size " << size << " exceeds "
+                        "the maximum frame size, closing connection\r" <<
+                        endl;
                     return false;
+                }
 
-                // Make sure we have enough data.
-                if (inData.size() < size + 4) {
-                    cerr << "Incomplete message, waiting for " << size <<
-                        ".\r" << endl;
-                    return true;
+                // Make sure we have enough data.  If the buffer isn't big
+                // enough to hold the whole message, make room for more of it
+                // so the rest can be received in place.  We grow by at most
+                // the amount we've received so that the size in the header
+                // alone can't make us allocate a lot of memory.
+                size_t received = inEnd - inStart;
+                if (received < frameSize) {
+                    reserveInput(min(frameSize - received,
+                                     max(received, size_t(readSize))
+                                     ));
+                    break;
                 }
 
-                // Process all of the requests in the RPC message.
+                // Parse the RPC message directly from the buffer.
                 mawb::RPC rpc;
-                rpc.ParseFromString(inData.substr(4));
+                bool parsed = rpc.ParseFromArray(frame + 4, size);
+                inStart += frameSize;
+                if (!parsed) {
+                    cerr << "Invalid RPC message of size " << size << "\r" <<
+                        endl;
+                    continue;
+                }
 
                 // If there is a message id, create a response.
                 Response *resp = 0;
@@ -205,83 +831,36 @@ class ConnectionHandler : public Reactable {
                     resp->set_msg_id(rpc.msg_id());
                 }
 
-                if (rpc.echo_size()) {
-                    for (int i = 0; i < rpc.echo_size(); ++i)
-                        processEcho(rpc.echo(i));
-                }
-
-                if (rpc.set_ticks_size()) {
-                    for (int i = 0; i < rpc.set_ticks_size(); ++i)
-                        processSetTicks(rpc.set_ticks(i));
-                }
-
-                if (rpc.set_initial_state_size()) {
-                    for (int i = 0; i < rpc.set_initial_state_size(); ++i)
-                        processSetInitialState(rpc.set_initial_state(i));
-                }
-
-                if (rpc.has_set_input_params()) {
-                    const SetInputParams &inputParams = rpc.set_input_params();
-                    if (inputParams.has_output_channel())
-                        controller.getInputDispatcher()->setOutputChannel(
-                            inputParams.output_channel()
-                        );
-                }
-
-                if (rpc.has_save_state())
-                    processSaveState(rpc.save_state());
-
-                if (rpc.has_load_state())
-                    processLoadState(rpc.load_state(), resp);
-
-                if (rpc.has_add_track()) {
-                    controller.addTrack(rpc.add_track());
-                }
-
-                // We do this after the state change events so a client can
-                // add a "play" to setup.
-                if (rpc.has_change_sequencer_state())
-                    processSetState(rpc.change_sequencer_state());
-
-                if (rpc.has_change_jack_state())
-                    processChangeJackState(rpc.change_jack_state());
-
-                if (rpc.has_clear_state())
-                    processClearState(rpc.clear_state());
-
-                if (rpc.has_shutdown())
-                    processShutdown(rpc.shutdown());
-
-                if (rpc.has_change_section())
-                    processChangeSection(rpc.change_section());
-
-                if (rpc.has_new_section())
-                    processNewSection(rpc.new_section());
-
-                if (rpc.has_change_channel_attrs())
-                    processChangeChannelAttrs(rpc.change_channel_attrs());
-
-                // Truncate the used portion of the buffer.
-                inData = inData.substr(size + 4);
+                processRPC(rpc, resp);
 
                 // Send the response, if requested.
                 if (resp) {
                     sendMessage(*resp);
                     delete resp;
                 }
+            }
 
+            // If we've processed everything, start again at the beginning
+            // of the buffer (and free the space used by a large message).
+            if (inStart == inEnd) {
+                inStart = inEnd = 0;
+                if (inData.size() > readSize * 16)
+                    vector<char>(readSize).swap(inData);
             }
             return true;
         }
 
         virtual void handleRead(Reactor &reactor) {
-            int rc = socket->recv(buffer, sizeof(buffer));
+            // Receive directly into the input buffer.
+            reserveInput(readSize);
+            int rc = socket->recv(&inData[inEnd], inData.size() - inEnd);
             if (rc == 0) {
                 // shutdown the connection.
                 reactor.removeReactable(this);
             } else if (rc > 0) {
-                inData.append(buffer, rc);
-                processMessage();
+                inEnd += rc;
+                if (!processMessage())
+                    reactor.removeReactable(this);
             } else {
                 cerr << "Error on connection <xxx need connection info>" <<
                     endl;
@@ -289,11 +868,31 @@ class ConnectionHandler : public Reactable {
         }
 
         virtual void handleWrite(Reactor &reactor) {
-            int rc = socket->send(outData.data(), outData.size());
-            if (rc > 0)
-                outData = outData.substr(rc);
-            else if (rc < 0)
+            // Send as many of the pending frames as we can at once.
+            iovec iov[maxFramesPerSend];
+            int count = 0;
+            for (deque<string>::iterator frame = outFrames.begin();
+                 frame != outFrames.end() && count < maxFramesPerSend;
+                 ++frame, ++count
+                 ) {
+                size_t skip = count ? 0 : outOffset;
+                iov[count].iov_base = const_cast<char *>(frame->data()) + skip;
+                iov[count].iov_len = frame->size() - skip;
+            }
+
+            ssize_t rc = socket->sendv(iov, count);
+            if (rc < 0) {
                 cerr << "Error on write to <need connection info>" << endl;
+                return;
+            }
+
+            // Discard the frames that have been sent completely.
+            size_t sent = rc + outOffset;
+            while (!outFrames.empty() && sent >= outFrames.front().size()) {
+                sent -= outFrames.front().size();
+                outFrames.pop_front();
+            }
+            outOffset = sent;
         }
 
         virtual void handleError(Reactor &reactor) {
@@ -312,17 +911,97 @@ class ConnectionHandler : public Reactable {
         }
 };
 
+// Store the fields of 'state' that differ from 'last' in 'delta' and update
+// 'last' to match 'state'.  Returns true if there were any differences.
+static bool diffState(const EngineState &state, EngineState &last,
+                      EngineState &delta
+                      ) {
+    #define DIFF_FIELD(name) \
+        if (!last.has_##name() || last.name() != state.name()) { \
+            delta.set_##name(state.name()); \
+            last.set_##name(state.name()); \
+        }
+    DIFF_FIELD(playing)
+    DIFF_FIELD(record_channel)
+    DIFF_FIELD(pos)
+    DIFF_FIELD(section_index)
+    DIFF_FIELD(section_count)
+    DIFF_FIELD(section_end)
+    DIFF_FIELD(channel_status)
+    #undef DIFF_FIELD
+    return delta.ByteSizeLong() != 0;
+}
+
+void DaemonMetrics::fill(Metrics &metrics) {
+    jackEngine.getMetrics(metrics);
+
+    size_t outputFrames = 0, maxOutputFrames = 0, inputBytes = 0;
+    for (set<ConnectionHandler *>::iterator iter = connections.begin();
+         iter != connections.end();
+         ++iter
+         ) {
+        size_t frames = (*iter)->getOutputFrames();
+        outputFrames += frames;
+        if (frames > maxOutputFrames)
+            maxOutputFrames = frames;
+        inputBytes += (*iter)->getInputBytes();
+    }
+    metrics.set_connections(connections.size());
+    metrics.set_output_frames(outputFrames);
+    metrics.set_max_output_frames(maxOutputFrames);
+    metrics.set_input_bytes(inputBytes);
+
+    metrics.set_loop_latency_last(latencyLast);
+    metrics.set_loop_latency_mean(probes ? latencySum / probes : 0);
+    metrics.set_loop_latency_max(latencyMax);
+}
+
+void StatePublisher::run() {
+    scheduled = false;
+    if (subscriptions.empty())
+        return;
+
+    // Push to every subscription whose interval has (nearly) elapsed, we
+    // allow half a period of slack so that pushes don't slip a whole period
+    // when the reactor runs us a little early.
+    Time now = Time::now();
+    int64 slack = getPeriod() / 2;
+    EngineState state;
+    jackEngine.getState(state);
+    for (SubscriptionMap::iterator iter = subscriptions.begin();
+         iter != subscriptions.end();
+         ++iter
+         ) {
+        Subscription &sub = iter->second;
+        if (toMicros(now - sub.lastPush) + slack < sub.interval)
+            continue;
+        sub.lastPush = now;
+
+        Response push;
+        if (diffState(state, sub.last, *push.mutable_state()))
+            iter->first->sendMessage(push);
+    }
+    schedule();
+}
+
 class Listener : public Reactable {
     private:
         Socket socket;
         Controller &controller;
         JackEngine &jackEngine;
+        StatePublisherPtr publisher;
+        DaemonMetricsPtr metrics;
 
     public:
-        Listener(int port, Controller &controller, JackEngine &jackEngine) :
+        Listener(int port, Controller &controller, JackEngine &jackEngine,
+                 StatePublisher *publisher,
+                 DaemonMetrics *metrics
+                 ) :
             socket(port),
             controller(controller),
-            jackEngine(jackEngine) {
+            jackEngine(jackEngine),
+            publisher(publisher),
+            metrics(metrics) {
 
             socket.listen(5);
             socket.setReusable(true);
@@ -339,9 +1018,13 @@ class Listener : public Reactable {
          */
         virtual void handleRead(Reactor &reactor) {
             reactor.addReactable(
-                new ConnectionHandler(socket.acceptAlloc(), controller,
-                                      jackEngine
-                                      )
+                new ConnectionHandler(
+                    new SocketConnection(socket.acceptAlloc()),
+                    controller,
+                    jackEngine,
+                    publisher.get(),
+                    metrics.get()
+                )
             );
         }
 
@@ -377,6 +1060,98 @@ class Listener : public Reactable {
         }
 };
 
+/**
+ * Listens for connections on a unix domain socket.  These are cheaper than
+ * loopback TCP for clients on the same machine.
+ */
+class UnixListener : public Reactable {
+    private:
+        int fd;
+        string path;
+        Controller &controller;
+        JackEngine &jackEngine;
+        StatePublisherPtr publisher;
+        DaemonMetricsPtr metrics;
+
+    public:
+        UnixListener(const string &path, Controller &controller,
+                     JackEngine &jackEngine,
+                     StatePublisher *publisher,
+                     DaemonMetrics *metrics
+                     ) :
+            path(path),
+            controller(controller),
+            jackEngine(jackEngine),
+            publisher(publisher),
+            metrics(metrics) {
+
+            sockaddr_un addr;
+            memset(&addr, 0, sizeof(addr));
+            addr.sun_family = AF_UNIX;
+            if (path.size() >= sizeof(addr.sun_path))
+                throw spug::Exception("Unix socket path too long: " + path);
+            strcpy(addr.sun_path, path.c_str());
+
+            fd = ::socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+            if (fd == -1)
+                throw spug::Exception(string("Unable to create unix socket: ") +
+                                      strerror(errno)
+                                      );
+
+            // Remove the socket file left behind by an earlier daemon.
+            unlink(path.c_str());
+            if (bind(fd, reinterpret_cast<sockaddr *>(&addr), sizeof(addr)) ||
+                listen(fd, 5)
+                ) {
+                string error = strerror(errno);
+                close(fd);
+                throw spug::Exception("Unable to listen on " + path + ": " +
+                                      error
+                                      );
+            }
+        }
+
+        ~UnixListener() {
+            close(fd);
+            unlink(path.c_str());
+        }
+
+        virtual Status getStatus() {
+            return readyToRead;
+        }
+
+        virtual void handleRead(Reactor &reactor) {
+            int conn = accept4(fd, 0, 0, SOCK_CLOEXEC);
+            if (conn == -1) {
+                cerr << "Error accepting on " << path << ": " <<
+                    strerror(errno) << "\r" << endl;
+                return;
+            }
+            reactor.addReactable(
+                new ConnectionHandler(new FDConnection(conn), controller,
+                                      jackEngine,
+                                      publisher.get(),
+                                      metrics.get()
+                                      )
+            );
+        }
+
+        virtual void handleWrite(Reactor &reactor) {}
+
+        virtual void handleError(Reactor &reactor) {
+            cerr << "Unix listener got an error!" << endl;
+        }
+
+        virtual void handleDisconnect(Reactor &reactor) {
+            cerr << "unix listener disconnected" << endl;
+            reactor.removeReactable(this);
+        }
+
+        virtual int fileno() {
+            return fd;
+        }
+};
+
 /**
  * A streambuf that just discards all of its input.
  */
@@ -400,9 +1175,18 @@ int main(int argc, const char **argv) {
     FluidSynthDispatcherPtr fs;
 
     bool enablePedal = false;
+    const char *unixPath = 0;
+    int readyFd = -1;
     for (int i = 1; i < argc; ++i) {
         if (!strcmp(argv[i], "-p")) {
             enablePedal = true;
+        } else if (!strcmp(argv[i], "-u") && i + 1 < argc) {
+            // Also listen on a unix domain socket.
+            unixPath = argv[++i];
+        } else if (!strcmp(argv[i], "-r") && i + 1 < argc) {
+            // File descriptor to notify when we're accepting connections
+            // (see comm.launchDaemon()).
+            readyFd = atoi(argv[++i]);
         } else if (!strcmp(argv[i], "-q")) {
             // Make cout and cerr inert.
             cerr.rdbuf(new NullStreambuf());
@@ -444,8 +1228,23 @@ int main(int argc, const char **argv) {
         controller.addInput(dispatcher.get());
         controller.setDispatcher("fluid", fs.get());
 
-        // Create the RPC listener.
-        reactor->addReactable(new Listener(8193, controller, *jackEng));
+        // Create the RPC listener, the publisher for connections that
+        // subscribe to the engine state and the metrics collector.
+        StatePublisherPtr publisher = new StatePublisher(*reactor, *jackEng);
+        DaemonMetricsPtr metrics = new DaemonMetrics(*reactor, *jackEng);
+        metrics->start();
+        reactor->addReactable(
+            new Listener(8193, controller, *jackEng, publisher.get(),
+                         metrics.get()
+                         )
+        );
+        if (unixPath)
+            reactor->addReactable(
+                new UnixListener(unixPath, controller, *jackEng,
+                                 publisher.get(),
+                                 metrics.get()
+                                 )
+            );
 
         // If we're on a TTY, start the terminal interface.
         if (Term::isTTY()) {
@@ -462,6 +1261,15 @@ int main(int argc, const char **argv) {
             }
         }
 
+        // Let whoever started us know that we're ready for connections.
+        if (readyFd != -1) {
+            static const char ready[] = "READY=1\n";
+            if (write(readyFd, ready, sizeof(ready) - 1) == -1)
+                cerr << "Unable to write to ready fd: " << strerror(errno) <<
+                    "\r" << endl;
+            close(readyFd);
+        }
+
         cerr << "AWB daemon started.\r" << endl;
         reactor->run();
     } catch (const Term::Quit &ex) {
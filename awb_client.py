@@ -2,21 +2,35 @@
 import abc
 import amidi
 from collections.abc import Iterable
+from concurrent.futures import Future
 from copy import copy
-from heapq import merge
-from importlib import import_module
+from dataclasses import dataclass, field
+from eventloop import EventLoop
 import jack
 import mawb_pb2
 from midi import Event
+from midihandlers import getForwardDest
+from pipeline import Pipeline
+from pluginloader import initPlugins, loadPlugins, PluginIndex, \
+    PluginStartupError, PluginStartupReport
 import modes
 import os
-import pickle
-from threading import Lock, Thread
-from typing import Any, Callable, Generator, IO, List, Optional
+import subprocess
+from threading import Condition, Thread
+from typing import Any, Callable, Dict, Generator, Hashable, IO, List, \
+    Optional, Sequence, Tuple
 import select
 import time
-from comm import Comm
+from clock import DispatchStats, TickClock
+from comm import Comm, EngineStateMirror
+from latency import getLabel, LatencyTracer, STAGE_DISPATCH, \
+    STAGE_END_TO_END, STAGE_INPUT, STAGE_PROCESS, STAGE_SCHEDULED
+from routeoffload import RouteOffloader
+from scheduler import Handle, OutputThread, PeriodicSource, Scheduler
+import session
+from spsc import EventFD
 from spug.io.proactor import getProactor
+from topology import Addr
 
 # Channel Status
 
@@ -25,14 +39,77 @@ RECORD = 2
 STICKY = 4
 ACTIVE = 8
 
-class Pipe(object):
-    def __init__(self,):
-        self.read, self.write = os.pipe()
+@dataclass
+class ExternalProgram:
+    """An external program to be started by AWBClient.launchPrograms().
+
+    Attrs:
+        command: The command line.
+        jackPorts: Jack ports ("client:port") that the program creates.
+        midiPorts: Midi ports ("client/port") that the program creates.
+        name: The name to use for the program in the startup report,
+            defaults to the basename of the executable.
+    """
+    command: List[str]
+    jackPorts: Sequence[str] = ()
+    midiPorts: Sequence[str] = ()
+    name: Optional[str] = None
+
+    def __post_init__(self):
+        if self.name is None:
+            self.name = os.path.basename(self.command[0])
+
+@dataclass
+class StartupReport:
+    """Results of AWBClient.launchPrograms().
+
+    Attrs:
+        programs: The programs that were launched.
+        processes: The running processes, keyed by program name.
+        portTimes: Seconds from the start of the launch until each port
+            appeared, keyed by port name.
+        launchTime: Seconds spent starting all of the processes.
+        totalTime: Seconds until all ports were available.
+    """
+    programs: List[ExternalProgram] = field(default_factory=list)
+    processes: Dict[str, subprocess.Popen] = field(default_factory=dict)
+    portTimes: Dict[str, float] = field(default_factory=dict)
+    launchTime: float = 0
+    totalTime: float = 0
+
+    def getReadyTime(self, program: ExternalProgram) -> Optional[float]:
+        """Returns the time when all of the program's ports were available,
+        None if some of them never showed up.
+        """
+        times = [self.portTimes.get(port)
+                 for port in list(program.jackPorts) + list(program.midiPorts)
+                 ]
+        if None in times:
+            return None
+        return max(times, default=0)
+
+    def __str__(self):
+        lines = ['started %d programs in %.3fs, all ports ready after %.3fs' %
+                  (len(self.programs), self.launchTime, self.totalTime)
+                 ]
+        for program in self.programs:
+            ready = self.getReadyTime(program)
+            lines.append('  %s: %s' % (
+                program.name,
+                'not ready' if ready is None else 'ready at %.3fs' % ready
+            ))
+            for port in list(program.jackPorts) + list(program.midiPorts):
+                t = self.portTimes.get(port)
+                lines.append('    %s: %s' % (
+                    port, 'missing' if t is None else '%.3fs' % t
+                ))
+        return '\n'.join(lines)
 
 class AWBClientState:
     """Persisted AWB client state.
 
-    We create one of these for writing the client state.
+    This is the pickled format used by older versions, session.read() still
+    uses it to load their files.
     """
 
     def __init__(self, voices: List[modes.StateVec], plugins: List['Plugin']):
@@ -45,10 +122,17 @@ class Plugin(abc.ABC):
     Plugins are classes that implement this interface.  They are used to
     extend the functionality of MAWB.  There are default versions of all of
     the methods, all of which do nothing.
+
+    Plugins are initialized concurrently on worker threads (see
+    pluginloader).  A plugin that needs other plugins to be initialized
+    first should list their names in "requires".
     """
 
+    # Names of the plugins that must be initialized before this one.
+    requires : Sequence[str] = ()
+
     def init(self, client: 'AWBClient'):
-        """Called during initialization."""
+        """Called during initialization, from a worker thread."""
 
     def shutdown(self, client: 'AWBClient'):
         """Called during shutdown."""
@@ -116,60 +200,131 @@ class AWBClient(object):
         dispatchEvent: [callable<AWBClient, midi.Event>] A user function to
             manage event processing.
         midiIn: [amidi.Port] the midi input port
+        routeOffload: [bool] If true (the default), when dispatchEvent is a
+            plain forward (e.g. midihandlers.PassThrough) and there are no
+            input processors, the sources connected to midiIn are connected
+            directly to the destination port so the kernel routes their
+            events without involving python.
+        eventLoop: [eventloop.EventLoop or None] The event loop, if the
+            client was created with useEventLoop.
+        engineState: [comm.EngineStateMirror] The state of the daemon's
+            jack engine.  This is pushed by the daemon every
+            'stateInterval' milliseconds while it's changing.  Until the
+            first state arrives, 'paused' is the value passed to the
+            constructor.
+
+    By default, the connection to awbd, midi input, midi output and the
+    pedal are each serviced by their own thread.  If 'useEventLoop' is true,
+    they are all serviced by a single event loop thread instead, which
+    means fewer context switches.  Other threads (e.g. the UI) can run code
+    on the loop thread with eventLoop.callSoon().
     """
 
-    def __init__(self, recordEnabled = False, paused = True):
+    def __init__(self, recordEnabled = False, paused = True,
+                 useEventLoop = False, stateInterval = 50):
         self.jack = jack.Client('MAWBSession')
-        self.comm = Comm()
+
+        # Jack only delivers notifications to active clients, and callbacks
+        # must be registered before activation.
+        self.__jackPortsChanged = Condition()
+        self.__jackPortGeneration = 0
+        self.jack.set_port_registration_callback(
+            self.__onJackPortRegistration
+        )
+        self.jack.activate()
+
+        # Created on demand by waitForMidiPorts().
+        self.__portWatcher : Optional[amidi.PortWatcher] = None
+
+        self.eventLoop : Optional[EventLoop] = \
+            EventLoop() if useEventLoop else None
+        self.__loopThread : Optional[Thread] = None
+
+        # In event loop mode, RPCs sent during an iteration of the loop are
+        # batched.
+        self.comm = Comm(loop = self.eventLoop, autoBatch = useEventLoop)
         self.seq = amidi.getSequencer(name = 'MAWB')
         self.recordEnabled = recordEnabled
-        self.paused = paused
         self.recording = {}
         self.recordChannel = -1
-        self.sectionIndex = 0
-        self.sectionCount = 1
         self.voices = []
         self.plugins = []  # type: List[Plugin]
+        self.__pluginIndex = PluginIndex('plugins')
+
+        # The startup report from the last time plugins were initialized.
+        self.pluginReport : Optional[PluginStartupReport] = None
+
+        # Named midi registers (recorded event sequences) and loop register
+        # contents indexed by loop number.  These are persisted by writeTo().
+        self.registers : Dict[str, Sequence[Event]] = {}
+        self.loops : Dict[int, session.SavedLoop] = {}
+
         self.state = None
-        self.dispatchEvent = None
-
-        # List of input processors.
-        #
-        # Input processors are applied to events after they are received from
-        # the system but before they are dispatched.  They are free to mutate
-        # the event.
-        #
-        # An input processor that returns true terminates the input chain.  No
-        # further processors are called and the event is not dispatched.
-        self.inputProcessors : Callable[[AWBClient, Event], bool] = []
-
-        # Start of time (unix time of the start of the midi thread).
-        self.__startOfTime = 0
-
-        # Pending midi event queue.  These get processed in the midi in the
-        # midi input thread.
-        self.__queue : List[Event] = []
-        self.__queueLock = Lock()
-
-        # {int: int}.  Maps channels to current status.
+        self.__dispatchEvent = None
+        self.routeOffload = True
+
+        # Input processors, see the inputProcessors property.  This is
+        # replaced rather than modified so the input thread can iterate over
+        # it without locking.
+        self.__inputProcessors : \
+            Tuple[Callable[[AWBClient, Event], bool], ...] = ()
+
+        # The compiled input processors and dispatch handler.
+        self.__pipeline = Pipeline(self)
+
+        # The tick clock.  Tick zero is the start of the midi thread.  This is
+        # only used for scheduling on the client, the daemon works in frames
+        # and has no notion of tempo.
+        self.__clock = TickClock(bpm=60, ppb=512)
+
+        # Statistics on how late scheduled events are dispatched.
+        self.__dispatchStats = DispatchStats()
+
+        # Latency tracer for the midi path, None when tracing is disabled
+        # (see enableTracing()).
+        self.tracer : Optional[LatencyTracer] = None
+
+        # Pending midi event queue.  Events are dispatched on the midi output
+        # thread, other threads hand events to it without locking.
+        self.__scheduler = Scheduler()
+        self.__outputThread = OutputThread(self.__scheduler, self.__clock,
+                                           self.__dispatchScheduled,
+                                           self.__dispatchStats
+                                           )
+
+        # Used to wake up the midi input thread when we're stopping.
+        self.__inputWakeup = EventFD()
+        self.__stopping = False
+
+        # {int: int}.  Maps channels to current status.  Everything but
+        # ACTIVE comes from the engine state.
         self.__channels = dict((i, 0) for i in range(8))
 
         # channel subscribers (dict<int, list<callback<int, int>>>)
         self.__subs = {}
 
-        # beats-per-minute and pulses per beat parameters.
-        # TODO: share these with awbd.
-        self.__bpm = 60
-        self.__ppb = 512
-
-        # Create a midi input port.
-        self.midiIn = self.makeMidiInPort('in')
+        # Mirror the daemon's engine state.  'paused' is what we assume until
+        # the daemon sends its state in response to the subscription.
+        self.engineState = EngineStateMirror()
+        self.engineState.update(mawb_pb2.EngineState(playing = not paused))
+        self.engineState.addListener(self.__onEngineState)
+        self.comm.subscribe(self.engineState.update, stateInterval)
+
+        # Create a midi input port.  Input is timestamped by the kernel
+        # against a real-time queue that we start along with the midi input
+        # thread, so timestamps are seconds since our start of time.
+        self.__inputQueue = self.seq.createQueue('MAWB')
+        self.midiIn = self.seq.createInputPort('in', self.__inputQueue)
+        self.__offloader = RouteOffloader(
+            self.seq, Addr(self.midiIn.addr.client, self.midiIn.addr.port)
+        )
 
         # Start the proactor thread.  We do this after Comm() has been
         # created so there are connections to manage, otherwise the proactor
         # will just immediately terminate.
-        proactorThread = Thread(target = getProactor().run)
-        proactorThread.start()
+        if not self.eventLoop:
+            proactorThread = Thread(target = getProactor().run)
+            proactorThread.start()
 
         self.threadPipeRd, self.threadPipeWr = os.pipe()
 
@@ -186,29 +341,44 @@ class AWBClient(object):
         else:
             self.pedal = None
 
+        # "closed clean" means that we ended the record of the last channel
+        # by a press of the channel's pedal.  In this case, we don't want to
+        # start recording when the pedal is released.
+        self.__pedalClosedClean = False
+
         # Start the pedal handler thread.
         if self.pedal:
-            self.pedalThread = Thread(target = self.handlePedal)
-            self.pedalThread.start()
+            if self.eventLoop:
+                self.eventLoop.addReader(self.pedal.fileno(), self.__readPedal)
+            else:
+                self.pedalThread = Thread(target = self.handlePedal)
+                self.pedalThread.start()
 
         # Callbacks.
         self.onProgramChange = None
 
-    def startMidiInputThread(self):
-        # Start the midi input thread.
-        self.midiInputControl = Pipe()
-        self.midiInputThread = threading.Thread(target = self.handleMidiInput)
+        if self.eventLoop:
+            self.__loopThread = Thread(target = self.eventLoop.run,
+                                       name = 'awb-loop'
+                                       )
+            self.__loopThread.start()
 
     def init(self):
         """Initialize the current client.
 
         This initializes all plugins and sets the current state.
+
+        Raises:
+            PluginStartupError: if some plugins failed to initialize.  The
+                client is still initialized, the failed plugins are removed
+                from 'plugins'.
         """
         # Initialize all of the plugins.
-        for plugin in self.plugins:
-            plugin.init(self);
+        report = self.initPlugins(self.plugins)
 
         self.state.activate()
+        if report.getErrors():
+            raise PluginStartupError(report)
 
     def shutdown(self):
         """Shutdown the current client (shuts down all plugins)."""
@@ -216,11 +386,23 @@ class AWBClient(object):
             plugin.shutdown(self)
 
     def startMidiInputThread(self):
-        # Start the midi input thread.
-        self.__startOfTime = time.time()
-        self.midiInputControl = Pipe()
-        self.midiInputThread = Thread(target = self.handleMidiInput)
-        self.midiInputThread.start()
+        # Start the midi input and output threads (or attach midi input and
+        # output to the event loop).
+        self.__clock.start()
+        self.seq.startQueue(self.__inputQueue)
+        if self.eventLoop:
+            self.eventLoop.callSoon(self.__attachMidi)
+        else:
+            self.midiInputThread = Thread(target = self.handleMidiInput)
+            self.midiInputThread.start()
+            self.__outputThread.start()
+
+    def __attachMidi(self):
+        """Service midi input and output from the event loop."""
+        self.eventLoop.addReader(self.seq.getPollHandle(),
+                                 self.__readMidiInput
+                                 )
+        self.__outputThread.attach(self.eventLoop)
 
     def __convertToPortInfo(self, src):
         """Convert 'src' to PortInfo, if it is PortInfo we just return it."""
@@ -241,6 +423,155 @@ class AWBClient(object):
         dstPort = self.__convertToPortInfo(dst)
         self.seq.connect(srcPort, dstPort)
 
+    @property
+    def dispatchEvent(self):
+        return self.__dispatchEvent
+
+    @dispatchEvent.setter
+    def dispatchEvent(self, handler):
+        self.__dispatchEvent = handler
+        self.__pipeline.configure(self.__inputProcessors, handler)
+        self.updateRouteOffload()
+
+    @property
+    def inputProcessors(self) -> Tuple[Callable[['AWBClient', Event], bool],
+                                       ...]:
+        """The input processors, in the order they're applied.
+
+        Input processors are applied to events after they are received from
+        the system but before they are dispatched.  They are free to mutate
+        the event.
+
+        An input processor that returns true terminates the input chain.  No
+        further processors are called and the event is not dispatched.
+
+        This is read-only, use addInputProcessor() and removeInputProcessor()
+        to change it so that the compiled pipeline and offloaded routes are
+        updated.
+        """
+        return self.__inputProcessors
+
+    def __setInputProcessors(
+        self, procs: Tuple[Callable[['AWBClient', Event], bool], ...]
+    ) -> None:
+        self.__inputProcessors = procs
+        self.__pipeline.configure(procs, self.__dispatchEvent)
+        self.updateRouteOffload()
+
+    def addInputProcessor(self, proc: Callable[['AWBClient', Event], bool]):
+        """Add an input processor to the end of inputProcessors."""
+        self.__setInputProcessors(self.__inputProcessors + (proc,))
+
+    def removeInputProcessor(self, proc: Callable[['AWBClient', Event], bool]):
+        """Remove an input processor added with addInputProcessor().
+
+        Raises ValueError if 'proc' isn't an input processor.
+        """
+        procs = list(self.__inputProcessors)
+        procs.remove(proc)
+        self.__setInputProcessors(tuple(procs))
+
+    def invalidatePipeline(self) -> None:
+        """Recompile the dispatch pipeline.
+
+        Destination ports are resolved when the pipeline is compiled, so this
+        must be called if ports that handlers send to are recreated.
+        """
+        self.__pipeline.invalidate()
+
+    def __getOffloadDest(self) -> Optional[str]:
+        """Returns the port that input can be routed to directly, None if
+        input needs to go through python.
+        """
+        if not self.routeOffload or self.__inputProcessors:
+            return None
+        return getForwardDest(self.__dispatchEvent)
+
+    def updateRouteOffload(self) -> List[Tuple[str, str]]:
+        """Offload pass-through routing to the kernel where possible.
+
+        If dispatchEvent is a plain forward to a single port and there are no
+        input processors, every source connected to midiIn is connected
+        directly to the destination port and disconnected from midiIn.  If
+        that is no longer the case, previously offloaded sources are connected
+        back to midiIn.
+
+        This is called automatically when dispatchEvent or the input
+        processors change and after a program is activated, it should be
+        called explicitly after connecting new sources to midiIn.
+
+        Returns the list of offloaded routes as (source, destination) port
+        names.
+        """
+        return self.__offloader.update(self.__getOffloadDest())
+
+    def getOffloadedRoutes(self) -> List[Tuple[str, str]]:
+        """Returns the routes currently being handled by the kernel, as a list
+        of (source, destination) port names.
+        """
+        return self.__offloader.getRoutes()
+
+    def __onJackPortRegistration(self, port, register):
+        with self.__jackPortsChanged:
+            self.__jackPortGeneration += 1
+            self.__jackPortsChanged.notify_all()
+
+    def __hasJackPort(self, portName: str) -> bool:
+        try:
+            self.jack.get_port_by_name(portName)
+            return True
+        except jack.JackError:
+            return False
+
+    def waitForJackPorts(self, portNames: Iterable[str], timeout: float,
+                         start: Optional[float] = None
+                         ) -> Dict[str, float]:
+        """Wait for all of the jack ports in 'portNames' to exist.
+
+        This doesn't poll: we only recheck when jack notifies us that a port
+        has been registered.
+
+        Args:
+            portNames: Port names in "client:port" format.
+            timeout: Maximum number of seconds to wait.
+            start: Reference time (from time.monotonic()) for the times in
+                the result, defaults to now.
+
+        Returns a dictionary mapping each port name to the time (in seconds
+        since 'start') when we first saw it.
+
+        Raises:
+            TimeoutError: If some of the ports didn't show up in time.
+        """
+        now = time.monotonic()
+        if start is None:
+            start = now
+        endTime = now + timeout
+        pending = set(portNames)
+        result = {}
+        while True:
+            with self.__jackPortsChanged:
+                generation = self.__jackPortGeneration
+
+            now = time.monotonic()
+            for name in list(pending):
+                if self.__hasJackPort(name):
+                    result[name] = now - start
+                    pending.remove(name)
+            if not pending:
+                return result
+
+            remaining = endTime - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('timed out waiting for %s' %
+                                   ', '.join(sorted(pending))
+                                   )
+            with self.__jackPortsChanged:
+                self.__jackPortsChanged.wait_for(
+                    lambda: self.__jackPortGeneration != generation,
+                    remaining
+                )
+
     def waitForJack(self, portName, timeout=3.0):
         """Wait for a jack port to become available.
 
@@ -251,15 +582,21 @@ class AWBClient(object):
             portName: [str] a jack port name in "client:port" format.
 
         Raises:
-            Exception: On a timeout.
+            TimeoutError: On a timeout.
+        """
+        self.waitForJackPorts([portName], timeout)
+
+    def waitForMidiPorts(self, portNames: Iterable[str], timeout: float,
+                         start: Optional[float] = None
+                         ) -> Dict[str, float]:
+        """Wait for all of the midi ports in 'portNames' to exist.
+
+        This is the midi equivalent of waitForJackPorts(), it's driven by
+        ALSA port announcements.
         """
-        endTime = time.time() + timeout
-        while time.time() < endTime:
-            for port in self.jack.get_ports():
-                if port.name == portName:
-                    return
-            time.sleep(0.1)
-        raise Exception('timed out waiting for %s' % portName)
+        if self.__portWatcher is None:
+            self.__portWatcher = amidi.PortWatcher()
+        return self.__portWatcher.waitForPorts(portNames, timeout, start)
 
     def waitForMidi(self, portName, timeout=5.0):
         """Wait for a midi port to become available.
@@ -271,15 +608,67 @@ class AWBClient(object):
             portName: [str] a midi port name in "client/port" format.
 
         Raises:
-            Exception: On a timeout.
+            TimeoutError: On a timeout.
         """
-        endTime = time.time() + timeout
-        while time.time() < endTime:
-            for port in self.seq.iterPortInfos():
-                if port.fullName == portName:
-                    return
-                time.sleep(0.1)
-        raise Exception('timed out waiting for %s' % portName)
+        self.waitForMidiPorts([portName], timeout)
+
+    def launchPrograms(self, programs: Sequence['ExternalProgram'],
+                       timeout: float = 10.0
+                       ) -> 'StartupReport':
+        """Start several external programs at once and wait for all of their
+        ports to come up.
+
+        All of the programs are started before we wait for anything, and jack
+        and midi ports are waited for concurrently, so the total startup time
+        is that of the slowest program rather than the sum of all of them.
+
+        Returns a StartupReport with the processes and the time it took for
+        each port to appear.
+
+        Raises:
+            TimeoutError: If any port didn't show up in time.  The exception
+                has a "report" attribute with the partial report, the
+                programs are left running.
+        """
+        start = time.monotonic()
+        report = StartupReport(list(programs))
+        for program in programs:
+            report.processes[program.name] = \
+                subprocess.Popen(program.command)
+        report.launchTime = time.monotonic() - start
+
+        midiPorts = [port for program in programs
+                     for port in program.midiPorts]
+        jackPorts = [port for program in programs
+                     for port in program.jackPorts]
+
+        # Wait for midi ports in a separate thread while we wait for jack.
+        midiError = []
+        def waitForMidi():
+            try:
+                report.portTimes.update(
+                    self.waitForMidiPorts(midiPorts, timeout, start)
+                )
+            except TimeoutError as ex:
+                midiError.append(ex)
+        midiThread = Thread(target=waitForMidi)
+        midiThread.start()
+
+        try:
+            report.portTimes.update(
+                self.waitForJackPorts(jackPorts, timeout, start)
+            )
+        except TimeoutError as ex:
+            midiThread.join()
+            ex.report = report
+            raise
+        midiThread.join()
+        if midiError:
+            midiError[0].report = report
+            raise midiError[0]
+
+        report.totalTime = time.monotonic() - start
+        return report
 
     def jackConnect(self, src, dst):
         """Connect two jack ports.
@@ -341,33 +730,48 @@ class AWBClient(object):
         self.comm.sendRPC(change_jack_state = req)
         self.recording[channel] = False
         self.recordChannel = -1
-        self.__setStatus(channel, record = False, nonempty = True)
 
-    def __setStatus(self, channel, nonempty = None, record = None,
-                    sticky = None,
-                    active = None):
-        flags = self.__channels[channel]
-        if nonempty is not None:
-            flags = flags | NONEMPTY if nonempty else flags & ~NONEMPTY
-        if record is not None:
-            flags = flags | RECORD if record else flags & ~RECORD
-        if sticky is not None:
-            flags = flags | STICKY if sticky else flags & ~STICKY
-        if active is not None:
-            flags = flags | ACTIVE if active else flags & ~ACTIVE
+    def __setStatus(self, channel, flags):
+        if flags == self.__channels[channel]:
+            return
         self.__channels[channel] = flags
         for cb in self.__subs.get(channel, []):
             cb(channel, flags)
 
+    def __setActive(self, channel, active):
+        flags = self.__channels[channel]
+        self.__setStatus(channel, flags | ACTIVE if active else
+                                  flags & ~ACTIVE
+                         )
+
+    def __onEngineState(self, state, delta):
+        """Engine state listener, updates the channel status."""
+        if not delta.HasField('channel_status'):
+            return
+        for channel, flags in list(self.__channels.items()):
+            self.__setStatus(channel,
+                             flags & ACTIVE |
+                             self.engineState.getChannelStatus(channel) &
+                             (NONEMPTY | RECORD | STICKY)
+                             )
+
+    @property
+    def paused(self) -> bool:
+        return not self.engineState.state.playing
+
+    @property
+    def sectionIndex(self) -> int:
+        return self.engineState.state.section_index
+
+    @property
+    def sectionCount(self) -> int:
+        return self.engineState.state.section_count
+
     def startRecord(self, channel):
         # If we're recording on another channel, mark that we've ended it.
         if self.recordChannel >= 0:
             self.recording[self.recordChannel] = False
-
-            # Turn off recording and active, turn on nonempty.
-            self.__setStatus(self.recordChannel, record = False, active = False,
-                             nonempty = True
-                             )
+            self.__setActive(self.recordChannel, False)
 
         req = mawb_pb2.ChangeJackStateRequest()
         req.state = mawb_pb2.RECORD
@@ -375,23 +779,23 @@ class AWBClient(object):
         self.comm.sendRPC(change_jack_state = req)
         self.recording[channel] = True
         self.recordChannel = channel
-        self.paused = False
-        self.__setStatus(channel, record = True, active = True)
+        self.__setActive(channel, True)
 
     def clearAllState(self):
         self.comm.sendRPC(clear_state = mawb_pb2.ClearStateRequest())
-        self.sectionIndex = 0
-        self.sectionCount = 1
 
-        for channel in self.__subs.iterkeys():
-            self.__setStatus(channel, active = True)
+        for channel in list(self.__subs.keys()):
+            self.__setActive(channel, True)
 
     def togglePause(self):
-        """Toggle pause/play of the daemon."""
+        """Toggle pause/play of the daemon.
+
+        This is based on the last state pushed by the daemon, so 'paused'
+        doesn't change until the daemon pushes the new state.
+        """
         req = mawb_pb2.ChangeJackStateRequest()
         req.state = mawb_pb2.PLAY if self.paused else mawb_pb2.IDLE
         self.comm.sendRPC(change_jack_state = req)
-        self.paused = not self.paused
 
     def activate(self, channel):
         """Activate the state vector for the specified channel.
@@ -405,18 +809,21 @@ class AWBClient(object):
         self.voices[channel].activate(self, self.state)
         self.state = self.voices[channel]
 
+        # Activation may have changed the connections to midiIn.
+        self.updateRouteOffload()
+
         # Change status, deactivate currently active channel and activate new
         # one.
         for ch, stat in self.__channels.items():
             if stat & ACTIVE:
-                self.__setStatus(ch, active = False)
-        self.__setStatus(channel, active = True)
+                self.__setActive(ch, False)
+        self.__setActive(channel, True)
 
     def nextOrNewSection(self):
+        # Section changes happen when the current section ends, until then
+        # the engine state still has the old section.
         if self.sectionIndex == self.sectionCount - 1:
             print('sending new section request')
-            self.sectionCount += 1
-            self.sectionIndex += 1
             self.comm.sendRPC(new_section = mawb_pb2.NewSectionRequest())
             return
         print('changing section index')
@@ -424,171 +831,289 @@ class AWBClient(object):
         req.sectionIndex = 1
 
         self.comm.sendRPC(change_section = req)
-        self.sectionIndex += 1
 
     def prevSection(self):
         print('setting to previous section')
         req = mawb_pb2.ChangeSectionRequest()
         req.sectionIndex = -1
         self.comm.sendRPC(change_section = req)
-        self.sectionIndex = (self.sectionIndex - 1) % self.sectionCount
 
     def handlePedal(self):
         """Background thread for processing pedal input."""
-
-        # "closed clean" means that we ended the record of the last channel by
-        # a press of the channel's pedal.  In this case, we don't want to start
-        # recording when the pedal is released.
-        closedClean = False
-
         while True:
             rdx, wrx, erx = select.select(
                 [self.pedal, self.threadPipeRd], [], []
             )
             if self.threadPipeRd in rdx:
                 break
+            self.__readPedal()
 
-            action = self.pedal.read(1)
-            action = ord(action)
-            release = False
-            if action & 0x80:
-                action = action & 0x7F
-                release = True
-
-            if action in (8, 9):
-                if release:
-                    continue
-                if action == 8:
-                    self.prevSection()
-                elif action == 9:
-                    self.nextOrNewSection()
-                continue
+    def __readPedal(self):
+        """Read and process a pedal action.
 
+        A single pedal action can send several RPCs (e.g. ending a record,
+        then changing the jack state), so they're sent as a batch.
+        """
+        with self.comm.batch():
+            self.__processPedalAction()
+
+    def __processPedalAction(self):
+        action = self.pedal.read(1)
+        action = ord(action)
+        release = False
+        if action & 0x80:
+            action = action & 0x7F
+            release = True
+
+        if action in (8, 9):
             if release:
-                # If we're releasing, start recording on the channel
-                if not closedClean:
-                    if self.recordEnabled: self.startRecord(channel)
-                else:
-                    # Clear out the previous closedClean.
-                    closedClean = False
+                return
+            if action == 8:
+                self.prevSection()
+            elif action == 9:
+                self.nextOrNewSection()
+            return
 
+        channel = action
+        if release:
+            # If we're releasing, start recording on the channel
+            if not self.__pedalClosedClean:
+                if self.recordEnabled: self.startRecord(channel)
             else:
-                # Initial press: change the voices.
-                channel = action
-                self.activate(channel)
+                # Clear out the previous closedClean.
+                self.__pedalClosedClean = False
 
-                # if we're currently recording on that channel, end the record.
-                if self.recording.get(channel):
-                    self.endRecord(channel)
-                    closedClean = True
+        else:
+            # Initial press: change the voices.
+            self.activate(channel)
+
+            # if we're currently recording on that channel, end the record.
+            if self.recording.get(channel):
+                self.endRecord(channel)
+                self.__pedalClosedClean = True
 
     def getTicks(self, seconds: Optional[float] = None) -> int:
-        """Returns the number of ticks corresponding to 'seconds', or since
-        the client's "start of time" if not provided.
+        """Returns the tick at 'seconds' since the client's "start of time",
+        or the current tick if not provided.
+
+        Ticks are derived from the monotonic clock, so they are unaffected
+        by changes to the system time.
         """
         if seconds is None:
-            seconds = time.time() - self.__startOfTime
-        return int(seconds * (self.__bpm / 60) * self.__ppb)
+            return self.__clock.getTicks()
+        return self.__clock.ticksAt(self.__clock.secsToNs(seconds))
+
+    def setTempo(self, bpm: float) -> None:
+        """Change the tempo (in beats per minute) as of now.
+
+        Ticks already elapsed are unaffected, so events scheduled for a
+        future tick will play at a time based on the new tempo.
+        """
+        self.__clock.setTempo(bpm)
+        self.__outputThread.wake()
+
+    def getTempo(self) -> float:
+        return float(self.__clock.bpm)
 
-    def __getSecs(self, ticks) -> float:
-        """Returns 'ticks' converted to time in seconds."""
-        return ticks / ((self.__bpm / 60) * self.__ppb)
+    def getDispatchStats(self) -> DispatchStats:
+        """Returns the dispatch error statistics for scheduled events.
 
-    def scheduleMidiEvent(self, event: Event):
+        These measure how late each scheduled event was dispatched relative
+        to its intended time.  Call reset() on the result to start a new
+        measurement period.
+        """
+        return self.__dispatchStats
+
+    def getEventTicks(self, event: Event) -> int:
+        """Returns the time that an incoming event was received in ticks
+        since the client's "start of time".
+
+        This uses the kernel timestamp of the event, so it doesn't include
+        any time that the event spent waiting to be processed.  Events that
+        weren't timestamped get the current time.
+        """
+        timestamp = getattr(event, 'timestamp', None)
+        if timestamp is None:
+            return self.getTicks()
+        return self.getTicks(timestamp)
+
+    def scheduleMidiEvent(self, event: Event,
+                          tag: Optional[Hashable] = None
+                          ) -> Handle:
         """Schedule a midi event for playback.
 
-        The event time should be relative to now.  We will make a copy of the
-        event modified to absolute time.
+        The event time should be relative to now.  The event itself is not
+        modified or copied.
+
+        Args:
+            tag: If provided, the event can be cancelled along with all other
+                events with the same tag using cancelScheduled().
+
+        Returns a handle that can be used to cancel or reschedule the event.
         """
-        return self.scheduleMidiEvents([event])
+        return self.__outputThread.schedule(event,
+                                            self.getTicks() + event.time,
+                                            tag
+                                            )
 
     # TODO: replace string Iterable type when we get python 3.9.
-    def scheduleMidiEvents(self, events: 'Iterable[Event]'):
+    def scheduleMidiEvents(self, events: 'Iterable[Event]',
+                           tag: Optional[Hashable] = None
+                           ) -> List[Handle]:
         """Schedule a sequence of midi events for playback.
 
-        'events' _must be ordered by time._
+        The event times should be relative to now.  The events are stored by
+        reference and each is copied as it's dispatched (handlers are free to
+        modify the events they're given), so the same sequence can be
+        scheduled again.
+
+        Args:
+            tag: If provided, the events can be cancelled along with all other
+                events with the same tag using cancelScheduled().
 
-        The event times should be relative to now.  We will make a copy of the
-        events modified to absolute time.
+        Returns the list of handles for the events.
         """
+        return self.__outputThread.scheduleAll(events, self.getTicks(), tag)
 
-        t = self.getTicks()
+    def schedulePeriodic(self, events: Sequence[Event], period: int,
+                         start: int = 0,
+                         phase: int = 0,
+                         tag: Optional[Hashable] = None
+                         ) -> PeriodicSource:
+        """Schedule a sequence of midi events to repeat every 'period' ticks.
 
-        with self.__queueLock:
-            self.__queue = list(merge(offsetEventTimes(events, t),
-                                      self.__queue,
-                                      key=lambda e: e.time
-                                      )
-                                )
+        The events must be sorted by time and are played by reference: the
+        queue never copies them, only a copy of each event is dispatched so
+        the stored events aren't changed by handlers.
 
-        # Interrupt the midi input thread.
-        os.write(self.midiInputControl.write, b'i')
+        Args:
+            events: The events, event times are relative to the start of
+                each cycle.
+            period: The length of the cycle in ticks.
+            start: Start time of the first cycle, relative to now.
+            phase: Offset of the events from the start of each cycle.
+            tag: If provided, the source can be cancelled with
+                cancelScheduled().
+
+        Returns the periodic source, which can be used to mute/unmute the
+        loop or change its period (effective at the next cycle boundary) or
+        to cancel it.
+        """
+        return self.__outputThread.addPeriodic(events, period,
+                                               self.getTicks() + start,
+                                               phase,
+                                               tag
+                                               )
+
+    def cancelScheduled(self, tag: Hashable) -> None:
+        """Cancel all scheduled events and periodic sources with the given
+        tag.
+
+        This takes effect on the midi output thread after everything that
+        the calling thread has already scheduled.
+        """
+        self.__outputThread.cancelTag(tag)
 
-    def __timeoutForNextEvent(self) -> Optional[float]:
-        """The queue lock must be held when calling this."""
-        if self.__queue:
-            t = time.time() - self.__startOfTime
-            next = self.__getSecs(self.__queue[0].time)
-            return 0 if next <= t else next - t
-        else:
-            return None
+    def enableTracing(self, capacity: int = 65536) -> LatencyTracer:
+        """Start tracing latency through the midi path.
 
-    def __processInputEvent(self, event) -> bool:
-        for proc in self.inputProcessors:
-            if proc(self, event):
-                return False
-        return True
+        Returns the tracer, which can be used to get per-stage statistics or
+        export a Chrome trace.
+        """
+        tracer = LatencyTracer(capacity)
+        self.seq.tracer = tracer
+        self.tracer = tracer
+        return tracer
+
+    def disableTracing(self) -> None:
+        self.tracer = None
+        self.seq.tracer = None
+
+    def __traceInputEvent(self, event: Event, tracer: LatencyTracer) -> None:
+        """Version of input event handling that records latency spans."""
+        received = tracer.now()
+        timestamp = getattr(event, 'timestamp', None)
+        if timestamp is not None:
+            stamped = self.__clock.origin + self.__clock.secsToNs(timestamp)
+            tracer.record(STAGE_INPUT, stamped, received)
+
+        # This does what Pipeline.dispatchInput() does, timing each step.
+        pipeline = self.__pipeline
+        start = received
+        for proc in pipeline.processors:
+            consumed = proc(self, event)
+            end = tracer.now()
+            tracer.record(STAGE_PROCESS, start, end, getLabel(proc))
+            start = end
+            if consumed:
+                return
+
+        handler = self.__dispatchEvent
+        if handler:
+            pipeline.dispatch(event)
+            end = tracer.now()
+            tracer.record(STAGE_DISPATCH, start, end, getLabel(handler))
+            if timestamp is not None:
+                tracer.record(STAGE_END_TO_END, stamped, end)
+
+    def __dispatchScheduled(self, event: Event) -> None:
+        """Dispatch a scheduled event, called on the midi output thread."""
+        tracer = self.tracer
+        if tracer is not None:
+            start = tracer.now()
+        if isinstance(event, VirtualEvent):
+            handler = event
+            event(self)
+        else:
+            # Handlers may modify the event (e.g. ChannelFilter), the
+            # original belongs to a register or loop.
+            handler = self.__dispatchEvent
+            self.__pipeline.dispatch(copy(event))
+        if tracer is not None:
+            tracer.record(STAGE_SCHEDULED, start, tracer.now(),
+                          getLabel(handler)
+                          )
 
     def handleMidiInput(self):
+        """The body of the midi input thread.
 
-        # Get the timeout for the next event.
-        with self.__queueLock:
-            timeout = self.__timeoutForNextEvent()
-
+        This only handles input events, scheduled events are dispatched on
+        the midi output thread so that bursts of input don't delay them.
+        """
         handle = self.seq.getPollHandle()
-        while True:
-            rdx, wrx, erx = select.select(
-                [handle, self.midiInputControl.read], [], [], timeout
-            )
-
-            # Terminate the midi handler if a message was sent to the control
-            # pipe.
-            if self.midiInputControl.read in rdx:
-                action = os.read(self.midiInputControl.read, 1)
-                if action == b'q':
-                    break
-
-            # collect any events that are due to be dispatched.  (we can be a
-            # little sloppy here and check the queue for elements outside of
-            # the lock)
-            if self.__queue:
-                events = []
-                with self.__queueLock:
-                    t = self.getTicks()
-                    while self.__queue and t >= self.__queue[0].time:
-                        events.append(self.__queue.pop(0))
-
-                    timeout = self.__timeoutForNextEvent()
-
-                # Dispatch them.
-                for event in events:
-                    if isinstance(event, VirtualEvent):
-                        event(self)
-                    else:
-                        self.dispatchEvent(self, event)
-
-            while self.seq.hasEvent():
-                event = self.seq.getEvent()
-                if self.__processInputEvent(event) and self.dispatchEvent:
-                    self.dispatchEvent(self, event)
+        wakeup = self.__inputWakeup.fd
+        while not self.__stopping:
+            rdx, wrx, erx = select.select([handle, wakeup], [], [])
+            self.__readMidiInput()
+
+    def __readMidiInput(self):
+        """Dispatch all pending midi input events."""
+        while self.seq.hasEvent():
+            event = self.seq.getEvent()
+            tracer = self.tracer
+            if tracer is not None:
+                self.__traceInputEvent(event, tracer)
+            else:
+                self.__pipeline.dispatchInput(event)
 
     def stop(self):
-        self.comm.close()
-        self.seq.close()
+        # Stop the midi threads before closing the sequencer they use.
         if self.midiInputThread:
-            os.write(self.midiInputControl.write, b'q')
+            self.__stopping = True
+            self.__inputWakeup.signal()
             self.midiInputThread.join()
-        if self.pedal:
+        self.__outputThread.stop()
+        if self.__portWatcher:
+            self.__portWatcher.close()
+        self.comm.close()
+        if self.eventLoop:
+            # Pending requests (including closing the connection) are
+            # processed before the loop stops.
+            self.eventLoop.stop()
+            self.__loopThread.join()
+            self.eventLoop.close()
+        self.seq.close()
+        if self.pedal and not self.eventLoop:
             os.write(self.threadPipeWr, 'end')
             self.pedalThread.join()
 
@@ -599,7 +1124,7 @@ class AWBClient(object):
             channel: [int]
             callback: [callable<int, int>] A callback accepting a channel
                 number and a status bitmask.  Status bits are NONEMPTY,
-                RECORD, STICKY and ACTIVE.
+                RECORD, STICKY (as pushed by the daemon) and ACTIVE.
         """
         self.__subs.setdefault(channel, []).append(callback)
 
@@ -615,7 +1140,6 @@ class AWBClient(object):
         setAttrs.channel = channel
         setAttrs.sticky = sticky
         self.comm.sendRPC(change_channel_attrs = setAttrs)
-        self.__setStatus(channel, sticky = sticky)
 
     def toggleChannelSticky(self, channel):
         """Toggle the channel sticky flag."""
@@ -636,16 +1160,32 @@ class AWBClient(object):
 
     def writeTo(self, out: IO[bytes]):
         """Write the client state to the output stream."""
-        state = AWBClientState(self.voices, self.plugins)
-        pickle.dump(state, out)
+        session.write(
+            session.Session(self.voices, self.plugins, self.registers,
+                            self.loops
+                            ),
+            out
+        )
 
     def readFrom(self, src: IO[bytes]):
-        """Read the client state from the input stream."""
-        state = pickle.load(src)
+        """Read the client state from the input stream.
+
+        Reads both session files and the pickled state written by older
+        versions.  Register and loop events are decoded on first use.
+
+        Raises:
+            PluginStartupError: if some plugins failed to initialize.  The
+                rest of the state is still loaded, the failed plugins are
+                removed from 'plugins'.
+        """
+        state = session.read(src)
         self.voices = state.voices
         self.plugins = state.plugins
-        for plugin in self.plugins:
-            plugin.init(self)
+        self.registers = state.registers
+        self.loops = state.loops
+        report = self.initPlugins(self.plugins)
+        if report.getErrors():
+            raise PluginStartupError(report)
 
     def getPlugins(self) -> List[Plugin]:
         """Returns the list of active, loaded plugins."""
@@ -655,16 +1195,64 @@ class AWBClient(object):
         """Returns a list of the names of all available plugins."""
         # TODO: maybe search sys.path for the first (or all) of the plugins
         # directories?
-        return [file[:-3] for file in os.listdir('plugins')
-                if file.endswith('.py')]
-
-    def loadPlugin(self, name: str):
-        mod = import_module('plugins.' + name)
-        pluginClass = getattr(mod, 'Plugin', None)
-        if pluginClass:
-            plugin = pluginClass()
-            plugin.init(self)
-            self.plugins.append(plugin)
-            return plugin
-        else:
-            raise Exception('No plugin class found in %s' % name)
+        return self.__pluginIndex.getNames()
+
+    def initPlugins(self, plugins: Sequence[Plugin]) -> PluginStartupReport:
+        """Initialize 'plugins' concurrently, in dependency order.
+
+        Plugins that fail don't stop the others, they're removed from the
+        list of active plugins (so they won't be shut down) and their
+        errors are in the returned startup report (also stored in
+        pluginReport).
+        """
+        report = initPlugins(plugins, lambda plugin: plugin.init(self))
+        failed = {id(plugin)
+                  for plugin, timing in zip(plugins, report.timings)
+                  if timing.error
+                  }
+        if failed:
+            self.plugins = [plugin for plugin in self.plugins
+                            if id(plugin) not in failed
+                            ]
+        self.pluginReport = report
+        return report
+
+    def loadPlugins(self, names: Sequence[str]) -> PluginStartupReport:
+        """Import and initialize the named plugins concurrently and add the
+        ones that succeed to the list of active plugins.
+
+        Returns the startup report, which has the errors of the plugins that
+        failed.
+        """
+        plugins, report = loadPlugins(names, lambda plugin: plugin.init(self))
+        self.plugins.extend(plugins)
+        self.pluginReport = report
+        return report
+
+    def loadPlugin(self, name: str) -> Plugin:
+        """Import and initialize a single plugin.
+
+        Raises:
+            Exception: The plugin couldn't be loaded or initialized.
+        """
+        plugins, report = loadPlugins([name],
+                                      lambda plugin: plugin.init(self)
+                                      )
+        self.pluginReport = report
+        if report.timings[0].error:
+            raise report.timings[0].error
+        self.plugins.extend(plugins)
+        return plugins[0]
+
+    def loadPluginAsync(self, name: str) -> 'Future[Plugin]':
+        """Like loadPlugin(), but runs in the background so the caller (e.g.
+        the UI thread) isn't blocked while the plugin starts.
+        """
+        future = Future()
+        def load():
+            try:
+                future.set_result(self.loadPlugin(name))
+            except Exception as ex:
+                future.set_exception(ex)
+        Thread(target=load, name='load-plugin').start()
+        return future
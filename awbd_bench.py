@@ -0,0 +1,73 @@
+"""Benchmark for RPC throughput of a running awbd.
+
+Start the daemon (e.g. "awbd -u /tmp/awbd.sock") and run:
+
+    python3 awbd_bench.py [address]
+
+where address is "unix:<path>" or "<host>[:<port>]" (127.0.0.1:8193 by
+default).  Measures:
+
+- sequential round trips of empty RPCs (just a msg_id, so the daemon only
+  frames, parses and responds),
+- the same pipelined, with up to Comm's maxInFlight calls outstanding,
+- pipelined 1MB frames, to exercise framing of large messages.  These carry
+  a jack_load_state request, which the daemon parses but doesn't process.
+"""
+
+import sys
+from threading import Thread
+import time
+from comm import Comm, parseAddress
+from eventloop import EventLoop
+from mawb_pb2 import LoadStateRequest
+
+CALLS = 20000
+LARGE_CALLS = 200
+LARGE_SIZE = 1024 * 1024
+
+def run(name, count, func, size = 0):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print('%-12s %10.0f RPCs/sec%s' % (
+        name, count / elapsed,
+        ' %8.1f MB/sec' % (count * size / elapsed / (1024 * 1024))
+            if size else ''
+    ))
+
+def main():
+    address = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1:8193'
+    loop = EventLoop()
+    comm = Comm(*parseAddress(address), loop = loop)
+    loopThread = Thread(target = loop.run)
+    loopThread.start()
+
+    def sequential():
+        for i in range(CALLS):
+            comm.call(timeout = 5).result()
+
+    def pipelined():
+        futures = [comm.call(timeout = 5) for i in range(CALLS)]
+        for future in futures:
+            future.result()
+
+    large = LoadStateRequest(filename = 'x' * LARGE_SIZE)
+    def pipelinedLarge():
+        futures = [comm.call(timeout = 30, jack_load_state = large)
+                   for i in range(LARGE_CALLS)
+                   ]
+        for future in futures:
+            future.result()
+
+    try:
+        run('sequential', CALLS, sequential)
+        run('pipelined', CALLS, pipelined)
+        run('1MB frames', LARGE_CALLS, pipelinedLarge, LARGE_SIZE)
+    finally:
+        comm.close()
+        loop.stop()
+        loopThread.join()
+        loop.close()
+
+if __name__ == '__main__':
+    main()
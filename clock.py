@@ -0,0 +1,239 @@
+"""Monotonic integer tick clock and dispatch timing statistics.
+
+TickClock converts between nanoseconds on the monotonic performance counter
+and musical ticks.  All of the math is integer, and tempo changes start a
+new segment anchored at the exact time of the change, so rounding never
+accumulates no matter how long the clock has been running.
+
+DispatchStats collects a histogram of how late scheduled events were
+actually dispatched relative to when they were intended to be.
+"""
+
+from bisect import bisect_right
+from fractions import Fraction
+from threading import Lock
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+import time
+
+NS_PER_SEC = 1000000000
+
+class TempoSegment(NamedTuple):
+    """A span of time with a constant tempo.
+
+    Attrs:
+        startNs: Start time of the segment in nanoseconds since the clock's
+            origin.
+        startTick: Tick at the start of the segment.
+        num, den: Ticks per nanosecond for the segment is num / den.
+    """
+    startNs: int
+    startTick: int
+    num: int
+    den: int
+
+def _checkBPM(bpm: Union[int, float, Fraction]) -> None:
+    if bpm <= 0:
+        raise ValueError('Tempo must be positive, got %r bpm' % bpm)
+
+class TickClock:
+    """A tick clock driven by time.perf_counter_ns().
+
+    Ticks are counted from the clock's origin, which is set when the clock
+    is created and can be moved with start().
+
+    Args:
+        bpm: Beats per minute, can be an int, float or Fraction.
+        ppb: Pulses (ticks) per beat.
+        timer: Function returning the current time in nanoseconds (used for
+            testing).
+    """
+
+    def __init__(self, bpm: Union[int, float, Fraction] = 60, ppb: int = 512,
+                 timer: Callable[[], int] = time.perf_counter_ns
+                 ):
+        _checkBPM(bpm)
+        if ppb <= 0:
+            raise ValueError('ppb must be positive, got %r' % ppb)
+        self.__timer = timer
+        self.__ppb = ppb
+        self.__origin = timer()
+        self.__lock = Lock()
+        self.__bpm = Fraction(bpm)
+
+        # The tempo map: a list of segments and a parallel list of their
+        # start times (for bisection).  This is always replaced as a whole so
+        # readers don't need the lock.
+        self.__tempoMap : Tuple[List[TempoSegment], List[int]] = \
+            ([self.__makeSegment(0, 0)], [0])
+
+    def __makeSegment(self, startNs: int, startTick: int) -> TempoSegment:
+        rate = self.__bpm * self.__ppb / (60 * NS_PER_SEC)
+        return TempoSegment(startNs, startTick, rate.numerator,
+                            rate.denominator
+                            )
+
+    def start(self) -> None:
+        """Reset the origin of the clock (tick zero) to now.
+
+        Tempo history is discarded, the current tempo is retained.
+        """
+        with self.__lock:
+            self.__tempoMap = ([self.__makeSegment(0, 0)], [0])
+            self.__origin = self.__timer()
+
+    @property
+    def origin(self) -> int:
+        """The timer value (perf_counter_ns()) at tick zero."""
+        return self.__origin
+
+    @property
+    def bpm(self) -> Fraction:
+        return self.__bpm
+
+    @property
+    def ppb(self) -> int:
+        return self.__ppb
+
+    def setTempo(self, bpm: Union[int, float, Fraction]) -> None:
+        """Change the tempo as of now.
+
+        Ticks before the change are unaffected and the tick count is
+        continuous across it.  Raises ValueError if 'bpm' isn't positive.
+        """
+        _checkBPM(bpm)
+        with self.__lock:
+            ns = self.nowNs()
+            tick = self.ticksAt(ns)
+            self.__bpm = Fraction(bpm)
+            segments, starts = self.__tempoMap
+            if starts[-1] == ns:
+                segments = segments[:-1]
+                starts = starts[:-1]
+            self.__tempoMap = (segments + [self.__makeSegment(ns, tick)],
+                               starts + [ns]
+                               )
+
+    def nowNs(self) -> int:
+        """Returns nanoseconds since the clock's origin."""
+        return self.__timer() - self.__origin
+
+    def ticksAt(self, ns: int) -> int:
+        """Returns the tick at 'ns' nanoseconds since the origin."""
+        segments, starts = self.__tempoMap
+        seg = segments[max(bisect_right(starts, ns) - 1, 0)]
+        return seg.startTick + (ns - seg.startNs) * seg.num // seg.den
+
+    def getTicks(self) -> int:
+        """Returns the current tick."""
+        return self.ticksAt(self.nowNs())
+
+    def nsForTick(self, tick: int) -> int:
+        """Returns the earliest time (ns since the origin) at which the clock
+        reads 'tick' or later.
+
+        Ticks beyond the last tempo change are extrapolated at the current
+        tempo.
+        """
+        segments = self.__tempoMap[0]
+        i = len(segments) - 1
+        while i > 0 and segments[i].startTick > tick:
+            i -= 1
+        seg = segments[i]
+
+        # Ceiling division so that ticksAt(nsForTick(t)) >= t.
+        return seg.startNs + -(-(tick - seg.startTick) * seg.den // seg.num)
+
+    def secsToNs(self, seconds: float) -> int:
+        """Convert seconds since the origin (for example, a kernel timestamp
+        from a queue started with the clock) to nanoseconds.
+        """
+        return round(seconds * NS_PER_SEC)
+
+class DispatchStats:
+    """Histogram of dispatch error: actual minus intended dispatch time.
+
+    Buckets are powers of two in microseconds: bucket 0 holds errors under
+    1us (including early dispatches), bucket i holds [2^(i-1), 2^i) us and
+    the last bucket holds everything beyond that.
+    """
+
+    BUCKETS = 25
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__buckets = [0] * self.BUCKETS
+            self.__count = 0
+            self.__totalNs = 0
+            self.__maxNs = 0
+
+    def record(self, errorNs: int) -> None:
+        """Record a single dispatch error in nanoseconds."""
+        us = errorNs // 1000
+        bucket = min(us.bit_length(), self.BUCKETS - 1) if us > 0 else 0
+        with self.__lock:
+            self.__buckets[bucket] += 1
+            self.__count += 1
+            self.__totalNs += errorNs
+            if errorNs > self.__maxNs:
+                self.__maxNs = errorNs
+
+    @staticmethod
+    def bucketLimitUs(bucket: int) -> int:
+        """Returns the upper limit of 'bucket' in microseconds."""
+        return 1 << bucket
+
+    def percentileUs(self, fraction: float) -> Optional[int]:
+        """Returns the upper bound (in microseconds) of the bucket containing
+        the given percentile ('fraction' is from 0 to 1), None if there's no
+        data.
+        """
+        with self.__lock:
+            buckets = list(self.__buckets)
+            count = self.__count
+        if not count:
+            return None
+        target = fraction * count
+        total = 0
+        for i, n in enumerate(buckets):
+            total += n
+            if total >= target:
+                return self.bucketLimitUs(i)
+        return self.bucketLimitUs(len(buckets) - 1)
+
+    def getSnapshot(self) -> Dict[str, object]:
+        """Returns the current statistics as a dictionary.
+
+        Keys are:
+            count: number of events dispatched.
+            meanUs, maxUs: mean and maximum error in microseconds.
+            p50Us, p99Us: bucket upper bounds for the 50th and 99th
+                percentiles.
+            histogram: list of (upper bound in us, count) for each
+                bucket.
+        """
+        with self.__lock:
+            buckets = list(self.__buckets)
+            count = self.__count
+            totalNs = self.__totalNs
+            maxNs = self.__maxNs
+        return {
+            'count': count,
+            'meanUs': totalNs / count / 1000 if count else None,
+            'maxUs': maxNs / 1000,
+            'p50Us': self.percentileUs(0.5),
+            'p99Us': self.percentileUs(0.99),
+            'histogram': [(self.bucketLimitUs(i), n)
+                          for i, n in enumerate(buckets)
+                          ],
+        }
+
+    def __str__(self) -> str:
+        snap = self.getSnapshot()
+        if not snap['count']:
+            return 'no events dispatched'
+        return ('%(count)d events, mean %(meanUs).1fus, p50 < %(p50Us)dus, '
+                'p99 < %(p99Us)dus, max %(maxUs).1fus' % snap)
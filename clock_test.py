@@ -0,0 +1,96 @@
+
+from unittest import main, TestCase
+from clock import DispatchStats, TickClock, NS_PER_SEC
+
+class FakeTimer:
+
+    def __init__(self):
+        self.ns = 1000
+
+    def __call__(self):
+        return self.ns
+
+class TickClockTest(TestCase):
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.clock = TickClock(bpm=60, ppb=512, timer=self.timer)
+
+    def testTicks(self):
+        self.assertEqual(self.clock.getTicks(), 0)
+        self.timer.ns += NS_PER_SEC
+        self.assertEqual(self.clock.getTicks(), 512)
+        self.assertEqual(self.clock.nsForTick(512), NS_PER_SEC)
+
+    def testNoDriftOverHours(self):
+        # A float based clock loses precision here, integer math doesn't.
+        hours = 6
+        self.timer.ns += hours * 3600 * NS_PER_SEC
+        self.assertEqual(self.clock.getTicks(), hours * 3600 * 512)
+
+    def testNsForTickRoundsUp(self):
+        # 512 ticks per second doesn't divide a nanosecond evenly.
+        ns = self.clock.nsForTick(1)
+        self.assertEqual(self.clock.ticksAt(ns), 1)
+        self.assertEqual(self.clock.ticksAt(ns - 1), 0)
+
+    def testTempoChange(self):
+        self.timer.ns += NS_PER_SEC
+        self.clock.setTempo(120)
+        self.assertEqual(self.clock.getTicks(), 512)
+        self.timer.ns += NS_PER_SEC
+        self.assertEqual(self.clock.getTicks(), 512 + 1024)
+
+        # Lookups before the change use the old tempo.
+        self.assertEqual(self.clock.ticksAt(NS_PER_SEC // 2), 256)
+        self.assertEqual(self.clock.nsForTick(256), NS_PER_SEC // 2)
+        self.assertEqual(self.clock.nsForTick(1536), 2 * NS_PER_SEC)
+
+    def testFractionalTempo(self):
+        self.clock.setTempo(90.5)
+        self.timer.ns += 60 * NS_PER_SEC
+        self.assertEqual(self.clock.getTicks(), 905 * 512 // 10)
+
+    def testInvalidTempo(self):
+        for bpm in (0, -60):
+            with self.assertRaises(ValueError):
+                self.clock.setTempo(bpm)
+            with self.assertRaises(ValueError):
+                TickClock(bpm=bpm, timer=self.timer)
+        with self.assertRaises(ValueError):
+            TickClock(ppb=0, timer=self.timer)
+
+        # The clock is unaffected.
+        self.timer.ns += NS_PER_SEC
+        self.assertEqual(self.clock.getTicks(), 512)
+
+    def testStart(self):
+        self.timer.ns += NS_PER_SEC
+        self.clock.setTempo(120)
+        self.clock.start()
+        self.assertEqual(self.clock.getTicks(), 0)
+        self.timer.ns += NS_PER_SEC
+        self.assertEqual(self.clock.getTicks(), 1024)
+
+class DispatchStatsTest(TestCase):
+
+    def testHistogram(self):
+        stats = DispatchStats()
+        self.assertIsNone(stats.percentileUs(0.5))
+        for i in range(98):
+            stats.record(500)
+        stats.record(3000)
+        stats.record(-100)
+        snap = stats.getSnapshot()
+        self.assertEqual(snap['count'], 100)
+        self.assertEqual(snap['p50Us'], 1)
+        self.assertEqual(snap['p99Us'], 1)
+        self.assertEqual(stats.percentileUs(1), 4)
+        self.assertEqual(snap['maxUs'], 3)
+        self.assertEqual(dict(snap['histogram'])[4], 1)
+
+        stats.reset()
+        self.assertEqual(stats.getSnapshot()['count'], 0)
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,189 @@
 Contains code for communicating to the MAWB daemon.
 """
 
+import asyncio
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+import heapq
+import itertools
+from multiprocessing.shared_memory import SharedMemory
+import os
+import secrets
+import select
+import socket
 import struct
 import subprocess
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Condition, local, Lock, Thread
 import time
+import traceback
+from typing import Optional
+import zlib
+from google.protobuf.descriptor import FieldDescriptor
 from spug.io.proactor import getProactor, DataHandler, INETAddress
-from mawb_pb2 import PBTrack, SetInitialState, SetInputParams, Response, RPC, \
-    RECORD, IDLE, PLAY
+from mawb_pb2 import EngineState, GetMetricsRequest, GetWaveChunksRequest, \
+    PBTrack, SetInitialState, SetInputParams, Response, RPC, ShmDescriptor, \
+    SubscribeRequest, Wave, WaveChunk, RECORD, IDLE, PLAY
+from ringbuf import ByteRing
 
-class BufferedDataHandler(DataHandler):
+# Every message is preceded by its size.
+_SIZE = struct.Struct('<I')
+
+# Prefix of daemon addresses that are unix domain socket paths (e.g.
+# "unix:/tmp/awbd.sock", see the daemon's -u option).
+UNIX_PREFIX = 'unix:'
+
+# Prefix of the names of shared memory segments passed to the daemon.  The
+# daemon won't open segments with any other names.
+SHM_PREFIX = 'mawb_'
+
+def parseAddress(address):
+    """Returns the (addr, port) for a daemon address string.
+
+    'address' is either "unix:<path>" or "<host>[:<port>]" (the port
+    defaults to 8193).
+    """
+    if address.startswith(UNIX_PREFIX):
+        return address, 0
+    host, sep, port = address.partition(':')
+    return host, int(port) if port else 8193
+
+def _connect(addr, port):
+    """Returns a socket connected to the daemon at 'addr' (a host or a
+    UNIX_PREFIX path) and 'port' (ignored for unix domain sockets).
+    """
+    if addr.startswith(UNIX_PREFIX):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(addr[len(UNIX_PREFIX):])
+        except:
+            sock.close()
+            raise
+    else:
+        sock = socket.create_connection((addr, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+class ResponseHandler:
+    """
+        Parses responses from the daemon and dispatches them to the callbacks
+        registered for their message ids.
+
+        Subclasses add received data to _input and call process().
+    """
+
+    def __init__(self):
+        self._input = ByteRing()
+        self.__messageCallbacks = {}
+        self.__pushCallback = None
+
+        # Set to the error message once the connection is lost (see
+        # _failAll()).
+        self.__closedError = None
+
+    def process(self):
+        """
+            This gets called every time data is added to the input buffer.
+            It consumes all complete RPC messages and dispatches them to the
+            appropriate handlers.
+        """
+        input = self._input
+        while len(input) >= _SIZE.size:
+            view = input.view()
+            size, = _SIZE.unpack_from(view)
+            end = size + _SIZE.size
+            if len(view) < end:
+                return
+
+            # Parse the message in place.
+            resp = Response()
+            resp.ParseFromString(view[_SIZE.size:end])
+            input.consume(end)
+            self.__dispatch(resp)
+
+    def __dispatch(self, resp):
+        """Find the registered callback for a response and call it.
+
+        Every message gets a single response, so the callback is removed.
+        Messages without a message id are pushed by the daemon, these go to
+        the push callback.
+        """
+        if not resp.HasField('msg_id'):
+            callback = self.__pushCallback
+            if not callback:
+                return
+        else:
+            try:
+                callback = self.__messageCallbacks.pop(resp.msg_id)
+            except KeyError:
+                print('Response received with unknown message id %s' %
+                      resp.msg_id)
+                return
+        self.__invoke(callback, resp)
+
+    def __invoke(self, callback, resp):
+        try:
+            callback(resp)
+        except:
+            print('Exception in callback:')
+            traceback.print_exc()
+
+    def _failAll(self, error):
+        """Called by subclasses when the connection is lost.
+
+        Every registered message callback (and any registered afterwards) is
+        called with an error response, since no more responses will arrive.
+
+        parms:
+            error: [str] The error message.
+        """
+        # Set this before taking the callbacks, see
+        # registerMessageCallback().
+        self.__closedError = error
+        callbacks = self.__messageCallbacks
+        self.__messageCallbacks = {}
+        for msgId, callback in callbacks.items():
+            self.__invoke(callback, Response(msg_id = msgId, error = error))
+
+    def registerMessageCallback(self, msgId, callback):
+        """
+            Registers the function to be called when the response to the
+            message with the specified id is received.
+
+            parms:
+                msgId: [int] xxx
+
+        """
+        self.__messageCallbacks[msgId] = callback
+
+        # If the connection was lost, the callback may have missed
+        # _failAll().  Only call it if it's still registered, otherwise
+        # _failAll() got it.
+        error = self.__closedError
+        if error is not None and \
+                self.__messageCallbacks.pop(msgId, None) is callback:
+            self.__invoke(callback, Response(msg_id = msgId, error = error))
+
+    def unregisterMessageCallback(self, msgId):
+        """
+            Remove the callback for a message id (if it's still registered).
+
+            parms:
+                msgId: [int]
+        """
+        self.__messageCallbacks.pop(msgId, None)
+
+    def setPushCallback(self, callback):
+        """
+            Sets the function to be called with messages pushed by the
+            daemon (responses without a message id).
+
+            parms:
+                callback: [callable<Response> or None]
+        """
+        self.__pushCallback = callback
+
+class BufferedDataHandler(DataHandler, ResponseHandler):
     """
         The proactor data handler that manages our connection to the daemon.
 
@@ -19,14 +194,13 @@ class BufferedDataHandler(DataHandler):
     """
 
     def __init__(self):
-        self.__outputBuffer = b''
-        self._inputBuffer = b''
+        ResponseHandler.__init__(self)
+        self.__output = ByteRing()
         self.closeFlag = False
         self.control = getProactor().makeControlQueue(self.__onControlEvent)
-        self.__messageCallbacks = {}
 
     def readyToGet(self):
-        return self.__outputBuffer
+        return bool(self.__output)
 
     def readyToPut(self):
         return True
@@ -35,46 +209,15 @@ class BufferedDataHandler(DataHandler):
         return self.closeFlag
 
     def peek(self, size):
-        return self.__outputBuffer[:size]
+        return self.__output.view()[:size]
 
     def get(self, size):
-        self.__outputBuffer = self.__outputBuffer[size:]
+        self.__output.consume(size)
 
     def put(self, data):
-        self._inputBuffer += data
+        self._input.write(data)
         self.process()
 
-    def process(self):
-        """
-            This gets called every time data is added to the input buffer.
-            It consumes a complete RPC message if there is one and dispatches
-            it to the appropriate handler.
-        """
-        # Return if we don't have a complete message in the buffer.
-        if len(self._inputBuffer) < 4:
-            return
-        size, = struct.unpack('<I', self._inputBuffer[:4])
-        if len(self._inputBuffer) < size + 4:
-            return
-
-        # Now parse the message.
-        serializedMessage = self._inputBuffer[4:size + 4]
-        self._inputBuffer = self._inputBuffer[size + 4:]
-        resp = Response()
-        resp.ParseFromString(serializedMessage)
-
-        # Find the registered callback and call it.
-        try:
-            callback = self.__messageCallbacks[resp.msg_id]
-        except KeyError:
-            print('Response received with unknown message id %s' % resp.msg_id)
-            return
-        try:
-            callback(resp)
-        except:
-            print('Exception in callback:')
-            traceback.print_exc()
-
     def __onControlEvent(self, event):
         """
             Handler for events coming in on the control queue.
@@ -83,7 +226,7 @@ class BufferedDataHandler(DataHandler):
                 event: [str]  Currently this is just data to be added to the
                     out-buffer.
         """
-        self.__outputBuffer += event
+        self.__output.write(event)
 
     # External interface.
 
@@ -96,41 +239,398 @@ class BufferedDataHandler(DataHandler):
         """
         self.control.add(data)
 
-    def registerMessageCallback(self, msgId, callback):
+    def close(self):
+        """Close the connection."""
+        self.control.close()
+        self.control.add(b'')
+        self.closeFlag = True
+
+class LoopConnection(ResponseHandler):
+    """
+        A connection to the daemon serviced by an eventloop.EventLoop instead
+        of the proactor thread.
+
+        Responses are dispatched to their callbacks on the loop thread.
+        queueForOutput() and close() may be called from any thread.
+    """
+
+    def __init__(self, loop: 'EventLoop', addr: str, port: int):
+        ResponseHandler.__init__(self)
+        self.__loop = loop
+        self.__sock : Optional[socket.socket] = _connect(addr, port)
+        self.__sock.setblocking(False)
+        self.__fd = self.__sock.fileno()
+        self.__output = ByteRing()
+        loop.addReader(self.__fd, self.__onReadable)
+
+    def __onReadable(self):
+        # Receive directly into the input buffer.
+        try:
+            size = self.__sock.recv_into(self._input.reserve(65536))
+        except BlockingIOError:
+            return
+        except OSError as ex:
+            print('Error reading from daemon: %s' % ex)
+            self.__close('Connection to daemon lost: %s' % ex)
+            return
+        if not size:
+            self.__close('Connection closed by daemon')
+            return
+        self._input.commit(size)
+        self.process()
+
+    def __send(self):
+        if self.__sock is None:
+            return
+        try:
+            sent = self.__sock.send(self.__output.view())
+        except BlockingIOError:
+            sent = 0
+        except OSError as ex:
+            # Typically EPIPE or ECONNRESET, the daemon has gone away.
+            print('Error writing to daemon: %s' % ex)
+            self.__close('Connection to daemon lost: %s' % ex)
+            return
+        self.__output.consume(sent)
+        if self.__output:
+            self.__loop.addWriter(self.__fd, self.__send)
+        else:
+            self.__loop.removeWriter(self.__fd)
+
+    def __write(self, data):
+        if self.__sock is None:
+            return
+        pending = bool(self.__output)
+        self.__output.write(data)
+
+        # If there was already pending output, we're waiting for the socket
+        # to become writable.
+        if not pending:
+            self.__send()
+
+    def __close(self, error = 'Connection closed'):
+        """Close the socket and fail all calls awaiting a response."""
+        if self.__sock is not None:
+            self.__loop.removeReader(self.__fd)
+            self.__loop.removeWriter(self.__fd)
+            self.__sock.close()
+            self.__sock = None
+            self.__output = ByteRing()
+            self._failAll(error)
+
+    # External interface.
+
+    def queueForOutput(self, data):
         """
-            Registers the function to be called when the response to the
-            message with the specified id is received.
+            Queues a piece of data to be sent over the connection.
 
             parms:
-                msgId: [int] xxx
-
+                data: [bytes]
         """
-        self.__messageCallbacks[msgId] = callback
+        self.__loop.callSoon(self.__write, data)
 
     def close(self):
         """Close the connection."""
-        self.control.close()
-        self.control.add(b'')
-        self.closeFlag = True
+        self.__loop.callSoon(self.__close)
+
+class RPCError(Exception):
+    """Raised from an RPC future when the daemon returns an error."""
+
+class _TimeoutWatcher:
+    """Fails RPC futures that haven't completed by their deadlines.
+
+    A single thread (started on demand) waits for the earliest deadline.
+    """
+
+    def __init__(self):
+        self.__cond = Condition()
+        self.__deadlines = []
+        self.__seq = itertools.count()
+        self.__thread = None
+
+    def add(self, timeout, future):
+        with self.__cond:
+            deadlines = self.__deadlines
+            heapq.heappush(deadlines,
+                           (time.monotonic() + timeout, next(self.__seq),
+                            future
+                            )
+                           )
+            if not self.__thread:
+                self.__thread = Thread(target = self.__run,
+                                       name = 'rpc-timeout',
+                                       daemon = True
+                                       )
+                self.__thread.start()
+
+            # The thread only needs to recompute its wait if this is the new
+            # earliest deadline.
+            if deadlines[0][2] is future:
+                self.__cond.notify()
+
+    def __run(self):
+        while True:
+            expired = []
+            with self.__cond:
+                deadlines = self.__deadlines
+                now = time.monotonic()
+                while deadlines and deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(deadlines)[2])
+                if not expired:
+                    self.__cond.wait(deadlines[0][0] - now if deadlines
+                                     else None
+                                     )
+
+            # Complete the futures outside of the lock, their done callbacks
+            # are run synchronously.
+            for future in expired:
+                if not future.done():
+                    try:
+                        future.set_exception(TimeoutError('RPC timed out'))
+                    except InvalidStateError:
+                        # Completed or cancelled since we checked.
+                        pass
+
+def _setField(rpc, name, value):
+    """Set the RPC field 'name' to 'value', whatever kind of field it is."""
+    field = rpc.DESCRIPTOR.fields_by_name[name]
+    if field.label == FieldDescriptor.LABEL_REPEATED:
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        if field.type == FieldDescriptor.TYPE_MESSAGE:
+            for elem in value:
+                getattr(rpc, name).add().CopyFrom(elem)
+        else:
+            getattr(rpc, name).extend(value)
+    elif field.type == FieldDescriptor.TYPE_MESSAGE:
+        getattr(rpc, name).CopyFrom(value)
+    else:
+        setattr(rpc, name, value)
+
+# The order in which the daemon processes the fields of an RPC (see
+# ConnectionHandler::processMessage() in awb.cc).  This must be kept in sync
+# with the daemon: it's what lets us merge RPCs without changing the order
+# in which their requests are processed.
+_PROCESSING_ORDER = [
+    'shm_payload',
+    'echo',
+    'set_ticks',
+    'set_initial_state',
+    'set_input_params',
+    'save_state',
+    'load_state',
+    'add_track',
+    'change_sequencer_state',
+    'change_jack_state',
+    'clear_state',
+    'shutdown',
+    'change_section',
+    'new_section',
+    'change_channel_attrs',
+    'put_wave_chunks',
+    'get_wave_chunks',
+    'subscribe',
+    'get_metrics',
+
+    # Not currently processed by the daemon.
+    'jack_save_state',
+    'jack_load_state',
+]
+_RANK = {name: rank for rank, name in enumerate(_PROCESSING_ORDER)}
+
+class _Batch:
+    """RPCs merged into a single RPC."""
+
+    def __init__(self):
+        self.rpc = RPC()
+
+        # Rank of the last field that the daemon will process.
+        self.rank = -1
+        self.count = 0
+
+    def merge(self, rpc):
+        """Merge 'rpc' into the batch if that won't change the order in
+        which its requests are processed.  Returns False if it can't be
+        merged.
+
+        An RPC can be merged if all of its fields are processed after all
+        of the fields already in the batch (or are appended to the last one,
+        if it's repeated).  RPCs with a msg_id are never merged with other
+        RPCs: the daemon sends a single response for the whole batch, so a
+        caller waiting for a response would get the errors of its
+        neighbours.
+        """
+        if not self.count:
+            self.rpc.CopyFrom(rpc)
+            self.rank = max((_RANK[field.name] for field, val in
+                             rpc.ListFields() if field.name != 'msg_id'),
+                            default = -1
+                            )
+            self.count = 1
+            return True
+
+        if rpc.HasField('msg_id') or self.rpc.HasField('msg_id'):
+            return False
+        fields = [field for field, val in rpc.ListFields()
+                  if field.name != 'msg_id'
+                  ]
+        if fields:
+            first = min(fields, key = lambda field: _RANK[field.name])
+            rank = _RANK[first.name]
+            if rank < self.rank or (
+                rank == self.rank and
+                first.label != FieldDescriptor.LABEL_REPEATED
+            ):
+                return False
+            self.rank = max(_RANK[field.name] for field in fields)
+        self.rpc.MergeFrom(rpc)
+        self.count += 1
+        return True
 
 class Comm:
-    """The communicator.  Sends RPCs to the daemon."""
+    """The communicator.  Sends RPCs to the daemon.
+
+    There are two ways to send an RPC: sendRPC() sends it and optionally
+    calls a callback with the response, call() and callAsync() return a
+    future for the response.  Responses are received on the proactor (or
+    event loop) thread, so that's where callbacks and future done callbacks
+    run.
+
+    RPCs can be merged into a single RPC frame, saving syscalls and parsing
+    in the daemon.  RPCs sent inside a "with comm.batch():" block are
+    merged and sent when the block exits.  If 'autoBatch' is true (event
+    loop mode only), all RPCs sent before the next iteration of the event
+    loop are merged.  RPCs are only merged when that doesn't change the
+    order the daemon processes them in (see _Batch.merge()), otherwise the
+    batch is sent and a new one started.
+
+    Large RPCs (e.g. track uploads) can be sent with callShared(), which
+    passes them to the daemon through shared memory.
 
-    def __init__(self, addr = '127.0.0.1', port = 8193):
-        self.handler = BufferedDataHandler()
-        self.conn = getProactor().makeConnection(
-            INETAddress(addr, port),
-            self.handler
-        )
-        self.__nextMsgId = 0
+    subscribe() has the daemon push the engine state as it changes (see
+    EngineStateMirror).
+
+    Everything sent can be captured by setting 'recorder' to an
+    rpcreplay.RPCRecorder.
+
+    parms:
+        addr: [str] Daemon address.  This is either a host or a unix domain
+            socket path prefixed with UNIX_PREFIX.
+        port: [int] Daemon port (not used for unix domain sockets).
+        loop: [EventLoop or None] If provided, the connection is serviced by
+            this event loop.  Otherwise it is serviced by the proactor, which
+            only supports TCP.
+        maxInFlight: [int] Maximum number of call()s awaiting a response.
+            Once this many are outstanding, call() blocks until one
+            completes.
+        autoBatch: [bool] Merge RPCs sent during each event loop iteration.
+    """
+
+    def __init__(self, addr = '127.0.0.1', port = 8193, loop = None,
+                 maxInFlight = 64, autoBatch = False):
+        if loop:
+            self.handler = LoopConnection(loop, addr, port)
+            self.conn = None
+        elif addr.startswith(UNIX_PREFIX):
+            raise ValueError('Unix domain sockets require an event loop')
+        else:
+            self.handler = BufferedDataHandler()
+            self.conn = getProactor().makeConnection(
+                INETAddress(addr, port),
+                self.handler
+            )
+        # next() on a count is atomic, so any thread can get message ids.
+        self.__msgIds = itertools.count()
+        self.__inFlight = BoundedSemaphore(maxInFlight)
+        self.__timeouts = _TimeoutWatcher()
+
+        # Explicit batches are per-thread (see batch()).
+        self.__local = local()
+
+        # The automatic batch, flushed by the event loop.
+        self.__loop = loop if autoBatch else None
+        self.__autoBatch = _Batch()
+        self.__autoBatchLock = Lock()
+
+        # If set, every RPC we send is passed to its record() method.
+        self.recorder = None
 
     def close(self):
         self.handler.close()
 
     def __getMsgId(self):
-        msgId = self.__nextMsgId
-        self.__nextMsgId += 1
-        return msgId
+        # msg_id is an int32.
+        return next(self.__msgIds) & 0x7FFFFFFF
+
+    def __write(self, rpc):
+        if self.recorder:
+            self.recorder.record(rpc)
+        parcel = rpc.SerializeToString()
+        self.handler.queueForOutput(_SIZE.pack(len(parcel)) + parcel)
+
+    def __flushAutoBatch(self):
+        with self.__autoBatchLock:
+            batch = self.__autoBatch
+            if batch.count:
+                self.__write(batch.rpc)
+                self.__autoBatch = _Batch()
+
+    def __submit(self, rpc):
+        """Send an RPC, through the automatic batch if there is one."""
+        if not self.__loop:
+            self.__write(rpc)
+            return
+        with self.__autoBatchLock:
+            batch = self.__autoBatch
+            if batch.merge(rpc):
+                if batch.count == 1:
+                    self.__loop.callSoon(self.__flushAutoBatch)
+                return
+
+            # Send what we have and start a new batch, the flush that's
+            # already scheduled will send it.
+            self.__write(batch.rpc)
+            self.__autoBatch = _Batch()
+            self.__autoBatch.merge(rpc)
+
+    def __send(self, rpc):
+        batch = getattr(self.__local, 'batch', None)
+        if batch is None:
+            self.__submit(rpc)
+        elif not batch.merge(rpc):
+            self.__submit(batch.rpc)
+            batch = self.__local.batch = _Batch()
+            batch.merge(rpc)
+
+    def __flushBatch(self):
+        """Send the RPCs merged so far in this thread's explicit batch."""
+        batch = getattr(self.__local, 'batch', None)
+        if batch is not None and batch.count:
+            self.__submit(batch.rpc)
+            self.__local.batch = _Batch()
+
+    @contextmanager
+    def batch(self):
+        """Context manager that merges the RPCs sent from this thread inside
+        the block.  They're sent when the outermost block exits.
+
+        Responses (and call() futures) don't complete until the batch is
+        sent, so don't wait on them inside the block.  If call() has to wait
+        for an in-flight slot inside the block, the RPCs merged so far are
+        sent first so that the calls holding the slots can complete.
+        """
+        if getattr(self.__local, 'batch', None) is not None:
+            # Nested, the outer block sends.
+            yield
+            return
+        self.__local.batch = _Batch()
+        try:
+            yield
+        finally:
+            batch = self.__local.batch
+            self.__local.batch = None
+            if batch.count:
+                self.__submit(batch.rpc)
 
     def sendRPC(self, **kwargs):
         rpc = RPC()
@@ -141,29 +641,432 @@ class Comm:
             del kwargs['callback']
 
         for attr, val in kwargs.items():
-            getattr(rpc, attr).CopyFrom(val)
+            _setField(rpc, attr, val)
 
-        parcel = rpc.SerializeToString()
-        data = struct.pack('<I', len(parcel)) + parcel
-        self.handler.queueForOutput(data)
+        self.__send(rpc)
+
+    def call(self, timeout = None, **fields):
+        """Send an RPC and return a future for the response.
+
+        The future's result is the Response message.  It fails with
+        RPCError if the response has an error, or with TimeoutError if there
+        is no response within 'timeout' seconds.  Cancelling the future
+        stops waiting for the response (the RPC is still processed by the
+        daemon).
+
+        Blocks while there are 'maxInFlight' calls awaiting a response, so
+        don't call this from the thread that receives responses.
+
+        parms:
+            timeout: [float or None] Seconds to wait for a response.
+            **fields: RPC fields to send.
+        """
+        if not self.__inFlight.acquire(blocking = False):
+            # The calls holding the slots may be waiting in our batch.
+            self.__flushBatch()
+            if not self.__inFlight.acquire(timeout = timeout):
+                raise TimeoutError('Too many RPCs in flight')
+
+        rpc = RPC()
+        try:
+            for attr, val in fields.items():
+                _setField(rpc, attr, val)
+        except:
+            self.__inFlight.release()
+            raise
+        rpc.msg_id = msgId = self.__getMsgId()
+        future = Future()
+
+        def onResponse(resp):
+            try:
+                if resp.HasField('error'):
+                    future.set_exception(RPCError(resp.error))
+                else:
+                    future.set_result(resp)
+            except InvalidStateError:
+                # Cancelled or timed out.
+                pass
+
+        def onDone(future):
+            # However the future completed, make sure we're not still waiting
+            # for a response and free its in-flight slot.
+            self.handler.unregisterMessageCallback(msgId)
+            self.__inFlight.release()
+
+        future.add_done_callback(onDone)
+        self.handler.registerMessageCallback(msgId, onResponse)
+        if timeout is not None:
+            self.__timeouts.add(timeout, future)
+        self.__send(rpc)
+        return future
+
+    def callShared(self, timeout = None, **fields):
+        """Like call(), but the RPC is passed to the daemon through a shared
+        memory segment.  Only the segment's descriptor goes through the
+        socket, which is much cheaper for large payloads.
+
+        The segment is created for the call and removed when the future
+        completes, so the daemon must be on the same machine.
+        """
+        rpc = RPC()
+        for attr, val in fields.items():
+            _setField(rpc, attr, val)
+        data = rpc.SerializeToString()
+
+        while True:
+            try:
+                shm = SharedMemory(SHM_PREFIX + secrets.token_hex(8),
+                                   create = True,
+                                   size = max(len(data), 1)
+                                   )
+                break
+            except FileExistsError:
+                pass
+        try:
+            shm.buf[:len(data)] = data
+            desc = ShmDescriptor()
+            desc.name = '/' + shm.name
+            desc.offset = 0
+            desc.size = len(data)
+            future = self.call(timeout, shm_payload = desc)
+        except:
+            shm.close()
+            shm.unlink()
+            raise
+
+        def release(future):
+            shm.close()
+            shm.unlink()
+        future.add_done_callback(release)
+        return future
+
+    def getWaveInfo(self, section, channel, timeout = None):
+        """Returns the attributes of a channel's wave (a Wave message without
+        data) and the size of its data in bytes.
+        """
+        resp = self.call(timeout,
+                         get_wave_chunks = GetWaveChunksRequest(
+                             section = section,
+                             channel = channel
+                         )
+                         ).result()
+        return resp.wave_chunk.wave, resp.wave_chunk.total_size
+
+    def iterWaveChunks(self, section, channel, chunkSize = 1 << 20,
+                       window = 4,
+                       timeout = None
+                       ):
+        """Generator that downloads a channel's wave data (see Wave.data),
+        yielding it as memoryviews of up to 'chunkSize' bytes.
+
+        Only 'window' chunks are requested at a time, so the data is never
+        held in memory all at once.  Once all of the data has been received
+        its checksum is verified, RPCError is raised if it doesn't match.
+        Don't download the same wave from multiple threads over the same
+        Comm, the daemon only computes the checksum for chunks that it sends
+        in order.
+
+        parms:
+            section: [int] Section index.
+            channel: [int] Channel index.
+            chunkSize: [int] Bytes per chunk (this should be even).
+            window: [int] Maximum number of chunk requests in flight.
+            timeout: [float or None] Seconds to wait for each chunk.
+        """
+        def request(offset):
+            return self.call(timeout,
+                             get_wave_chunks = GetWaveChunksRequest(
+                                 section = section,
+                                 channel = channel,
+                                 offset = offset,
+                                 length = chunkSize
+                             )
+                             )
+
+        # We don't know the size until the first chunk arrives.
+        futures = deque([request(0)])
+        offset = chunkSize
+        adler = zlib.adler32(b'')
+        try:
+            while futures:
+                chunk = futures.popleft().result().wave_chunk
+                size = chunk.total_size
+
+                # Request more before handing this chunk to the caller.
+                while len(futures) < window and offset < size:
+                    futures.append(request(offset))
+                    offset += chunkSize
+
+                data = chunk.data
+                adler = zlib.adler32(data, adler)
+                if chunk.offset + len(data) >= size:
+                    if not chunk.HasField('adler32'):
+                        raise RPCError('No checksum received for wave data')
+                    if chunk.adler32 != adler:
+                        raise RPCError('Wave data checksum mismatch')
+                if data:
+                    yield memoryview(data)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def putWaveChunks(self, section, channel, wave, chunks, window = 4,
+                      timeout = None
+                      ):
+        """Upload a channel's wave in chunks.
+
+        Replaces the wave for the channel.  'section' may be one past the
+        last section, in which case a new section is created.  Raises
+        RPCError if the daemon rejects any of the chunks.
+
+        parms:
+            section: [int] Section index.
+            channel: [int] Channel index.
+            wave: [Wave] The wave's attributes, its data is ignored.
+            chunks: [iterable<bytes-like>] The wave data (see Wave.data),
+                in order.  Chunks should have an even number of bytes.
+            window: [int] Maximum number of chunks in flight.
+            timeout: [float or None] Seconds to wait for each chunk to be
+                acknowledged.
+        """
+        info = Wave()
+        info.CopyFrom(wave)
+        info.ClearField('data')
+
+        futures = deque()
+        def send(**fields):
+            if len(futures) >= window:
+                futures.popleft().result()
+            futures.append(self.call(timeout,
+                                     put_wave_chunks = WaveChunk(
+                                         section = section,
+                                         channel = channel,
+                                         **fields
+                                     )
+                                     ))
+
+        offset = 0
+        adler = zlib.adler32(b'')
+        try:
+            # The first chunk carries the attributes (even if there's no
+            # data).
+            send(offset = 0, wave = info)
+            for data in chunks:
+                if not isinstance(data, bytes):
+                    data = bytes(data)
+                send(offset = offset, data = data)
+                offset += len(data)
+                adler = zlib.adler32(data, adler)
+            send(offset = offset, last = True, total_size = offset,
+                 adler32 = adler
+                 )
+            while futures:
+                futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def subscribe(self, callback, interval = 50):
+        """Subscribe to the daemon's engine state.
+
+        'callback' is called with the complete EngineState when the daemon
+        responds, then with an EngineState containing just the fields that
+        changed whenever anything changes (but no more often than every
+        'interval' milliseconds).  It's called on the thread that receives
+        responses, in the order the daemon sent them.  Subscribing again
+        replaces the callback and the interval.
+
+        parms:
+            callback: [callable<EngineState>]
+            interval: [int] Minimum milliseconds between pushes.
+        """
+        def onMessage(resp):
+            callback(resp.state)
+        self.handler.setPushCallback(onMessage)
+        self.sendRPC(subscribe = SubscribeRequest(interval = interval),
+                     callback = onMessage
+                     )
+
+    def unsubscribe(self):
+        """Stop receiving engine state pushes."""
+        self.sendRPC(subscribe = SubscribeRequest(interval = 0))
+        self.handler.setPushCallback(None)
+
+    def getMetrics(self, timeout = None):
+        """Returns the daemon's metrics (a Metrics message): jack cycle
+        times, xruns, allocations in the audio thread, memory used by the
+        waves in each section and channel, RPC queue depths and reactor
+        loop latency.
+        """
+        return self.call(timeout,
+                         get_metrics = GetMetricsRequest()
+                         ).result().metrics
+
+    async def callAsync(self, timeout = None, **fields):
+        """Like call(), but returns the response to an awaiting coroutine.
+
+        Cancelling the awaiting task cancels the call.
+        """
+        return await asyncio.wrap_future(self.call(timeout, **fields))
+
+class EngineStateMirror:
+    """A copy of the daemon's engine state, kept up to date by a
+    subscription.  Pass update() to Comm.subscribe().
+
+    'state' is the complete EngineState.  It's replaced rather than modified
+    by updates, so other threads can read it without locking.
+    """
+
+    def __init__(self):
+        self.state = EngineState()
+        self.__listeners = []
+
+    def addListener(self, listener):
+        """Adds a function to be called after every update.
+
+        parms:
+            listener: [callable<EngineState, EngineState>] Called with the
+                new state and the fields that changed, on the thread that
+                receives responses.
+        """
+        self.__listeners.append(listener)
+
+    def update(self, delta):
+        """Merge the fields present in 'delta' into the state.
+
+        parms:
+            delta: [EngineState]
+        """
+        state = EngineState()
+        state.CopyFrom(self.state)
+        state.MergeFrom(delta)
+        self.state = state
+        for listener in self.__listeners:
+            listener(state, delta)
+
+    def getChannelStatus(self, channel):
+        """Returns the status bits of a channel in the current section (see
+        EngineState.channel_status).
+        """
+        if channel >= 8:
+            return 0
+        return self.state.channel_status >> (channel * 4) & 0xF
+
+class DaemonStartError(Exception):
+    """Raised when the daemon exits or times out before it's ready."""
+
+# The line the daemon writes to its ready fd (see the -r option) once it's
+# accepting connections.
+READY_LINE = b'READY=1\n'
+
+def launchDaemon(awbdCmd, timeout = 10):
+    """Start the daemon and wait until it's accepting connections.
+
+    The daemon is passed the write end of a pipe with its -r option, and
+    writes READY_LINE to it once its listeners are set up.  So this takes
+    as long as the daemon actually needs to start.
+
+    Returns the daemon's subprocess.Popen object.
+
+    parms:
+        awbdCmd: [list<str>] The daemon command line.  The -r option is
+            appended to it, so it can also be a debugger command like
+            ['gdb', '--args', './awbd'].
+        timeout: [float or None] Seconds to wait for the daemon, None to wait
+            forever (e.g. when it's being started from a debugger).
+
+    Raises DaemonStartError if the daemon exits or doesn't become ready in
+    time (in which case it is killed).
+    """
+    readFd, writeFd = os.pipe()
+    try:
+        daemon = subprocess.Popen(awbdCmd + ['-r', str(writeFd)],
+                                  pass_fds = (writeFd,)
+                                  )
+    except:
+        os.close(readFd)
+        raise
+    finally:
+        os.close(writeFd)
+
+    def fail(message):
+        daemon.kill()
+        daemon.wait()
+        raise DaemonStartError(message)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    data = b''
+    try:
+        while not data.endswith(b'\n'):
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0 or not select.select([readFd], [], [], wait)[0]:
+                    fail('Daemon not ready after %ss' % timeout)
+            chunk = os.read(readFd, 64)
+            if not chunk:
+                # The daemon closed the pipe without saying it's ready, it
+                # has most likely exited.
+                fail('Daemon exited during startup')
+            data += chunk
+    finally:
+        os.close(readFd)
+
+    if data != READY_LINE:
+        fail('Unexpected readiness message %r' % data)
+    return daemon
+
+def connectWithBackoff(addr = '127.0.0.1', port = 8193, timeout = 10,
+                       initialDelay = 0.01, maxDelay = 0.5
+                       ):
+    """Connect to the daemon, retrying with exponential backoff.
+
+    Returns the connected socket.
+
+    parms:
+        addr: [str] Daemon address (a host or a UNIX_PREFIX path).
+        port: [int] Daemon port.
+        timeout: [float] Seconds to keep trying before raising TimeoutError.
+        initialDelay: [float] Seconds to wait after the first failure, this
+            doubles after every failure up to 'maxDelay'.
+        maxDelay: [float] Maximum seconds between attempts.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initialDelay
+    while True:
+        try:
+            return _connect(addr, port)
+        except (ConnectionRefusedError, FileNotFoundError) as ex:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('Unable to connect to the daemon: %s' % ex)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, maxDelay)
 
 class DaemonManager:
-    """Lets you control the daemon."""
+    """Lets you control the daemon.
 
-    def __init__(self, awbdCmd = ['./awbd']):
+    parms:
+        awbdCmd: [list<str>] The daemon command line.
+        timeout: [float or None] Seconds to wait for the daemon to start (see
+            launchDaemon()).
+    """
+
+    def __init__(self, awbdCmd = ['./awbd'], timeout = 10):
         self.daemon = None
         self.awbdCmd = awbdCmd
+        self.timeout = timeout
         self.proxy = None
 
     def start(self):
         if self.daemon:
             print('Daemon already started.')
             return
-        self.daemon = subprocess.Popen(self.awbdCmd)
-        self.proxy = Comm()
+        self.daemon = launchDaemon(self.awbdCmd, self.timeout)
 
-        # TODO: repeatedly attempt to connect until we can get an "echo" back.
-        time.sleep(2)
+        # The daemon says it's listening, but make sure we can really
+        # connect before handing the connection to the proactor.
+        connectWithBackoff(timeout = self.timeout or 10).close()
+        self.proxy = Comm()
 
     def stop(self):
         if self.daemon:
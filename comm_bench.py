@@ -0,0 +1,87 @@
+"""Benchmark for response parsing in comm.
+
+Feeds a stream of small framed Response messages to a ResponseHandler in
+4KB reads (as they would arrive from the daemon) and measures responses
+per second.  For comparison, "bytes" is the previous implementation, which
+concatenated bytes objects and parsed at most one message per read (so it
+falls behind and has to be drained after the last read).
+"""
+
+import struct
+import time
+from comm import ResponseHandler
+from mawb_pb2 import Response
+
+RESPONSES = 50000
+READ_SIZE = 4096
+
+def makeStream():
+    parts = []
+    for i in range(RESPONSES):
+        resp = Response()
+        resp.msg_id = i
+        data = resp.SerializeToString()
+        parts.append(struct.pack('<I', len(data)) + data)
+    return b''.join(parts)
+
+class Counter(ResponseHandler):
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        for i in range(RESPONSES):
+            self.registerMessageCallback(i, self.onResponse)
+
+    def onResponse(self, resp):
+        self.count += 1
+
+    def put(self, data):
+        self._input.write(data)
+        self.process()
+
+class BytesCounter:
+    """The previous bytes based parser."""
+
+    def __init__(self):
+        self._inputBuffer = b''
+        self.count = 0
+
+    def put(self, data):
+        self._inputBuffer += data
+        self.process()
+
+    def process(self):
+        if len(self._inputBuffer) < 4:
+            return False
+        size, = struct.unpack('<I', self._inputBuffer[:4])
+        if len(self._inputBuffer) < size + 4:
+            return False
+        serializedMessage = self._inputBuffer[4:size + 4]
+        self._inputBuffer = self._inputBuffer[size + 4:]
+        resp = Response()
+        resp.ParseFromString(serializedMessage)
+        self.count += 1
+        return True
+
+def run(name, handler, stream, drain=None):
+    start = time.perf_counter()
+    for i in range(0, len(stream), READ_SIZE):
+        handler.put(stream[i:i + READ_SIZE])
+    received = handler.count
+    if drain:
+        while drain():
+            pass
+    elapsed = time.perf_counter() - start
+    assert handler.count == RESPONSES
+    print('%-10s %10.0f responses/sec (%d of %d parsed on arrival)' %
+          (name, RESPONSES / elapsed, received, RESPONSES)
+          )
+
+def main():
+    stream = makeStream()
+    bytesCounter = BytesCounter()
+    run('bytes', bytesCounter, stream, bytesCounter.process)
+    run('ring', Counter(), stream)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,605 @@
+
+import asyncio
+from concurrent.futures import CancelledError
+import os
+import socket
+import struct
+import sys
+import tempfile
+from threading import Event as ThreadEvent, Thread, Timer
+import time
+from unittest import main, TestCase
+import zlib
+from comm import Comm, connectWithBackoff, DaemonStartError, \
+    EngineStateMirror, launchDaemon, RPCError, SHM_PREFIX, UNIX_PREFIX
+from eventloop import EventLoop
+from mawb_pb2 import ChangeChannelAttrs, ChangeSectionRequest, EngineState, \
+    Metrics, Response, RPC, SetInitialState, Wave, WaveChunk
+
+class FakeDaemon:
+    """Answers RPCs with 'echo' fields.  An RPC echoing 'error' gets an
+    error response, an echo of 'ignore' gets no response and an echo of 'reset'
+    resets the connection.
+
+    Listens on a unix domain socket if 'path' is given, otherwise on a
+    loopback TCP port.  RPCs passed through shared memory are recorded with
+    the contents of the segment in place of the descriptor.
+
+    Wave chunks are stored in 'waves' (keyed by section and channel), as
+    awbd would.  If 'corrupt' is set, the data in get_wave_chunks responses
+    is altered.
+
+    A subscribe request is answered with 'state', followed by a push of each
+    of the deltas in 'pushes'.  These are also pushed after the response to
+    an echo of 'push'.
+
+    get_metrics requests are answered with 'metrics'.
+    """
+
+    def __init__(self, path=None):
+        if path:
+            self.listener = socket.socket(socket.AF_UNIX)
+            self.listener.bind(path)
+        else:
+            self.listener = socket.socket()
+            self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.rpcs = []
+        self.segments = []
+        self.waves = {}
+        self.corrupt = False
+        self.state = EngineState()
+        self.pushes = []
+        self.metrics = Metrics()
+        self.thread = Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        conn, addr = self.listener.accept()
+        data = b''
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            while len(data) >= 4:
+                size, = struct.unpack_from('<I', data)
+                if len(data) < size + 4:
+                    break
+                rpc = RPC()
+                rpc.ParseFromString(data[4:size + 4])
+                data = data[size + 4:]
+                if rpc.HasField('shm_payload'):
+                    desc = rpc.shm_payload
+                    self.segments.append(desc.name)
+                    with open('/dev/shm' + desc.name, 'rb') as src:
+                        src.seek(desc.offset)
+                        rpc.MergeFromString(src.read(desc.size))
+                    rpc.ClearField('shm_payload')
+                self.rpcs.append(rpc)
+                if list(rpc.echo) == ['reset']:
+                    # Closing with a zero linger time sends a RST.
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                    struct.pack('ii', 1, 0)
+                                    )
+                    conn.close()
+                    return
+                if not rpc.HasField('msg_id') or list(rpc.echo) == ['ignore']:
+                    continue
+                resp = Response()
+                resp.msg_id = rpc.msg_id
+                if 'error' in rpc.echo:
+                    resp.error = 'failed'
+                self.processWaveChunks(rpc, resp)
+                if rpc.HasField('get_metrics'):
+                    resp.metrics.CopyFrom(self.metrics)
+                messages = [resp]
+                if rpc.subscribe.interval:
+                    resp.state.CopyFrom(self.state)
+                if rpc.subscribe.interval or list(rpc.echo) == ['push']:
+                    messages.extend(Response(state=delta)
+                                    for delta in self.pushes
+                                    )
+                for message in messages:
+                    parcel = message.SerializeToString()
+                    conn.sendall(struct.pack('<I', len(parcel)) + parcel)
+        conn.close()
+
+    def processWaveChunks(self, rpc, resp):
+        for chunk in rpc.put_wave_chunks:
+            key = chunk.section, chunk.channel
+            if chunk.HasField('wave'):
+                self.waves[key] = (chunk.wave, bytearray())
+            wave, data = self.waves[key]
+            if chunk.offset != len(data):
+                resp.error = 'out of order'
+            data += chunk.data
+            if chunk.last and (chunk.total_size != len(data) or
+                               chunk.adler32 != zlib.adler32(data)
+                               ):
+                resp.error = 'checksum mismatch'
+
+        if rpc.HasField('get_wave_chunks'):
+            req = rpc.get_wave_chunks
+            wave, data = self.waves[req.section, req.channel]
+            chunk = resp.wave_chunk
+            chunk.offset = req.offset
+            chunk.total_size = len(data)
+            if not req.offset:
+                chunk.wave.CopyFrom(wave)
+            chunk.data = bytes(data[req.offset:req.offset + req.length])
+            if req.length and req.offset + req.length >= len(data):
+                chunk.adler32 = zlib.adler32(data)
+            if self.corrupt and chunk.data:
+                chunk.data = b'x' + chunk.data[1:]
+
+class CallTest(TestCase):
+
+    def setUp(self):
+        self.daemon = FakeDaemon()
+        self.loop = EventLoop()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop,
+                         maxInFlight=2
+                         )
+        self.loopThread = Thread(target=self.loop.run)
+        self.loopThread.start()
+
+    def tearDown(self):
+        self.comm.close()
+        self.loop.stop()
+        self.loopThread.join()
+        self.daemon.thread.join()
+        self.daemon.listener.close()
+        self.loop.close()
+
+    def testCall(self):
+        resp = self.comm.call(timeout=5, echo='hello').result()
+        self.assertIsInstance(resp, Response)
+        self.assertEqual(list(self.daemon.rpcs[0].echo), ['hello'])
+
+    def testGetMetrics(self):
+        self.daemon.metrics.cycles = 1000
+        self.daemon.metrics.cycle_p99 = 0.25
+        self.daemon.metrics.section_memory.add().channel_bytes.extend(
+            [4096, 0]
+        )
+        metrics = self.comm.getMetrics(timeout=5)
+        self.assertEqual(metrics, self.daemon.metrics)
+        self.assertTrue(self.daemon.rpcs[0].HasField('get_metrics'))
+
+    def testScalarAndRepeatedFields(self):
+        self.comm.call(timeout=5, echo=['a', 'b'], set_ticks=10,
+                       save_state='file'
+                       ).result()
+        rpc = self.daemon.rpcs[0]
+        self.assertEqual(list(rpc.echo), ['a', 'b'])
+        self.assertEqual(list(rpc.set_ticks), [10])
+        self.assertEqual(rpc.save_state, 'file')
+
+    def testError(self):
+        with self.assertRaises(RPCError):
+            self.comm.call(timeout=5, echo='error').result()
+
+    def testTimeoutFreesSlot(self):
+        for i in range(3):
+            with self.assertRaises(TimeoutError):
+                self.comm.call(timeout=0.05, echo='ignore').result()
+
+        # The slots were freed, so we can still make calls.
+        self.comm.call(timeout=5, echo='hello').result()
+
+    def testCancelFreesSlot(self):
+        futures = [self.comm.call(echo='ignore') for i in range(2)]
+
+        # No slots are free.
+        with self.assertRaises(TimeoutError):
+            self.comm.call(timeout=0.05, echo='hello')
+        for future in futures:
+            self.assertTrue(future.cancel())
+            with self.assertRaises(CancelledError):
+                future.result()
+        self.comm.call(timeout=5, echo='hello').result()
+
+    def testCallsInBatch(self):
+        # With a single slot, the first call has to be sent for the second
+        # one to get it.
+        self.comm.close()
+        self.daemon.thread.join()
+        self.daemon = FakeDaemon()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop,
+                         maxInFlight=1
+                         )
+        with self.comm.batch():
+            futures = [self.comm.call(timeout=5, echo=str(i))
+                       for i in range(4)
+                       ]
+        for future in futures:
+            future.result()
+        self.assertEqual([list(rpc.echo) for rpc in self.daemon.rpcs],
+                         [[str(i)] for i in range(4)]
+                         )
+
+    def testAsync(self):
+        async def call():
+            return await self.comm.callAsync(timeout=5, echo='hello')
+        self.assertIsInstance(asyncio.run(call()), Response)
+
+class TransportTest(TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.loopThread = Thread(target=self.loop.run)
+        self.loopThread.start()
+        self.tempDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.comm.close()
+        self.loop.stop()
+        self.loopThread.join()
+        self.daemon.thread.join()
+        self.daemon.listener.close()
+        self.loop.close()
+        self.tempDir.cleanup()
+
+    def testUnixSocket(self):
+        path = os.path.join(self.tempDir.name, 'awbd.sock')
+        self.daemon = FakeDaemon(path)
+        self.comm = Comm(UNIX_PREFIX + path, loop=self.loop)
+        self.comm.call(timeout=5, echo='hello').result()
+        self.assertEqual(list(self.daemon.rpcs[0].echo), ['hello'])
+
+    def testUnixSocketRequiresLoop(self):
+        self.daemon = FakeDaemon()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop)
+        with self.assertRaises(ValueError):
+            Comm(UNIX_PREFIX + '/nonexistent')
+
+    def testCallShared(self):
+        self.daemon = FakeDaemon()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop)
+        events = bytes(range(256)) * 4096
+        future = self.comm.callShared(
+            timeout=5, set_initial_state=SetInitialState(events=events)
+        )
+        # Done callbacks run in order, so the segment has been released
+        # once ours is called.
+        released = ThreadEvent()
+        future.add_done_callback(lambda future: released.set())
+        future.result()
+        released.wait()
+        rpc = self.daemon.rpcs[0]
+        self.assertEqual(rpc.set_initial_state[0].events, events)
+        self.assertFalse(rpc.HasField('shm_payload'))
+        self.assertTrue(self.daemon.segments[0].startswith('/' + SHM_PREFIX))
+        self.assertFalse(os.path.exists('/dev/shm' + self.daemon.segments[0]))
+
+    def testConnectionLost(self):
+        self.daemon = FakeDaemon()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop)
+        pending = self.comm.call(echo='ignore')
+        with self.assertRaises(RPCError):
+            self.comm.call(timeout=5, echo='reset').result()
+        with self.assertRaises(RPCError):
+            pending.result(5)
+
+        # Calls made after the connection is lost fail without waiting for
+        # their timeout.
+        start = time.monotonic()
+        with self.assertRaises(RPCError):
+            self.comm.call(timeout=5, echo='x' * (1 << 20)).result()
+        self.assertLess(time.monotonic() - start, 1)
+
+        # The loop is still running.
+        ran = ThreadEvent()
+        self.loop.callSoon(ran.set)
+        self.assertTrue(ran.wait(5))
+
+class WaveChunkTest(TestCase):
+
+    def setUp(self):
+        self.daemon = FakeDaemon()
+        self.loop = EventLoop()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop)
+        self.loopThread = Thread(target=self.loop.run)
+        self.loopThread.start()
+        self.data = bytes(range(256)) * 1000
+
+    def tearDown(self):
+        self.comm.close()
+        self.loop.stop()
+        self.loopThread.join()
+        self.daemon.thread.join()
+        self.daemon.listener.close()
+        self.loop.close()
+
+    def put(self):
+        view = memoryview(self.data)
+        self.comm.putWaveChunks(1, 2, Wave(end=1000), (
+            view[i:i + 10000] for i in range(0, len(view), 10000)
+        ), timeout=5)
+
+    def testRoundTrip(self):
+        self.put()
+        wave, data = self.daemon.waves[1, 2]
+        self.assertEqual(wave.end, 1000)
+        self.assertEqual(data, self.data)
+
+        info, size = self.comm.getWaveInfo(1, 2, timeout=5)
+        self.assertEqual(info.end, 1000)
+        self.assertEqual(size, len(self.data))
+
+        chunks = list(self.comm.iterWaveChunks(1, 2, chunkSize=4096,
+                                               timeout=5
+                                               ))
+        self.assertIsInstance(chunks[0], memoryview)
+        self.assertEqual(len(chunks[0]), 4096)
+        self.assertEqual(b''.join(chunks), self.data)
+
+    def testEmptyWave(self):
+        self.comm.putWaveChunks(0, 0, Wave(), [], timeout=5)
+        self.assertEqual(list(self.comm.iterWaveChunks(0, 0, timeout=5)), [])
+
+    def testChecksumMismatch(self):
+        self.put()
+        self.daemon.corrupt = True
+        with self.assertRaises(RPCError):
+            for chunk in self.comm.iterWaveChunks(1, 2, chunkSize=4096,
+                                                  timeout=5
+                                                  ):
+                pass
+
+    def testPutError(self):
+        # A chunk that isn't preceded by one with the wave attributes.
+        self.put()
+        with self.assertRaises(RPCError):
+            self.comm.call(timeout=5, put_wave_chunks=WaveChunk(
+                section=1, channel=2, offset=0, data=b'xx'
+            )).result()
+
+class SubscribeTest(TestCase):
+
+    def setUp(self):
+        self.daemon = FakeDaemon()
+        self.loop = EventLoop()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop)
+        self.loopThread = Thread(target=self.loop.run)
+        self.loopThread.start()
+
+    def tearDown(self):
+        self.comm.close()
+        self.loop.stop()
+        self.loopThread.join()
+        self.daemon.thread.join()
+        self.daemon.listener.close()
+        self.loop.close()
+
+    def testMirror(self):
+        self.daemon.state = EngineState(playing=True, record_channel=-1,
+                                        pos=0, section_index=0,
+                                        section_count=1, section_end=0,
+                                        channel_status=0
+                                        )
+        self.daemon.pushes = [
+            EngineState(record_channel=2, channel_status=0x200),
+            EngineState(pos=512),
+            EngineState(record_channel=-1, section_end=1024,
+                        channel_status=0x100
+                        ),
+        ]
+
+        mirror = EngineStateMirror()
+        deltas = []
+        done = ThreadEvent()
+        def listener(state, delta):
+            deltas.append(delta)
+            if len(deltas) == 4:
+                done.set()
+        mirror.addListener(listener)
+        self.comm.subscribe(mirror.update, 20)
+        self.assertTrue(done.wait(5))
+
+        self.assertEqual(self.daemon.rpcs[0].subscribe.interval, 20)
+        self.assertEqual(deltas[0], self.daemon.state)
+        self.assertEqual(deltas[2], EngineState(pos=512))
+        state = mirror.state
+        self.assertTrue(state.playing)
+        self.assertEqual(state.record_channel, -1)
+        self.assertEqual(state.pos, 512)
+        self.assertEqual(state.section_end, 1024)
+        self.assertEqual(mirror.getChannelStatus(2), 1)
+        self.assertEqual(mirror.getChannelStatus(1), 0)
+        self.assertEqual(mirror.getChannelStatus(8), 0)
+
+    def testUnsubscribe(self):
+        self.daemon.pushes = [EngineState(pos=1)]
+        states = []
+        self.comm.subscribe(states.append)
+
+        # Pushes are sent after the response, so make another call to be
+        # sure we've received them.
+        self.comm.call(timeout=5, echo='push').result()
+        self.comm.call(timeout=5).result()
+        self.assertEqual(len(states), 3)
+
+        # Once we've unsubscribed, pushes are ignored.
+        self.comm.unsubscribe()
+        self.comm.call(timeout=5, echo='push').result()
+        self.comm.call(timeout=5).result()
+        self.assertEqual(len(states), 3)
+        self.assertTrue(self.daemon.rpcs[3].HasField('subscribe'))
+        self.assertEqual(self.daemon.rpcs[3].subscribe.interval, 0)
+
+class BatchTest(TestCase):
+
+    def setUp(self):
+        self.daemon = FakeDaemon()
+        self.loop = EventLoop()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop)
+        self.loopThread = Thread(target=self.loop.run)
+        self.loopThread.start()
+
+    def tearDown(self):
+        self.comm.close()
+        self.loop.stop()
+        self.loopThread.join()
+        self.daemon.thread.join()
+        self.daemon.listener.close()
+        self.loop.close()
+
+    def section(self, index):
+        req = ChangeSectionRequest()
+        req.sectionIndex = index
+        return req
+
+    def sync(self, comm):
+        """Wait for everything sent so far to get to the daemon."""
+        comm.call(timeout=5).result()
+
+    def testMerge(self):
+        with self.comm.batch():
+            self.comm.sendRPC(echo='a')
+            self.comm.sendRPC(echo='b')
+            self.comm.sendRPC(set_ticks=0)
+            with self.comm.batch():
+                self.comm.sendRPC(change_section=self.section(1))
+            future = self.comm.call(
+                timeout=5, change_channel_attrs=ChangeChannelAttrs(channel=2)
+            )
+        future.result()
+        self.assertEqual(len(self.daemon.rpcs), 2)
+        rpc = self.daemon.rpcs[0]
+        self.assertEqual(list(rpc.echo), ['a', 'b'])
+        self.assertEqual(list(rpc.set_ticks), [0])
+        self.assertEqual(rpc.change_section.sectionIndex, 1)
+        self.assertFalse(rpc.HasField('msg_id'))
+
+        # The call gets its own frame.
+        rpc = self.daemon.rpcs[1]
+        self.assertEqual(rpc.change_channel_attrs.channel, 2)
+        self.assertTrue(rpc.HasField('msg_id'))
+
+    def testFailingNeighbour(self):
+        with self.comm.batch():
+            self.comm.sendRPC(echo='error')
+            future = self.comm.call(timeout=5, echo='ok')
+            self.comm.sendRPC(echo='error')
+        self.assertTrue(future.result())
+        self.sync(self.comm)
+        self.assertEqual([list(rpc.echo) for rpc in self.daemon.rpcs[:3]],
+                         [['error'], ['ok'], ['error']]
+                         )
+
+    def testOrderPreserved(self):
+        with self.comm.batch():
+            self.comm.sendRPC(change_section=self.section(1))
+
+            # Processed before change_section, needs a new frame.
+            self.comm.sendRPC(echo='a')
+
+            # Singular fields can't be merged.
+            self.comm.sendRPC(change_section=self.section(2))
+            self.comm.sendRPC(change_section=self.section(3))
+        self.sync(self.comm)
+        self.assertEqual(
+            [rpc.change_section.sectionIndex for rpc in self.daemon.rpcs[:4]],
+            [1, 2, 3, 0]
+        )
+        self.assertEqual(list(self.daemon.rpcs[1].echo), ['a'])
+
+    def testAutoBatch(self):
+        # Use a second connection with auto-batching.
+        self.comm.close()
+        self.daemon.thread.join()
+        self.daemon = FakeDaemon()
+        self.comm = Comm(*self.daemon.listener.getsockname(), loop=self.loop,
+                         autoBatch=True
+                         )
+
+        # Block the loop so everything we send is in the same iteration.
+        blocked = ThreadEvent()
+        release = ThreadEvent()
+        def block():
+            blocked.set()
+            release.wait()
+        self.loop.callSoon(block)
+        blocked.wait()
+        for i in range(10):
+            self.comm.sendRPC(echo=str(i))
+        future = self.comm.call(timeout=5, set_ticks=0)
+        release.set()
+        future.result()
+        self.assertEqual(len(self.daemon.rpcs), 2)
+        self.assertEqual(list(self.daemon.rpcs[0].echo),
+                         [str(i) for i in range(10)]
+                         )
+        self.assertEqual(list(self.daemon.rpcs[1].set_ticks), [0])
+
+# A stand-in for awbd that writes 'ready' to its -r fd after 'delay' seconds
+# and then waits to be killed.
+DAEMON_SCRIPT = '''
+import os, sys, time
+fd = int(sys.argv[sys.argv.index('-r') + 1])
+time.sleep(%(delay)s)
+os.write(fd, %(ready)r)
+time.sleep(60)
+'''
+
+class DaemonStartTest(TestCase):
+
+    def daemonCmd(self, delay=0, ready=b'READY=1\n'):
+        return [sys.executable, '-c',
+                DAEMON_SCRIPT % {'delay': delay, 'ready': ready}
+                ]
+
+    def testWaitsForReady(self):
+        start = time.monotonic()
+        daemon = launchDaemon(self.daemonCmd(0.2))
+        try:
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
+            self.assertIsNone(daemon.poll())
+        finally:
+            daemon.kill()
+            daemon.wait()
+
+    def testExitBeforeReady(self):
+        with self.assertRaises(DaemonStartError):
+            launchDaemon([sys.executable, '-c', 'pass'])
+
+    def testTimeout(self):
+        start = time.monotonic()
+        with self.assertRaises(DaemonStartError):
+            launchDaemon(self.daemonCmd(30), timeout=0.2)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def testBadReadyLine(self):
+        with self.assertRaises(DaemonStartError):
+            launchDaemon(self.daemonCmd(ready=b'bogus\n'))
+
+    def testConnectWithBackoff(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, 'awbd.sock')
+            listener = socket.socket(socket.AF_UNIX)
+
+            # Start listening after a few failed attempts.
+            def listen():
+                listener.bind(path)
+                listener.listen(1)
+            timer = Timer(0.1, listen)
+            timer.start()
+            try:
+                sock = connectWithBackoff(UNIX_PREFIX + path, timeout=5)
+                sock.close()
+            finally:
+                timer.join()
+                listener.close()
+
+    def testConnectTimeout(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            with self.assertRaises(TimeoutError):
+                connectWithBackoff(
+                    UNIX_PREFIX + os.path.join(tempDir, 'awbd.sock'),
+                    timeout=0.1
+                )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark for the compiled dispatch pipeline.
+
+Measures events/sec through a typical ControlMap -> ChannelFilter /
+PassThrough configuration with one input processor, dispatched the old way
+(walking the processors and handler chain for every event) and through a
+compiled Pipeline.
+
+The sequencer is simulated: getPort() scans a list of ports like
+amidi.Sequencer.getPort() does and sendEvent() does nothing, so this
+measures only the python dispatch overhead.
+"""
+
+import time
+from midi import ControlChange, NoteOn, NoteOff
+from midihandlers import ChannelFilter, ControlMap, PassThrough
+from pipeline import Pipeline
+
+EVENTS = 200000
+
+class FakePort:
+    def __init__(self, fullName):
+        self.fullName = fullName
+
+class FakeSequencer:
+    def __init__(self):
+        self.ports = [FakePort('client%d/port%d' % (i, j))
+                      for i in range(8) for j in range(4)
+                      ]
+        self.ports.append(FakePort('synth/in'))
+        self.sent = 0
+
+    def getPort(self, name):
+        for port in self.ports:
+            if port.fullName == name:
+                return port
+        return None
+
+    def sendEvent(self, event, port):
+        self.sent += 1
+
+class FakeClient:
+    def __init__(self):
+        self.seq = FakeSequencer()
+
+def recorder(client, event):
+    return False
+
+def makeEvents():
+    events = []
+    for i in range(EVENTS // 4):
+        note = i % 128
+        events.append(NoteOn(0, 0, note, 100))
+        events.append(NoteOff(0, 0, note, 0))
+        events.append(ControlChange(0, 0, 7, note))
+        events.append(ControlChange(0, 0, 1, note))
+    return events
+
+def run(name, dispatch, events):
+    start = time.perf_counter()
+    for event in events:
+        dispatch(event)
+    elapsed = time.perf_counter() - start
+    print('%-10s %10.0f events/sec' % (name, len(events) / elapsed))
+
+def main():
+    client = FakeClient()
+    handler = ControlMap(ChannelFilter('synth/in', 1))
+    handler.addControlHandler(7, PassThrough('synth/in'))
+    processors = [recorder]
+    events = makeEvents()
+
+    def walk(event):
+        for proc in processors:
+            if proc(client, event):
+                return
+        handler(client, event)
+
+    pipeline = Pipeline(client)
+    pipeline.configure(processors, handler)
+
+    run('chain', walk, events)
+    run('compiled', pipeline.dispatchInput, events)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Single threaded event loop.
+
+EventLoop multiplexes file descriptors and timers on one epoll instance, so
+that the midi input, the pedal, the connection to awbd and scheduled midi
+output can all be serviced from a single thread.  Other threads (like the
+Tk UI) post work to the loop with callSoon().
+
+Note that epoll timeouts have millisecond resolution, timers are rounded up
+to the next millisecond.
+"""
+
+from collections import deque
+import heapq
+import select
+from threading import get_ident
+import time
+import traceback
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from spsc import EventFD
+
+class Timer:
+    """A callback scheduled with EventLoop.callAt() or callLater()."""
+
+    def __init__(self, when: float, callback: Callable[..., Any],
+                 args: Tuple
+                 ):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """Cancel the timer.  Must be called on the loop thread."""
+        self.cancelled = True
+
+    def __lt__(self, other: 'Timer') -> bool:
+        return self.when < other.when
+
+class EventLoop:
+    """An epoll based event loop.
+
+    Everything except callSoon() and stop() must be called from the loop
+    thread (or before the loop is started).  Exceptions raised from callbacks
+    are printed and otherwise ignored, so that one misbehaving handler
+    doesn't bring down the loop.
+    """
+
+    def __init__(self):
+        self.__epoll = select.epoll()
+
+        # Maps fds to [events, reader, writer].
+        self.__fds : Dict[int, List[Any]] = {}
+        self.__timers : List[Timer] = []
+
+        # Callbacks posted by callSoon().  deque append and popleft are
+        # atomic, so this doesn't need a lock.
+        self.__ready : Deque[Tuple[Callable[..., Any], Tuple]] = deque()
+        self.__wakeup = EventFD()
+        self.__epoll.register(self.__wakeup.fd, select.EPOLLIN)
+        self.__running = False
+        self.__thread : Optional[int] = None
+
+    def time(self) -> float:
+        """Returns the loop's notion of the current time (monotonic
+        seconds).
+        """
+        return time.monotonic()
+
+    def __update(self, fd: int, events: int, reader: Optional[Callable],
+                 writer: Optional[Callable]
+                 ) -> None:
+        if fd in self.__fds:
+            if events:
+                self.__epoll.modify(fd, events)
+                self.__fds[fd] = [events, reader, writer]
+            else:
+                self.__epoll.unregister(fd)
+                del self.__fds[fd]
+        elif events:
+            self.__epoll.register(fd, events)
+            self.__fds[fd] = [events, reader, writer]
+
+    def addReader(self, fd: int, callback: Callable[[], Any]) -> None:
+        """Call 'callback' whenever 'fd' is readable."""
+        events, reader, writer = self.__fds.get(fd, (0, None, None))
+        self.__update(fd, events | select.EPOLLIN, callback, writer)
+
+    def removeReader(self, fd: int) -> None:
+        events, reader, writer = self.__fds.get(fd, (0, None, None))
+        self.__update(fd, events & ~select.EPOLLIN, None, writer)
+
+    def addWriter(self, fd: int, callback: Callable[[], Any]) -> None:
+        """Call 'callback' whenever 'fd' is writable."""
+        events, reader, writer = self.__fds.get(fd, (0, None, None))
+        self.__update(fd, events | select.EPOLLOUT, reader, callback)
+
+    def removeWriter(self, fd: int) -> None:
+        events, reader, writer = self.__fds.get(fd, (0, None, None))
+        self.__update(fd, events & ~select.EPOLLOUT, reader, None)
+
+    def callAt(self, when: float, callback: Callable[..., Any],
+               *args: Any
+               ) -> Timer:
+        """Call 'callback(*args)' at time 'when' (see time())."""
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.__timers, timer)
+        return timer
+
+    def callLater(self, delay: float, callback: Callable[..., Any],
+                  *args: Any
+                  ) -> Timer:
+        """Call 'callback(*args)' after 'delay' seconds."""
+        return self.callAt(self.time() + delay, callback, *args)
+
+    def callSoon(self, callback: Callable[..., Any], *args: Any) -> None:
+        """Call 'callback(*args)' on the next iteration of the loop.
+
+        This may be called from any thread.
+        """
+        self.__ready.append((callback, args))
+        if self.__thread != get_ident():
+            self.__wakeup.signal()
+
+    def stop(self) -> None:
+        """Make run() return.  May be called from any thread."""
+        self.callSoon(self.__stop)
+
+    def __stop(self) -> None:
+        self.__running = False
+
+    def __call(self, callback: Callable[..., Any], args: Tuple) -> None:
+        try:
+            callback(*args)
+        except Exception:
+            print('Exception in event loop callback %r:' % (callback,))
+            traceback.print_exc()
+
+    def __getTimeout(self) -> float:
+        if self.__ready:
+            return 0
+        timers = self.__timers
+        while timers and timers[0].cancelled:
+            heapq.heappop(timers)
+        if not timers:
+            return -1
+        return max(0, timers[0].when - self.time())
+
+    def runOnce(self, timeout: Optional[float] = None) -> None:
+        """Run a single iteration of the loop.
+
+        Waits for at most 'timeout' seconds (or until the next timer if that's
+        sooner) for events, then runs all callbacks that are ready.
+        """
+        self.__thread = get_ident()
+        wait = self.__getTimeout()
+        if timeout is not None and (wait < 0 or timeout < wait):
+            wait = timeout
+        try:
+            events = self.__epoll.poll(wait)
+        except InterruptedError:
+            events = []
+
+        for fd, mask in events:
+            if fd == self.__wakeup.fd:
+                self.__wakeup.clear()
+                continue
+
+            # Look up the handlers for every event, since an earlier
+            # callback may have removed them.
+            entry = self.__fds.get(fd)
+            if entry and mask & (select.EPOLLIN | select.EPOLLHUP |
+                                 select.EPOLLERR) and entry[1]:
+                self.__call(entry[1], ())
+            entry = self.__fds.get(fd)
+            if entry and mask & (select.EPOLLOUT | select.EPOLLHUP |
+                                 select.EPOLLERR) and entry[2]:
+                self.__call(entry[2], ())
+
+        now = self.time()
+        timers = self.__timers
+        while timers and timers[0].when <= now:
+            timer = heapq.heappop(timers)
+            if not timer.cancelled:
+                self.__call(timer.callback, timer.args)
+
+        # Only run the callbacks that were ready when we started, anything
+        # they post is run on the next iteration.
+        ready = self.__ready
+        for i in range(len(ready)):
+            callback, args = ready.popleft()
+            self.__call(callback, args)
+
+    def run(self) -> None:
+        """Run the loop until stop() is called."""
+        self.__running = True
+        while self.__running:
+            self.runOnce()
+
+    def close(self) -> None:
+        self.__epoll.close()
+        self.__wakeup.close()
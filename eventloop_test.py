@@ -0,0 +1,91 @@
+
+import os
+import socket
+from threading import Thread
+import time
+from unittest import main, TestCase
+from eventloop import EventLoop
+
+class EventLoopTest(TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def testReader(self):
+        rd, wr = os.pipe()
+        received = []
+        def onReadable():
+            received.append(os.read(rd, 100))
+            if received[-1] == b'end':
+                self.loop.stop()
+        self.loop.addReader(rd, onReadable)
+        os.write(wr, b'data')
+        self.loop.runOnce(1)
+        self.assertEqual(received, [b'data'])
+
+        os.write(wr, b'end')
+        self.loop.run()
+        self.assertEqual(received, [b'data', b'end'])
+
+        # Nothing is delivered after the reader is removed.
+        self.loop.removeReader(rd)
+        os.write(wr, b'more')
+        self.loop.runOnce(0)
+        self.assertEqual(len(received), 2)
+        os.close(rd)
+        os.close(wr)
+
+    def testReaderAndWriter(self):
+        a, b = socket.socketpair()
+        events = []
+        def onWritable():
+            events.append('w')
+            self.loop.removeWriter(a.fileno())
+        self.loop.addReader(a.fileno(), lambda: events.append(a.recv(10)))
+        self.loop.addWriter(a.fileno(), onWritable)
+        b.send(b'x')
+        self.loop.runOnce(1)
+        self.assertEqual(sorted(events, key=str), [b'x', 'w'])
+        self.loop.removeReader(a.fileno())
+        a.close()
+        b.close()
+
+    def testTimers(self):
+        order = []
+        self.loop.callLater(0.03, order.append, 3)
+        self.loop.callLater(0.01, order.append, 1)
+        cancelled = self.loop.callLater(0.02, order.append, 2)
+        cancelled.cancel()
+        self.loop.callLater(0.04, self.loop.stop)
+        start = time.monotonic()
+        self.loop.run()
+        self.assertEqual(order, [1, 3])
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+
+    def testCallSoonFromThread(self):
+        received = []
+        def post():
+            for i in range(100):
+                self.loop.callSoon(received.append, i)
+            self.loop.stop()
+        thread = Thread(target=post)
+        thread.start()
+        self.loop.run()
+        thread.join()
+        self.assertEqual(received, list(range(100)))
+
+    def testExceptionsDontStopLoop(self):
+        received = []
+        def fail():
+            raise Exception('expected failure')
+        self.loop.callSoon(fail)
+        self.loop.callSoon(received.append, 1)
+        self.loop.stop()
+        self.loop.run()
+        self.assertEqual(received, [1])
+
+if __name__ == '__main__':
+    main()
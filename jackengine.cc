@@ -6,6 +6,7 @@
 #include <stdio.h>
 #include <stdlib.h>
 
+#include <algorithm>
 #include <atomic>
 #include <iostream>
 #include <sstream>
@@ -27,6 +28,8 @@ static int jack_callback(jack_nframes_t nframes, void *arg) {
     return 0;
 }
 
+static int xrun_callback(void *arg);
+
 namespace {
 
 SPUG_RCPTR(Channel);
@@ -101,54 +104,85 @@ struct Channel : public RCBase {
         return data->get(pos * 2, false);
     }
 
-    void storeIn(Wave &wave) const {
+    // The wave data (see Wave.data in mawb.proto) consists of the samples
+    // of every buffer from offset to offset + end, each stored as a 16-bit
+    // big-endian value.  Missing buffers are stored as silence.
+
+    // Returns the size of the wave data in bytes.
+    size_t getDataSize() const {
+        int bufSize = WaveTree::getBufferSize() / 2;
+        return static_cast<size_t>((end + bufSize - 1) / bufSize) *
+               bufSize * 4;
+    }
+
+    // Appends up to 'size' bytes of the wave data starting at byte 'start'
+    // to 'out'.  'start' and 'size' should be even.
+    void readData(size_t start, size_t size, string &out) const {
+        size_t bufSamples = WaveTree::getBufferSize();
+        size_t sample = start / 2;
+        size_t lastSample = min(start + size, getDataSize()) / 2;
+        while (sample < lastSample) {
+            size_t bufStart = sample - sample % bufSamples;
+            size_t bufEnd = min(bufStart + bufSamples, lastSample);
+            WaveBuf *buf = data->get(offset * 2 + bufStart);
+            for (; sample < bufEnd; ++sample) {
+                int val = buf ? buf->buffer[sample - bufStart] * 32768 : 0;
+                out.push_back(static_cast<char>(val >> 8));
+                out.push_back(static_cast<char>(val & 0xFF));
+            }
+        }
+    }
+
+    // Writes 'size' bytes of wave data to the wave at byte 'start'.
+    // 'start' and 'size' should be even.
+    void writeData(size_t start, const char *bytes, size_t size) {
+        size_t bufSamples = WaveTree::getBufferSize();
+        size_t sample = start / 2;
+        size_t lastSample = min(start + size, getDataSize()) / 2;
+        while (sample < lastSample) {
+            size_t bufStart = sample - sample % bufSamples;
+            size_t bufEnd = min(bufStart + bufSamples, lastSample);
+            WaveBuf *buf = data->get(offset * 2 + bufStart, true);
+            for (; sample < bufEnd; ++sample) {
+                const char *val = bytes + sample * 2 - start;
+                buf->buffer[sample - bufStart] = static_cast<float>(
+                    ((val[0] << 8) | (val[1] & 0xFF)) / 32768.0
+                );
+            }
+        }
+    }
+
+    // Store the attributes of the channel (everything but the data) in
+    // 'wave'.
+    void storeInfoIn(Wave &wave) const {
         wave.set_enabled(enabled);
         wave.set_end(end);
         wave.set_looppos(loopPos);
         wave.set_offset(offset);
+    }
 
-        // Store the wave data.
-        int bufSize = WaveTree::getBufferSize() / 2;
-        ostringstream temp;
-        for (int i = offset; i < end + offset; i += bufSize) {
-            WaveBuf *buf = data->get(i * 2);
-            if (buf) {
-                for (int j = 0; j < bufSize * 2; ++j) {
-                    int val = buf->buffer[j] * 32768;
-                    temp << static_cast<char>(val >> 8);
-                    temp << static_cast<char>(val & 0xFF);
-                }
-            } else {
-                for (int j = 0; j < bufSize * 2; ++j) {
-                    temp << "\0\0";
-                }
-            }
-        }
-        wave.set_data(temp.str());
+    void storeIn(Wave &wave) const {
+        storeInfoIn(wave);
+        string temp;
+        temp.reserve(getDataSize());
+        readData(0, getDataSize(), temp);
+        wave.set_data(temp);
     }
 
-    void loadFrom(const Wave &wave) {
+    // Load the attributes of the channel from 'wave', leaving the data
+    // empty.
+    void loadInfoFrom(const Wave &wave) {
+        data = new WaveTree();
         enabled = wave.enabled();
         end = wave.has_end() ? wave.end() : 0;
         loopPos = wave.has_looppos() ? wave.looppos() : 0;
         offset = wave.has_offset() ? wave.offset() : 0;
+    }
 
-        // Retrieve wave data.
+    void loadFrom(const Wave &wave) {
+        loadInfoFrom(wave);
         const string &temp = wave.data();
-        int bufSize = WaveTree::getBufferSize() / 2;
-        for (int i = offset; i < end + offset; i += bufSize) {
-            WaveBuf *buf = data->get(i * 2, true);
-            for (int j = 0; j < bufSize * 2; ++j) {
-                int index = (i - offset) * 4 + j * 2;
-                if (index < temp.size()) {
-                    buf->buffer[j] = static_cast<float>(
-                        ((temp[index] << 8) |
-                        (temp[index + 1] & 0xFF)) /
-                        32768.0
-                    );
-                }
-            }
-        }
+        writeData(0, temp.data(), temp.size());
 
         cerr << "loaded channel: enabled = " << enabled << " end = " << end <<
             " loop pos = " << loopPos << " offset = " << offset << '\r' <<
@@ -204,6 +238,11 @@ enum Command {
     nextSectionCmd,
     prevSectionCmd,
 
+    // Swap in a channel wave or a loaded project prepared by another thread
+    // (see JackEngineImpl::runOnRT()).
+    resetWaveCmd,
+    loadCmd,
+
     // Set/clear channel stickiness.  Low-byte contains the channel number.
     setChannelSticky = 256,
     clearChannelSticky = 512
@@ -224,13 +263,62 @@ class JackEngineImpl : public JackEngine {
         atomic_int pos;
 
         // The list of sections and an ordinal indicating which section is
-        // current.
+        // current.  Only the RT thread changes these, other threads can
+        // read them while we're not busy.
         vector<SectionObjPtr> sections;
         int sectionIndex;
 
         // Commands sent from other threads.
         atomic<Command> command;
 
+        // A channel wave to swap in for resetWaveCmd.  'newSection' is
+        // appended to the sections first if it is set.  After the command,
+        // 'channel' holds the replaced channel so that it gets released by
+        // the thread that sent the command rather than the RT thread.
+        struct WaveReset {
+            int sectionIndex, channelIndex;
+            SectionObjPtr newSection;
+            ChannelPtr channel;
+        } pendingReset;
+
+        // The sections to swap in for loadCmd.  After the command, these are
+        // the old sections.
+        vector<SectionObjPtr> pendingSections;
+        int pendingSectionIndex;
+
+        // State that only the RT thread can access safely, published at the
+        // end of every cycle for other threads (see publishState()).
+        atomic_int publishedSectionIndex, publishedSectionCount,
+            publishedSectionEnd;
+        atomic<uint32_t> publishedChannelStatus;
+
+        // Metrics, collected by the RT thread with relaxed stores and
+        // aggregated by JackEngine::getMetrics().
+
+        // Histogram of the time spent in a cycle as a fraction of the
+        // period, in half percent bins.  The last bin is for cycles that
+        // took a period or longer.
+        static const int cycleBins = 201;
+        atomic<uint32_t> cycleHistogram[cycleBins];
+
+        // The longest cycle in millionths of a period.
+        atomic<uint32_t> maxCycleLoad;
+
+        // xruns reported by jack and WaveBufs allocated in process().
+        atomic<uint32_t> xruns;
+        atomic<uint64_t> rtAllocations;
+
+        // Wave buffers held by the channels of the first few sections.
+        // This is updated every memoryCycles cycles.
+        static const int memorySections = 32;
+        static const int memoryChannels = 8;
+        static const int memoryCycles = 64;
+        atomic<uint32_t> publishedBuffers[memorySections][memoryChannels];
+        atomic_int publishedMemorySections;
+        int cyclesUntilMemory;
+
+        jack_nframes_t sampleRate;
+
         // The record mode.
         atomic<RecordMode> recordMode;
 
@@ -263,6 +351,16 @@ class JackEngineImpl : public JackEngine {
                 pos(0),
                 sectionIndex(0),
                 command(noopCmd),
+                pendingSectionIndex(0),
+                publishedSectionIndex(0),
+                publishedSectionCount(1),
+                publishedSectionEnd(0),
+                publishedChannelStatus(0),
+                maxCycleLoad(0),
+                xruns(0),
+                rtAllocations(0),
+                publishedMemorySections(0),
+                cyclesUntilMemory(0),
                 recordMode(spanRelative),
                 recording(false),
                 lastRecordChannel(-1),
@@ -275,6 +373,13 @@ class JackEngineImpl : public JackEngine {
             client = jack_client_open(name, static_cast<jack_options_t>(0),
                                       &status);
             jack_set_process_callback(client, jack_callback, this);
+            jack_set_xrun_callback(client, xrun_callback, this);
+            sampleRate = jack_get_sample_rate(client);
+            for (auto &bin : cycleHistogram)
+                bin.store(0, memory_order_relaxed);
+            for (auto &section : publishedBuffers)
+                for (auto &buffers : section)
+                    buffers.store(0, memory_order_relaxed);
             in1 = jack_port_register(client, "in_1",
                                      JACK_DEFAULT_AUDIO_TYPE,
                                      JackPortIsInput,
@@ -324,27 +429,83 @@ class JackEngineImpl : public JackEngine {
         }
 
         void load(istream &in) {
-            sections.clear();
             ProjectFile pf;
             pf.ParseFromIstream(&in);
-            sectionIndex = pf.sectionindex();
 
+            // Build the new sections here and have the RT thread swap them
+            // in.
+            waitForCommand();
             for (int i = 0; i < pf.section_size(); ++i) {
                 const Section &sec = pf.section(0);
-                section = new SectionObj();
-                section->end = sec.end();
-                sections.push_back(section);
-                cerr << "loaded section, end = " << section->end << "\r\n" <<
+                SectionObjPtr loaded = new SectionObj();
+                loaded->end = sec.end();
+                pendingSections.push_back(loaded);
+                cerr << "loaded section, end = " << loaded->end << "\r\n" <<
                     flush;
 
                 for (const auto &wave : sec.waves()) {
                     ChannelPtr channel = new Channel();
-                    section->channels.push_back(channel);
+                    loaded->channels.push_back(channel);
                     channel->loadFrom(wave);
-                    if (channel->end - channel->offset > section->end)
-                        section->end = channel->end - channel->offset;
+                    if (channel->end - channel->offset > loaded->end)
+                        loaded->end = channel->end - channel->offset;
                 }
             }
+            pendingSectionIndex = pf.sectionindex();
+            runOnRT(loadCmd);
+            pendingSections.clear();
+        }
+
+        // Wait for the RT thread to pick up the last command sent.
+        // process() is called every cycle while the client is active, so
+        // this never takes much more than a period.
+        void waitForCommand() const {
+            while (command.load(memory_order_acquire) != noopCmd)
+                usleep(1000);
+        }
+
+        // Have the RT thread run 'cmd' and wait for it to finish.  This is
+        // how other threads change the list of sections and their channels,
+        // which the RT thread reads (see publishState() and
+        // publishMemory()) without locking.  Everything the command
+        // installs is allocated by the caller beforehand.
+        void runOnRT(Command cmd) {
+            waitForCommand();
+            command.store(cmd, memory_order_release);
+            waitForCommand();
+        }
+
+        // Apply pendingReset.  Called by the RT thread.
+        void applyReset() {
+            WaveReset &reset = pendingReset;
+            if (reset.newSection)
+                sections.push_back(reset.newSection);
+            SectionObj *sec = sections[reset.sectionIndex].get();
+            ChannelPtr old = sec->channels[reset.channelIndex];
+            sec->channels[reset.channelIndex] = reset.channel;
+            reset.channel = old;
+
+            const Channel *chan = sec->channels[reset.channelIndex].get();
+            if (chan->end - chan->offset > sec->end)
+                sec->end = chan->end - chan->offset;
+        }
+
+        // Apply pendingSections.  Called by the RT thread.
+        void applyLoad() {
+            sections.swap(pendingSections);
+            sectionIndex = pendingSectionIndex;
+            if (!sections.empty())
+                section = sections.back();
+        }
+
+        // Returns the channel, null if the section or channel doesn't exist.
+        Channel *getChannel(int sectionIndex, int channelIndex) const {
+            if (sectionIndex < 0 || sectionIndex >= sections.size())
+                return 0;
+            const SectionObj *sec = sections[sectionIndex].get();
+            if (channelIndex < 0 || channelIndex >= sec->channels.size())
+                return 0;
+            return sec->channels[channelIndex].get();
         }
 
         SectionObjPtr changeSections() {
@@ -365,7 +526,8 @@ class JackEngineImpl : public JackEngine {
 
                 case prevSectionCmd:
                     cerr << "prev section\r" << endl;
-                    sectionIndex = (sectionIndex - 1) % sections.size();
+                    sectionIndex = (sectionIndex + sections.size() - 1) %
+                                   sections.size();
                     section = sections[sectionIndex];
                     break;
 
@@ -377,6 +539,82 @@ class JackEngineImpl : public JackEngine {
             pos = 0;
             return section;
         }
+
+        // Publish the section and channel state for other threads.  Called
+        // by the RT thread at the end of every cycle, this only does a
+        // handful of relaxed stores.
+        void publishState() {
+            publishedSectionIndex.store(sectionIndex, memory_order_relaxed);
+            publishedSectionCount.store(sections.size(),
+                                        memory_order_relaxed
+                                        );
+            publishedSectionEnd.store(section->end, memory_order_relaxed);
+
+            // Four status bits per channel, see EngineState.channel_status
+            // in mawb.proto.
+            int curRecordChannel = recordChannel.load(memory_order_relaxed);
+            uint32_t status = 0;
+            for (int i = 0; i < section->channels.size() && i < 8; ++i) {
+                const Channel *channel = section->channels[i].get();
+                uint32_t bits = (channel->end ? 1 : 0) |
+                                (i == curRecordChannel ? 2 : 0) |
+                                (channel->sticky ? 4 : 0);
+                status |= bits << (i * 4);
+            }
+            publishedChannelStatus.store(status, memory_order_relaxed);
+        }
+
+        // Record the metrics for a cycle that started at 'start' (as
+        // returned by jack_get_time()), when the thread had allocated
+        // 'allocations' WaveBufs.  Called by the RT thread at the end of
+        // every cycle.
+        void recordCycle(unsigned int nframes, jack_time_t start,
+                         size_t allocations
+                         ) {
+            // Single writer, so we don't need atomic increments.
+            uint64_t period = uint64_t(nframes) * 1000000 / sampleRate;
+            uint64_t load =
+                period ? (jack_get_time() - start) * 1000000 / period : 0;
+            int bin = min(load * (cycleBins - 1) / 1000000,
+                          uint64_t(cycleBins - 1)
+                          );
+            cycleHistogram[bin].store(
+                cycleHistogram[bin].load(memory_order_relaxed) + 1,
+                memory_order_relaxed
+            );
+            if (load > maxCycleLoad.load(memory_order_relaxed))
+                maxCycleLoad.store(min(load, uint64_t(UINT32_MAX)),
+                                   memory_order_relaxed
+                                   );
+
+            allocations = WaveBuf::getThreadAllocations() - allocations;
+            if (allocations)
+                rtAllocations.store(
+                    rtAllocations.load(memory_order_relaxed) + allocations,
+                    memory_order_relaxed
+                );
+
+            if (!cyclesUntilMemory--) {
+                publishMemory();
+                cyclesUntilMemory = memoryCycles - 1;
+            }
+        }
+
+        // Publish the number of buffers held by each channel.
+        void publishMemory() {
+            int count = min(sections.size(), size_t(memorySections));
+            for (int i = 0; i < count; ++i) {
+                const SectionObj *sec = sections[i].get();
+                for (int j = 0; j < memoryChannels; ++j)
+                    publishedBuffers[i][j].store(
+                        j < sec->channels.size() ?
+                            sec->channels[j]->data->getBufferCount() :
+                            0,
+                        memory_order_relaxed
+                    );
+            }
+            publishedMemorySections.store(count, memory_order_relaxed);
+        }
 };
 
 // Audio sample rate.
@@ -384,6 +622,12 @@ int framesPerSecond = 44100;
 
 } // anon namespace
 
+static int xrun_callback(void *arg) {
+    JackEngineImpl *impl = reinterpret_cast<JackEngineImpl *>(arg);
+    impl->xruns.fetch_add(1, memory_order_relaxed);
+    return 0;
+}
+
 JackEngine::~JackEngine() {
     JackEngineImpl *impl = static_cast<JackEngineImpl *>(this);
     jack_deactivate(impl->client);
@@ -508,6 +752,8 @@ void JackEngine::closeRecordChannel(const int pos) {
 
 void JackEngine::process(unsigned int nframes) {
     JackEngineImpl *impl = static_cast<JackEngineImpl *>(this);
+    jack_time_t cycleStart = jack_get_time();
+    size_t allocations = WaveBuf::getThreadAllocations();
 
     // Initialize if necessary.
     if (!impl->initialized) {
@@ -518,7 +764,7 @@ void JackEngine::process(unsigned int nframes) {
     }
 
     // Process a command.
-    Command command = impl->command.load(memory_order_relaxed);
+    Command command = impl->command.load(memory_order_acquire);
     int param = 0;
     if (command > 0xff) {
         param = command & 0xff;
@@ -530,6 +776,7 @@ void JackEngine::process(unsigned int nframes) {
             impl->sections.clear();
             impl->section = new SectionObj();
             impl->sections.push_back(impl->section);
+            impl->sectionIndex = 0;
             impl->command.store(noopCmd, memory_order_relaxed);
             impl->playing.store(true, memory_order_relaxed);
             break;
@@ -550,11 +797,21 @@ void JackEngine::process(unsigned int nframes) {
             impl->newSectionLatched = prevSectionCmd;
             impl->command.store(noopCmd, memory_order_relaxed);
             break;
+        case resetWaveCmd:
+            impl->applyReset();
+            impl->command.store(noopCmd, memory_order_release);
+            break;
+        case loadCmd:
+            impl->applyLoad();
+            impl->command.store(noopCmd, memory_order_release);
+            break;
         case setChannelSticky:
             impl->section->channels[param]->sticky = true;
+            impl->command.store(noopCmd, memory_order_relaxed);
             break;
         case clearChannelSticky:
             impl->section->channels[param]->sticky = false;
+            impl->command.store(noopCmd, memory_order_relaxed);
             break;
         default:
             assert(false && "Unknown command received.");
@@ -730,6 +987,9 @@ void JackEngine::process(unsigned int nframes) {
             impl->pos.store(pos + nframes, memory_order_relaxed);
         }
     }
+
+    impl->publishState();
+    impl->recordCycle(nframes, cycleStart, allocations);
 }
 
 void JackEngine::startRecord(int channel) {
@@ -764,7 +1024,10 @@ bool JackEngine::isPlaying() const {
 
 void JackEngine::setSticky(int channel, bool sticky) {
     JackEngineImpl *impl = static_cast<JackEngineImpl *>(this);
-    impl->command.store(makeParamCommand(setChannelSticky, channel));
+    impl->command.store(makeParamCommand(sticky ? setChannelSticky :
+                                                  clearChannelSticky,
+                                         channel
+                                         ));
 }
 
 void JackEngine::clear() {
@@ -787,9 +1050,157 @@ void JackEngine::startPrevSection() {
     impl->command.store(prevSectionCmd, memory_order_relaxed);
 }
 
+bool JackEngine::isBusy() const {
+    const JackEngineImpl *impl = static_cast<const JackEngineImpl *>(this);
+    return isPlaying() || impl->recordChannel.load(memory_order_relaxed) != -1;
+}
+
+bool JackEngine::getWaveInfo(int section, int channel, Wave &wave,
+                             size_t &size
+                             ) {
+    const JackEngineImpl *impl = static_cast<const JackEngineImpl *>(this);
+    Channel *chan = impl->getChannel(section, channel);
+    if (!chan || isBusy())
+        return false;
+    chan->storeInfoIn(wave);
+    size = chan->getDataSize();
+    return true;
+}
+
+bool JackEngine::readWaveData(int section, int channel, size_t offset,
+                              size_t size,
+                              string &out
+                              ) {
+    const JackEngineImpl *impl = static_cast<const JackEngineImpl *>(this);
+    Channel *chan = impl->getChannel(section, channel);
+    if (!chan || isBusy())
+        return false;
+    chan->readData(offset, size, out);
+    return true;
+}
+
+bool JackEngine::resetWave(int section, int channel, const Wave &wave) {
+    JackEngineImpl *impl = static_cast<JackEngineImpl *>(this);
+    if (isBusy())
+        return false;
+
+    // The RT thread publishes the sections and channels, so we build the new
+    // channel (and section) here and have it swap them in.
+    impl->waitForCommand();
+    JackEngineImpl::WaveReset &reset = impl->pendingReset;
+    ChannelPtr chan = new Channel();
+    if (const Channel *old = impl->getChannel(section, channel)) {
+        chan->sticky = old->sticky;
+    } else if (section == impl->sections.size() && channel >= 0 &&
+               channel < defaultChannels
+               ) {
+        // Add a section if we're writing one past the end.
+        reset.newSection = new SectionObj();
+    } else {
+        return false;
+    }
+    chan->loadInfoFrom(wave);
+
+    reset.sectionIndex = section;
+    reset.channelIndex = channel;
+    reset.channel = chan;
+    impl->runOnRT(resetWaveCmd);
+
+    // Release the replaced channel here rather than on the RT thread.
+    reset.channel = 0;
+    reset.newSection = 0;
+    return true;
+}
+
+bool JackEngine::writeWaveData(int section, int channel, size_t offset,
+                               const string &data
+                               ) {
+    JackEngineImpl *impl = static_cast<JackEngineImpl *>(this);
+    Channel *chan = impl->getChannel(section, channel);
+    if (!chan || isBusy())
+        return false;
+    chan->writeData(offset, data.data(), data.size());
+    return true;
+}
+
+int JackEngine::getSectionIndex() const {
+    const JackEngineImpl *impl = static_cast<const JackEngineImpl *>(this);
+    return impl->publishedSectionIndex.load(memory_order_relaxed);
+}
+
+int JackEngine::getSectionCount() const {
+    const JackEngineImpl *impl = static_cast<const JackEngineImpl *>(this);
+    return impl->publishedSectionCount.load(memory_order_relaxed);
+}
+
+void JackEngine::getState(EngineState &state) const {
+    const JackEngineImpl *impl = static_cast<const JackEngineImpl *>(this);
+    state.set_playing(isPlaying());
+    state.set_record_channel(getRecordChannel());
+    state.set_pos(impl->pos.load(memory_order_relaxed));
+    state.set_section_index(getSectionIndex());
+    state.set_section_count(getSectionCount());
+    state.set_section_end(
+        impl->publishedSectionEnd.load(memory_order_relaxed)
+    );
+    state.set_channel_status(
+        impl->publishedChannelStatus.load(memory_order_relaxed)
+    );
+}
+
+void JackEngine::getMetrics(Metrics &metrics) const {
+    const JackEngineImpl *impl = static_cast<const JackEngineImpl *>(this);
+    const int bins = JackEngineImpl::cycleBins;
+
+    // Get the percentiles from a snapshot of the cycle histogram.
+    uint32_t histogram[bins];
+    uint64_t cycles = 0;
+    for (int i = 0; i < bins; ++i) {
+        histogram[i] = impl->cycleHistogram[i].load(memory_order_relaxed);
+        cycles += histogram[i];
+    }
+    float maxLoad =
+        impl->maxCycleLoad.load(memory_order_relaxed) / 1000000.0;
+    float p50 = 0, p99 = 0;
+    uint64_t total = 0;
+    for (int i = 0; i < bins && cycles; ++i) {
+        total += histogram[i];
+
+        // Use the upper bound of the bin, which can't exceed the maximum.
+        float load = min(float(i + 1) / (bins - 1), maxLoad);
+        if (!p50 && total * 2 >= cycles)
+            p50 = load;
+        if (total * 100 >= cycles * 99) {
+            p99 = load;
+            break;
+        }
+    }
+    metrics.set_cycles(cycles);
+    metrics.set_cycle_p50(p50);
+    metrics.set_cycle_p99(p99);
+    metrics.set_cycle_max(maxLoad);
+
+    metrics.set_xruns(impl->xruns.load(memory_order_relaxed));
+    metrics.set_rt_allocations(
+        impl->rtAllocations.load(memory_order_relaxed)
+    );
+
+    size_t bufferBytes = WaveTree::getBufferSize() * 2 * sizeof(float);
+    metrics.set_wave_bytes(WaveBuf::getLiveCount() * bufferBytes);
+    int sections = impl->publishedMemorySections.load(memory_order_relaxed);
+    for (int i = 0; i < sections; ++i) {
+        SectionMemory *mem = metrics.add_section_memory();
+        for (int j = 0; j < JackEngineImpl::memoryChannels; ++j)
+            mem->add_channel_bytes(
+                impl->publishedBuffers[i][j].load(memory_order_relaxed) *
+                bufferBytes
+            );
+    }
+}
+
 void JackEngine::store(ostream &out) {
     const JackEngineImpl *impl = static_cast<const JackEngineImpl *>(this);
-    if (isPlaying() || impl->recordChannel.load(memory_order_relaxed) != -1) {
+    if (isBusy()) {
         cerr << "\033[31mCan't save/load while playing or recording (hit "
                 "pause)\r" << endl;
         return;
@@ -799,7 +1210,7 @@ void JackEngine::store(ostream &out) {
 
 void JackEngine::load(istream &in) {
     JackEngineImpl *impl = static_cast<JackEngineImpl *>(this);
-    if (isPlaying() || impl->recordChannel.load(memory_order_relaxed) != -1) {
+    if (isBusy()) {
         cerr << "\033[31mCan't save/load while playing or recording (hit "
                 "pause)\r" << endl;
         return;
@@ -2,6 +2,13 @@
 #define awb_jackengine_h_
 
 #include <iostream>
+#include <string>
+
+namespace mawb {
+    class EngineState;
+    class Metrics;
+    class Wave;
+}
 
 namespace awb {
 
@@ -67,8 +74,54 @@ class JackEngine {
         // record is initiated.
         void startNextSection();
 
+        // Returns the index of the current section and the number of
+        // sections.  Section changes are applied by the audio thread, so
+        // these don't reflect a section change until it happens.
+        int getSectionIndex() const;
+        int getSectionCount() const;
+
+        // Store the complete engine state in 'state'.
+        void getState(mawb::EngineState &state) const;
+
+        // Store the engine's metrics (cycle times, xruns, allocations and
+        // memory use) in 'metrics'.
+        void getMetrics(mawb::Metrics &metrics) const;
+
         void store(std::ostream &out);
         void load(std::istream &in);
+
+        // Returns true if we're playing or recording.  Wave data can't be
+        // transferred while we're busy.
+        bool isBusy() const;
+
+        // Wave data transfer.  The data is in the format of Wave.data (see
+        // mawb.proto) and is transferred in pieces, so it never has to be
+        // held in memory all at once.  These all return false if the
+        // section or channel doesn't exist or if we're busy.
+
+        // Store the attributes of a channel's wave (everything but the data)
+        // in 'wave' and the size of its data in bytes in 'size'.
+        bool getWaveInfo(int section, int channel, mawb::Wave &wave,
+                         size_t &size
+                         );
+
+        // Append up to 'size' bytes of a channel's wave data, starting at
+        // byte 'offset', to 'out'.
+        bool readWaveData(int section, int channel, size_t offset,
+                          size_t size,
+                          std::string &out
+                          );
+
+        // Replace a channel's wave with an empty one that has the attributes
+        // of 'wave'.  'section' may be one past the last section, in which
+        // case a new section is added.  The change is applied by the audio
+        // thread, this blocks until it has been.
+        bool resetWave(int section, int channel, const mawb::Wave &wave);
+
+        // Write 'data' to a channel's wave data at byte 'offset'.
+        bool writeWaveData(int section, int channel, size_t offset,
+                           const std::string &data
+                           );
 };
 
 } // namespace awb
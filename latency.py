@@ -0,0 +1,220 @@
+"""Latency tracing for the MIDI path.
+
+A LatencyTracer records spans (a stage name, an optional label such as the
+name of a handler, and start and end times from time.perf_counter_ns()) into
+a preallocated ring buffer.  Recording a span doesn't allocate (other than
+the first time a stage/label pair is seen) and only holds an uncontended
+lock for a few stores, so it is cheap enough to leave on during a
+performance.
+
+Instrumented code holds an optional reference to a tracer and only records
+if it's not None, so tracing costs nothing but an attribute check when it's
+disabled.
+
+Spans can be summarized per stage and label (see getStats()) or exported as
+a Chrome trace (see exportChromeTrace()) for viewing in chrome://tracing or
+Perfetto.
+"""
+
+from array import array
+import json
+from threading import Lock
+from typing import Dict, IO, List, Optional, Tuple
+import time
+
+# Standard stage names used by AWBClient and amidi.
+
+# From the kernel timestamp of an incoming event to when we've read it.
+STAGE_INPUT = 'input'
+
+# An input processor.  Labeled with the processor.
+STAGE_PROCESS = 'process'
+
+# The dispatch handler.  Labeled with the handler.
+STAGE_DISPATCH = 'dispatch'
+
+# Sending an event to the sequencer (amidi.Sequencer.sendEvent()).
+STAGE_SEND = 'send'
+
+# From the kernel timestamp of an incoming event to the end of its dispatch.
+STAGE_END_TO_END = 'end-to-end'
+
+# Dispatch of a scheduled event, labeled with the handler.
+STAGE_SCHEDULED = 'scheduled'
+
+def getLabel(obj: object) -> str:
+    """Returns a readable label for a handler or processor."""
+    name = getattr(obj, '__qualname__', None)
+    if name is None:
+        name = type(obj).__name__
+    return name
+
+class StageStats:
+    """Summary statistics for a stage/label pair.  All times are in
+    microseconds.
+    """
+
+    def __init__(self, count: int, p50: float, p99: float, max: float):
+        self.count = count
+        self.p50 = p50
+        self.p99 = p99
+        self.max = max
+
+    def __repr__(self):
+        return 'StageStats(count=%d, p50=%.1f, p99=%.1f, max=%.1f)' % (
+            self.count, self.p50, self.p99, self.max
+        )
+
+class LatencyTracer:
+    """Records timing spans into a ring buffer.
+
+    Args:
+        capacity: The number of spans retained.  Once the buffer is full,
+            the oldest spans are overwritten.
+    """
+
+    def __init__(self, capacity: int = 65536):
+        self.capacity = capacity
+        self.__starts = array('q', [0]) * capacity
+        self.__ends = array('q', [0]) * capacity
+        self.__keys = array('i', [0]) * capacity
+
+        # Total number of spans recorded, the next slot is this modulo
+        # capacity.  Spans are recorded from several threads (midi input,
+        # midi output, the UI), so this and the slots are guarded by
+        # __lock.
+        self.__recorded = 0
+        self.__lock = Lock()
+
+        # Interned (stage, label) pairs.
+        self.__keyIds : Dict[Tuple[str, Optional[str]], int] = {}
+        self.__keyNames : List[Tuple[str, Optional[str]]] = []
+        self.__keyLock = Lock()
+
+    @staticmethod
+    def now() -> int:
+        return time.perf_counter_ns()
+
+    def __getKey(self, stage: str, label: Optional[str]) -> int:
+        pair = (stage, label)
+        key = self.__keyIds.get(pair)
+        if key is None:
+            with self.__keyLock:
+                key = self.__keyIds.get(pair)
+                if key is None:
+                    key = len(self.__keyNames)
+                    self.__keyNames.append(pair)
+                    self.__keyIds[pair] = key
+        return key
+
+    def record(self, stage: str, start: int, end: int,
+               label: Optional[str] = None
+               ) -> None:
+        """Record a span.
+
+        Args:
+            stage: The stage name (typically one of the STAGE_* constants).
+            start, end: Start and end times from time.perf_counter_ns().
+            label: An optional label to distinguish different handlers in the
+                same stage.
+        """
+        key = self.__getKey(stage, label)
+        with self.__lock:
+            slot = self.__recorded % self.capacity
+            self.__recorded += 1
+            self.__keys[slot] = key
+            self.__starts[slot] = start
+            self.__ends[slot] = end
+
+    def __len__(self):
+        return min(self.__recorded, self.capacity)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__recorded = 0
+
+    def getSpans(self) -> List[Tuple[str, Optional[str], int, int]]:
+        """Returns the retained spans as a list of
+        (stage, label, start, end), oldest first.
+        """
+        with self.__lock:
+            recorded = self.__recorded
+            keys = self.__keys[:]
+            starts = self.__starts[:]
+            ends = self.__ends[:]
+        size = min(recorded, self.capacity)
+        first = recorded - size
+        names = self.__keyNames
+        result = []
+        for i in range(first, recorded):
+            slot = i % self.capacity
+            stage, label = names[keys[slot]]
+            result.append((stage, label, starts[slot], ends[slot]))
+        return result
+
+    def getStats(self) -> Dict[Tuple[str, Optional[str]], StageStats]:
+        """Returns latency statistics for each stage/label pair.
+
+        Stats for a stage across all labels are keyed by (stage, None) for
+        stages that have labels.
+        """
+        durations : Dict[Tuple[str, Optional[str]], List[int]] = {}
+        for stage, label, start, end in self.getSpans():
+            durations.setdefault((stage, label), []).append(end - start)
+            if label is not None:
+                durations.setdefault((stage, None), []).append(end - start)
+
+        result = {}
+        for key, values in durations.items():
+            values.sort()
+            n = len(values)
+            result[key] = StageStats(n,
+                                     values[n // 2] / 1000,
+                                     values[min(n - 1, n * 99 // 100)] / 1000,
+                                     values[-1] / 1000
+                                     )
+        return result
+
+    def formatStats(self) -> str:
+        """Returns the stats formatted as a table."""
+        lines = ['%-40s %8s %10s %10s %10s' %
+                  ('stage', 'count', 'p50 us', 'p99 us', 'max us')
+                 ]
+        for (stage, label), stats in sorted(self.getStats().items(),
+                                            key=lambda x: (x[0][0],
+                                                           x[0][1] or '')
+                                            ):
+            name = stage if label is None else '  %s: %s' % (stage, label)
+            lines.append('%-40s %8d %10.1f %10.1f %10.1f' %
+                          (name, stats.count, stats.p50, stats.p99, stats.max)
+                         )
+        return '\n'.join(lines)
+
+    def exportChromeTrace(self, out: IO[str]) -> None:
+        """Write the retained spans to 'out' in Chrome trace event format
+        (loadable by chrome://tracing and Perfetto).
+
+        Each stage is shown as a separate thread.
+        """
+        stageIds : Dict[str, int] = {}
+        events = []
+        for stage, label, start, end in self.getSpans():
+            tid = stageIds.setdefault(stage, len(stageIds) + 1)
+            events.append({
+                'name': label or stage,
+                'cat': stage,
+                'ph': 'X',
+                'ts': start / 1000,
+                'dur': (end - start) / 1000,
+                'pid': 1,
+                'tid': tid,
+            })
+        for stage, tid in stageIds.items():
+            events.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': 1,
+                'tid': tid,
+                'args': {'name': stage},
+            })
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ns'}, out)
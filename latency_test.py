@@ -0,0 +1,81 @@
+
+from io import StringIO
+import json
+from threading import Thread
+from unittest import main, TestCase
+from latency import getLabel, LatencyTracer, STAGE_DISPATCH, STAGE_SEND
+
+class Handler:
+    def __call__(self, client, event):
+        pass
+
+class LatencyTracerTest(TestCase):
+
+    def testStats(self):
+        tracer = LatencyTracer(1000)
+        for i in range(100):
+            tracer.record(STAGE_SEND, 0, (i + 1) * 1000)
+            tracer.record(STAGE_DISPATCH, 0, 1000, 'a')
+            tracer.record(STAGE_DISPATCH, 0, 3000, 'b')
+        stats = tracer.getStats()
+        self.assertEqual(stats[STAGE_SEND, None].count, 100)
+        self.assertEqual(stats[STAGE_SEND, None].p50, 51)
+        self.assertEqual(stats[STAGE_SEND, None].p99, 100)
+        self.assertEqual(stats[STAGE_SEND, None].max, 100)
+        self.assertEqual(stats[STAGE_DISPATCH, 'a'].max, 1)
+        self.assertEqual(stats[STAGE_DISPATCH, 'b'].p50, 3)
+
+        # The overall dispatch stage includes all handlers.
+        self.assertEqual(stats[STAGE_DISPATCH, None].count, 200)
+        self.assertIn('dispatch: a', tracer.formatStats())
+
+    def testRingOverwritesOldest(self):
+        tracer = LatencyTracer(4)
+        for i in range(10):
+            tracer.record(STAGE_SEND, i, i + 1)
+        self.assertEqual(len(tracer), 4)
+        self.assertEqual([span[2] for span in tracer.getSpans()],
+                         [6, 7, 8, 9]
+                         )
+        tracer.clear()
+        self.assertEqual(tracer.getSpans(), [])
+
+    def testConcurrentRecorders(self):
+        tracer = LatencyTracer(100000)
+        def record(start):
+            for i in range(start, start + 10000):
+                tracer.record(STAGE_SEND, i, i + 1)
+        threads = [Thread(target=record, args=(i * 10000,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every span is retained exactly once.
+        self.assertEqual(len(tracer), 40000)
+        self.assertEqual(sorted(span[2] for span in tracer.getSpans()),
+                         list(range(40000))
+                         )
+
+    def testChromeTrace(self):
+        tracer = LatencyTracer(16)
+        tracer.record(STAGE_DISPATCH, 1000, 3000, 'handler')
+        tracer.record(STAGE_SEND, 1500, 2500)
+        out = StringIO()
+        tracer.exportChromeTrace(out)
+        events = json.loads(out.getvalue())['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X']
+        self.assertEqual(spans[0]['name'], 'handler')
+        self.assertEqual(spans[0]['ts'], 1)
+        self.assertEqual(spans[0]['dur'], 2)
+        self.assertEqual(spans[1]['name'], STAGE_SEND)
+        self.assertNotEqual(spans[0]['tid'], spans[1]['tid'])
+        names = {e['args']['name'] for e in events if e['ph'] == 'M'}
+        self.assertEqual(names, {STAGE_DISPATCH, STAGE_SEND})
+
+    def testGetLabel(self):
+        self.assertEqual(getLabel(Handler()), 'Handler')
+        self.assertEqual(getLabel(Handler.__call__), 'Handler.__call__')
+
+if __name__ == '__main__':
+    main()
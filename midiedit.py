@@ -493,9 +493,19 @@ class MidiEditToplevel(Toplevel):
 
 class AlsaAudioIFace(AudioIFace):
 
-    def __init__(self, seq: Sequencer, port: PortInfo, ppb: int):
+    def __init__(self, seq: Sequencer, port: PortInfo, ppb: int,
+                 queue: Optional[int] = None
+                 ):
+        """
+        Args:
+            queue: If provided, this is the real-time queue that the input
+                port timestamps events against.  Recorded events are placed
+                at the time they were received by the kernel rather than the
+                time that we got around to processing them.
+        """
         self.seq = seq
         self.port = port
+        self.__queue = queue
         self.__last_note = -1
         self.__pos = 0
         # Start ticks per sec as a bogus value, respond to a SetTempo event
@@ -558,8 +568,18 @@ class AlsaAudioIFace(AudioIFace):
 
                     # Process all input events.
                     if handles[0]:
+                        queue_now = None
+                        if self.__queue is not None:
+                            queue_now = self.seq.getQueueTime(self.__queue)
                         while self.seq.hasEvent():
                             ev = self.seq.getEvent(t)
+                            if queue_now is not None and \
+                               ev.timestamp is not None:
+                                # Back-date the event to when it arrived.
+                                ev.time = max(
+                                    0,
+                                    t - int((queue_now - ev.timestamp) * tps)
+                                )
                             if isinstance(ev,
                                           (NoteOn, NoteOff, ControlChange,
                                            ProgramChange, PitchWheel)
@@ -638,8 +658,10 @@ if __name__ == '__main__':
     tk.bind('<F2>', save)
     seq = Sequencer(SND_SEQ_OPEN_INPUT | SND_SEQ_OPEN_OUTPUT, 0, name='midiedit')
     port = seq.createOutputPort('out')
-    seq.createInputPort('in')
+    queue = seq.createQueue('midiedit')
+    seq.createInputPort('in', queue)
+    seq.startQueue(queue)
     print(f'ppqn = {track.ppqn}')
-    win = MidiEditor(tk, track, AlsaAudioIFace(seq, port, track.ppqn))
+    win = MidiEditor(tk, track, AlsaAudioIFace(seq, port, track.ppqn, queue))
     win.mainloop()
 
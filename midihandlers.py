@@ -1,6 +1,7 @@
 """Midi handlers.  Attach these to AWBClient's dispatchEvent."""
 
 import midi
+from pipeline import compileHandler, configChanged
 from typing import Callable, TypeAlias
 
 MidiHandler: TypeAlias = Callable['AWBClient', midi.Event]
@@ -18,6 +19,50 @@ class PassThrough(object):
     def __call__(self, client, event):
         client.seq.sendEvent(event, client.seq.getPort(self.dest))
 
+    def compileFor(self, client, eventType, channel, controller):
+        port = client.seq.getPort(self.dest)
+        if port is None:
+            # Port doesn't exist (yet), look it up on every event.
+            return self
+        send = client.seq.sendEvent
+        return lambda client, event: send(event, port)
+
+    def getForwardDest(self):
+        """Returns the name of the port that all events are forwarded to.
+
+        A PassThrough doesn't alter or filter events, so AWBClient can
+        replace it with a direct connection to this port.  Subclasses that
+        override __call__() or compileFor() aren't offloaded unless they
+        also define getForwardDest() (see the getForwardDest() function).
+        """
+        return self.dest
+
+# Methods that determine what a handler does with events.  A handler is only
+# a plain forward if these come from the same class as its getForwardDest().
+_DISPATCH_METHODS = ('__call__', 'compileFor')
+
+def getForwardDest(handler) -> str | None:
+    """Returns the destination port name if 'handler' is a plain forward of
+    all events to a single port, None if it does anything else.
+
+    Handlers opt in by defining getForwardDest().  A subclass that inherits
+    getForwardDest() but overrides __call__() or compileFor() may be
+    filtering or transforming events, so it doesn't count unless it defines
+    its own getForwardDest().
+    """
+    cls = type(handler)
+    owner = next((base for base in cls.__mro__
+                  if 'getForwardDest' in vars(base)
+                  ),
+                 None
+                 )
+    if owner is None:
+        return None
+    for name in _DISPATCH_METHODS:
+        if getattr(cls, name, None) is not getattr(owner, name, None):
+            return None
+    return handler.getForwardDest()
+
 class ChannelFilter(object):
     """A pass-through handler that changes the midi channel.
     """
@@ -32,10 +77,23 @@ class ChannelFilter(object):
 
     def __call__(self, client, event):
         if isinstance(event, midi.ChannelEvent):
-            print('changing channel to %d' % self.channel)
             event.channel = self.channel
         client.seq.sendEvent(event, client.seq.getPort(self.dest))
 
+    def compileFor(self, client, eventType, channel, controller):
+        port = client.seq.getPort(self.dest)
+        if port is None:
+            return self
+        send = client.seq.sendEvent
+        if not issubclass(eventType, midi.ChannelEvent):
+            return lambda client, event: send(event, port)
+
+        newChannel = self.channel
+        def sendOnChannel(client, event):
+            event.channel = newChannel
+            send(event, port)
+        return sendOnChannel
+
 class ProgramChangeControl(object):
     """A ControlChange handler that activates a program change."""
 
@@ -92,7 +150,16 @@ class ControlMap(object):
                 handler called for non-control events.
         """
         self.__map = {}
-        self.nonControlHandler = nonControlHandler
+        self.__nonControlHandler = nonControlHandler
+
+    @property
+    def nonControlHandler(self):
+        return self.__nonControlHandler
+
+    @nonControlHandler.setter
+    def nonControlHandler(self, handler):
+        self.__nonControlHandler = handler
+        configChanged()
 
     def addControlHandler(self, controller, handler):
         """Adds a handler for a midi controller.
@@ -103,6 +170,7 @@ class ControlMap(object):
                 attach to the control.
         """
         self.__map[controller] = handler
+        configChanged()
 
     def __call__(self, client, event):
         if isinstance(event, midi.ControlChange):
@@ -111,8 +179,17 @@ class ControlMap(object):
                 handler(client, event)
                 return
 
-        elif self.nonControlHandler:
-            self.nonControlHandler(client, event)
+        elif self.__nonControlHandler:
+            self.__nonControlHandler(client, event)
+
+    def compileFor(self, client, eventType, channel, controller):
+        if issubclass(eventType, midi.ControlChange):
+            handler = self.__map.get(controller)
+        else:
+            handler = self.__nonControlHandler
+        return compileHandler(handler, client,
+                              (eventType, channel, controller)
+                              )
 
 class EventLogger(MidiHandler):
     """Logs (prints) a midi event and optionally sends it to the next handler
@@ -126,3 +203,13 @@ class EventLogger(MidiHandler):
         print(event)
         if self.next:
             self.next(client, event)
+
+    def compileFor(self, client, eventType, channel, controller):
+        next = compileHandler(self.next, client,
+                              (eventType, channel, controller)
+                              )
+        def log(client, event):
+            print(event)
+            if next:
+                next(client, event)
+        return log
@@ -57,8 +57,21 @@ class MidiState(SubState):
 class Route(object):
     __metaclass__ = ABCMeta
 
+    def getTopology(self, client):
+        """Returns a view of the system's connections that is passed to
+        getCurrentOutbounds(), disconnect() and connect().
+
+        Routing.activate() gets this once per type of route and shares it
+        across all of the routes of that type.  The default is None, for
+        routes that query the system directly.
+
+        parms:
+            client: [awb_client.Client]
+        """
+        return None
+
     @abstractmethod
-    def getCurrentOutbounds(self, client):
+    def getCurrentOutbounds(self, client, topology=None):
         """Returns the list of all outbound connections from the source port
         as a list of keys.
 
@@ -66,6 +79,7 @@ class Route(object):
 
         parms:
             client: [awb_client.Client]
+            topology: [object] As returned from getTopology().
         """
 
     @abstractmethod
@@ -77,7 +91,7 @@ class Route(object):
         """Returns the destination key for a given connection."""
 
     @abstractmethod
-    def disconnect(self, client, destKey):
+    def disconnect(self, client, destKey, topology=None):
         """Remove the system connection from the source port to the
         destination key.
 
@@ -85,14 +99,16 @@ class Route(object):
             client: [awb_client.Client] See getCurrentOutbounds.
             destKey: [object] A key compatible with that returned from
                 getDestKey().
+            topology: [object] See getCurrentOutbounds.
         """
 
     @abstractmethod
-    def connect(self, client):
+    def connect(self, client, topology=None):
         """Connect the route.
 
         Args:
             client: [awb_client.Client] See getCurrentOutbounds.
+            topology: [object] See getCurrentOutbounds.
         """
 
     @abstractmethod
@@ -125,32 +141,49 @@ class RouteImpl(Route):
             self.dst == other.dst
 
 class MidiRoute(RouteImpl):
+    """A route between two ALSA midi ports.
 
-    def getCurrentOutbounds(self, client):
-        port = client.seq.getPort(self.src)
-        return [str(sub) for sub in client.seq.iterSubs(port)]
+    Ports are looked up in a topology snapshot (see amidi.Sequencer.snapshot)
+    rather than by walking the live port list.  If no snapshot is passed in,
+    each call takes its own.
+    """
 
-    def disconnect(self, client, destKey):
-        client.seq.disconnect(client.seq.getPort(self.src),
-                              client.seq.getPort(destKey)
+    def getTopology(self, client):
+        return client.seq.snapshot()
+
+    def getCurrentOutbounds(self, client, topology=None):
+        if topology is None:
+            topology = client.seq.snapshot()
+        port = topology.getPort(self.src)
+        if port is None:
+            return []
+        return [str(sub) for sub in topology.subscribersOf(port)]
+
+    def disconnect(self, client, destKey, topology=None):
+        if topology is None:
+            topology = client.seq.snapshot()
+        client.seq.disconnect(topology.getPort(self.src),
+                              topology.getPort(destKey)
                               )
 
-    def connect(self, client):
-        client.seq.connect(client.seq.getPort(self.src),
-                           client.seq.getPort(self.dst)
+    def connect(self, client, topology=None):
+        if topology is None:
+            topology = client.seq.snapshot()
+        client.seq.connect(topology.getPort(self.src),
+                           topology.getPort(self.dst)
                            )
 
 class JackRoute(RouteImpl):
 
-    def getCurrentOutbounds(self, client):
+    def getCurrentOutbounds(self, client, topology=None):
         return [
             port.name for port in client.jack.get_all_connections(self.src)
         ]
 
-    def disconnect(self, client, destKey):
+    def disconnect(self, client, destKey, topology=None):
         client.jack.disconnect(self.src, destKey)
 
-    def connect(self, client):
+    def connect(self, client, topology=None):
         client.jack.connect(self.src, self.dst)
 
 class Routing(SubState):
@@ -181,10 +214,20 @@ class Routing(SubState):
         for route in self.routes:
             routesBySource[route.getSourceKey()].append(route)
 
+        # Topologies by route type, see Route.getTopology().  We only take one
+        # of each per activation: the routes for a source only change that
+        # source's connections, so the topology is still accurate for all of
+        # the sources that we haven't processed yet.
+        topologies = {}
+
         # Go through the source ports, remove all existing connections that
         # aren't in the new connections and add all new connections that aren't
         # in the existing connections.
         for routes in routesBySource.values():
+            routeType = type(routes[0])
+            if routeType not in topologies:
+                topologies[routeType] = routes[0].getTopology(client)
+            topology = topologies[routeType]
 
             # Convert the routes to a map indexed by destination ports.
             routeMap = dict((route.getDestKey(), route) for route in routes)
@@ -192,19 +235,19 @@ class Routing(SubState):
             # Go through the existing outbound connections, remove the ones
             # that aren't in the set of desired routes and remove the ones
             # that are from the set of routes that we need to connect.
-            for dest in routes[0].getCurrentOutbounds(client):
+            for dest in routes[0].getCurrentOutbounds(client, topology):
                 try:
                     del routeMap[dest]
                 except KeyError:
                     # We don't want to preserve this connection.  Remove it.
-                    routes[0].disconnect(client, dest)
+                    routes[0].disconnect(client, dest, topology)
 
             # connect everything remaining in the routeMap (only the
             # connections that we want but don't currently exist should
             # remain).
             for route in routeMap.values():
                 try:
-                    route.connect(client)
+                    route.connect(client, topology)
                 except Exception as ex:
                     print('error connecting %s: %s' % (route, ex))
 
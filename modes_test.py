@@ -24,6 +24,7 @@ class FakeSequencer(object):
 
     def __init__(self):
         self.events = []
+        self.snapshots = 0
 
     def sendEvent(self, event, port):
         self.events.append((event, port))
@@ -34,6 +35,14 @@ class FakeSequencer(object):
     def iterSubs(self, port):
         return [1, 2, 3]
 
+    # The fake sequencer doubles as its own topology snapshot.
+    def snapshot(self):
+        self.snapshots += 1
+        return self
+
+    def subscribersOf(self, port):
+        return [1, 2, 3]
+
     def disconnect(self, port1, port2):
         self.events.append('disconnect %s, %s' % (port1, port2))
 
@@ -109,13 +118,13 @@ class StateVecTest(TestCase):
 
 class FakeRoute(RouteImpl):
 
-    def getCurrentOutbounds(self, client):
+    def getCurrentOutbounds(self, client, topology=None):
         return ['foo', 'bar']
 
-    def disconnect(self, client, destKey):
+    def disconnect(self, client, destKey, topology=None):
         client.collector.append('disconnect %s, %s' % (self.src, destKey))
 
-    def connect(self, client):
+    def connect(self, client, topology=None):
         client.collector.append('connect %s, %s' % (self.src, self.dst))
 
 class RoutingTest(TestCase):
@@ -162,6 +171,23 @@ class RoutingTest(TestCase):
         route.connect(client)
         self.assertEqual(seq.events, ['connect a, b'])
 
+    def testMidiRoutingTakesOneSnapshot(self):
+        seq = FakeSequencer()
+        client = FakeClient(seq)
+        Routing(MidiRoute('a', 'b'),
+                MidiRoute('c', 'd'),
+                MidiRoute('e', '1')
+                ).activate(client)
+        self.assertEqual(seq.snapshots, 1)
+        self.assertEqual(seq.events,
+                         ['disconnect a, 1', 'disconnect a, 2',
+                          'disconnect a, 3', 'connect a, b',
+                          'disconnect c, 1', 'disconnect c, 2',
+                          'disconnect c, 3', 'connect c, d',
+                          'disconnect e, 2', 'disconnect e, 3'
+                          ]
+                         )
+
     def testJackRoutes(self):
         client = FakeClient(FakeSequencer())
         client.jack = FakeJack()
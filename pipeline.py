@@ -0,0 +1,145 @@
+"""Compiled midi dispatch pipeline.
+
+Incoming events normally walk AWBClient.inputProcessors and then a chain of
+midi handlers (e.g. ControlMap -> ChannelFilter -> PassThrough), each doing
+its own type checks and port lookups for every event.  The Pipeline
+compiles the handler chain into a dispatch table keyed by
+(event type, channel, controller): each entry is a single callable that
+does exactly what the chain would do for events with that key, with
+destination ports resolved up front.
+
+Input processors are free to change the event, so they are run first and
+the key is taken from the event they leave behind.
+
+Table entries are compiled lazily the first time an event with a given
+key is seen and are thrown away whenever the configuration changes.
+
+Handlers take part in compilation by defining a method:
+
+    compileFor(client, eventType, channel, controller)
+
+which returns the callable to use for events with that key, or None if
+such events are dropped.  Handlers without a compileFor() method are used
+as-is.  Handlers that change their configuration after construction (for
+example, ControlMap.addControlHandler()) must call configChanged().
+"""
+
+import midi
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+# Dispatch table key: (event type, channel, controller).  Channel is None for
+# non-channel events and controller is None for everything other than
+# control changes.
+EventKey = Tuple[type, Optional[int], Optional[int]]
+
+# A compiled action, called with the client and the event.
+Action = Callable[[Any, midi.Event], None]
+
+# Incremented whenever the configuration of any handler changes.
+_configVersion = 0
+
+def configChanged() -> None:
+    """Notify all pipelines that some handler's configuration has changed.
+
+    This causes them to recompile their dispatch tables.
+    """
+    global _configVersion
+    _configVersion += 1
+
+# Maps event types to the kind of key they get: 0 = type only, 1 = type and
+# channel, 2 = type, channel and controller.
+_keyKinds : Dict[type, int] = {}
+
+def getEventKey(event: midi.Event) -> EventKey:
+    """Returns the dispatch table key for an event."""
+    cls = event.__class__
+    kind = _keyKinds.get(cls)
+    if kind is None:
+        if issubclass(cls, midi.ControlChange):
+            kind = 2
+        elif issubclass(cls, midi.ChannelEvent):
+            kind = 1
+        else:
+            kind = 0
+        _keyKinds[cls] = kind
+    if kind == 2:
+        return cls, event.channel, event.controller
+    elif kind == 1:
+        return cls, event.channel, None
+    else:
+        return cls, None, None
+
+def compileHandler(handler: Optional[Callable], client: Any,
+                   key: EventKey
+                   ) -> Optional[Action]:
+    """Returns the compiled action for 'handler' for events matching 'key'.
+
+    Returns None if the handler drops events with that key.
+    """
+    if handler is None:
+        return None
+    compileFor = getattr(handler, 'compileFor', None)
+    if compileFor is None:
+        return handler
+    return compileFor(client, *key)
+
+class Pipeline:
+    """Dispatches events through a compiled set of input processors and a
+    handler.
+
+    Args:
+        client: The AWBClient that is passed to processors and handlers.
+    """
+
+    def __init__(self, client: Any):
+        self.__client = client
+        self.__processors : Tuple[Callable[[Any, midi.Event], bool], ...] = ()
+        self.__handler : Optional[Callable] = None
+
+        # Compiled handler actions.
+        self.__handlerTable : Dict[EventKey, Optional[Action]] = {}
+        self.__version = _configVersion
+
+    def configure(self, processors: Sequence[Callable[[Any, midi.Event], bool]],
+                  handler: Optional[Callable]
+                  ) -> None:
+        """Set the input processors and handler to compile."""
+        self.__processors = tuple(processors)
+        self.__handler = handler
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """Discard all compiled actions.
+
+        This should be called when the ports that handlers send to are
+        created or destroyed.
+        """
+        self.__version = _configVersion
+        self.__handlerTable = {}
+
+    @property
+    def processors(self) -> Tuple[Callable[[Any, midi.Event], bool], ...]:
+        """The input processors that dispatchInput() applies."""
+        return self.__processors
+
+    def dispatchInput(self, event: midi.Event) -> None:
+        """Dispatch an incoming event through the processors and handler."""
+        client = self.__client
+        for proc in self.__processors:
+            if proc(client, event):
+                return
+        self.dispatch(event)
+
+    def dispatch(self, event: midi.Event) -> None:
+        """Dispatch an event directly to the handler."""
+        if self.__version != _configVersion:
+            self.invalidate()
+        table = self.__handlerTable
+        key = getEventKey(event)
+        try:
+            action = table[key]
+        except KeyError:
+            action = table[key] = \
+                compileHandler(self.__handler, self.__client, key)
+        if action is not None:
+            action(self.__client, event)
@@ -0,0 +1,119 @@
+
+from unittest import main, TestCase
+from midi import ControlChange, NoteOn, SysStart
+from midihandlers import ChannelFilter, ControlMap, EventLogger, PassThrough
+from pipeline import getEventKey, Pipeline
+
+class FakeSequencer:
+
+    def __init__(self):
+        self.ports = {'synth/in': 'synth-port', 'drums/in': 'drums-port'}
+        self.lookups = 0
+        self.sent = []
+
+    def getPort(self, name):
+        self.lookups += 1
+        return self.ports.get(name)
+
+    def sendEvent(self, event, port):
+        self.sent.append((event, port))
+
+class FakeClient:
+
+    def __init__(self):
+        self.seq = FakeSequencer()
+
+class PipelineTest(TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.pipeline = Pipeline(self.client)
+        self.controls = []
+        self.handler = ControlMap(ChannelFilter('synth/in', 3))
+        self.handler.addControlHandler(
+            7, lambda client, event: self.controls.append(event)
+        )
+        self.pipeline.configure([], self.handler)
+
+    def testEventKey(self):
+        self.assertEqual(getEventKey(NoteOn(0, 2, 60, 100)), (NoteOn, 2, None))
+        self.assertEqual(getEventKey(ControlChange(0, 1, 7, 100)),
+                         (ControlChange, 1, 7)
+                         )
+        self.assertEqual(getEventKey(SysStart(0)), (SysStart, None, None))
+
+    def testDispatch(self):
+        note = NoteOn(0, 0, 60, 100)
+        volume = ControlChange(0, 0, 7, 100)
+        unmapped = ControlChange(0, 0, 1, 100)
+        self.pipeline.dispatchInput(note)
+        self.pipeline.dispatchInput(volume)
+        self.pipeline.dispatchInput(unmapped)
+        self.assertEqual(self.client.seq.sent, [(note, 'synth-port')])
+        self.assertEqual(note.channel, 3)
+        self.assertEqual(self.controls, [volume])
+
+    def testPortsResolvedOnce(self):
+        for i in range(10):
+            self.pipeline.dispatchInput(NoteOn(0, 0, 60, 100))
+        self.assertEqual(self.client.seq.lookups, 1)
+        self.assertEqual(len(self.client.seq.sent), 10)
+
+    def testMissingPortIsLookedUpEachTime(self):
+        self.pipeline.configure([], PassThrough('late/in'))
+        self.pipeline.dispatchInput(NoteOn(0, 0, 60, 100))
+        self.client.seq.ports['late/in'] = 'late-port'
+        self.pipeline.dispatchInput(NoteOn(0, 0, 60, 100))
+        self.assertEqual(self.client.seq.sent[-1][1], 'late-port')
+
+    def testProcessors(self):
+        def consumeNotes(client, event):
+            return isinstance(event, NoteOn)
+        self.pipeline.configure([consumeNotes], self.handler)
+        self.pipeline.dispatchInput(NoteOn(0, 0, 60, 100))
+        self.assertEqual(self.client.seq.sent, [])
+
+        # Processors aren't applied to direct dispatch.
+        self.pipeline.dispatch(NoteOn(0, 0, 60, 100))
+        self.assertEqual(len(self.client.seq.sent), 1)
+
+    def testProcessorsCanChangeTheKey(self):
+        # A processor that turns modulation into volume.
+        def remap(client, event):
+            if isinstance(event, ControlChange) and event.controller == 1:
+                event.controller = 7
+        self.pipeline.configure([remap], self.handler)
+        modulation = ControlChange(0, 0, 1, 100)
+        self.pipeline.dispatchInput(modulation)
+        self.assertEqual(self.controls, [modulation])
+        self.assertEqual(self.client.seq.sent, [])
+
+    def testRebuildOnConfigChange(self):
+        volume = ControlChange(0, 0, 7, 100)
+        self.pipeline.dispatchInput(volume)
+        self.assertEqual(self.controls, [volume])
+
+        # Rebinding the controller must be seen by the compiled table.
+        self.handler.addControlHandler(7, PassThrough('drums/in'))
+        self.pipeline.dispatchInput(volume)
+        self.assertEqual(self.controls, [volume])
+        self.assertEqual(self.client.seq.sent, [(volume, 'drums-port')])
+
+    def testUncompilableHandler(self):
+        received = []
+        self.pipeline.configure(
+            [], EventLogger(lambda client, event: received.append(event))
+        )
+        note = NoteOn(0, 0, 60, 100)
+        self.pipeline.dispatchInput(note)
+        self.assertEqual(received, [note])
+
+    def testInvalidate(self):
+        self.pipeline.dispatchInput(NoteOn(0, 0, 60, 100))
+        self.client.seq.ports['synth/in'] = 'new-synth-port'
+        self.pipeline.invalidate()
+        self.pipeline.dispatchInput(NoteOn(0, 0, 60, 100))
+        self.assertEqual(self.client.seq.sent[-1][1], 'new-synth-port')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""Plugin discovery and concurrent initialization.
+
+Plugins that start synths or load samples can take a long time to
+initialize, so we initialize them on a pool of worker threads.  A plugin can
+declare the plugins that must be initialized before it in its "requires"
+class attribute, initialization of a plugin starts as soon as everything it
+requires has finished.
+
+Plugins are identified by name, which is the name of the module in the
+plugins package that they were loaded from (e.g. the plugin class in
+"plugins/fluidsynth.py" is named "fluidsynth").
+"""
+
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from importlib import import_module
+import os
+import time
+from typing import Any, Callable, List, Optional, Sequence, Set, Tuple
+
+class PluginIndex:
+    """A cached index of the plugins available in a directory.
+
+    The directory is only re-listed when its modification time changes, so
+    getNames() is cheap enough to call whenever a UI needs it.
+    """
+
+    def __init__(self, directory: str = 'plugins'):
+        self.directory = directory
+        self.__mtime : Optional[int] = None
+        self.__names : List[str] = []
+
+    def getNames(self) -> List[str]:
+        """Returns the sorted names of all of the plugins in the directory.
+        """
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            self.__mtime = None
+            return []
+        if mtime != self.__mtime:
+            self.__names = sorted(
+                entry.name[:-3] for entry in os.scandir(self.directory)
+                if entry.name.endswith('.py') and entry.name != '__init__.py'
+            )
+            self.__mtime = mtime
+        return list(self.__names)
+
+    def invalidate(self) -> None:
+        """Force the directory to be re-listed on the next getNames()."""
+        self.__mtime = None
+
+def getPluginName(plugin: Any) -> str:
+    """Returns the name of a plugin object (the last component of its
+    module name).
+    """
+    return type(plugin).__module__.rpartition('.')[2]
+
+class DependencyError(Exception):
+    """Raised for plugins with circular dependencies, and stored as the
+    error of plugins that weren't initialized because a plugin that they
+    require failed.
+    """
+
+@dataclass
+class PluginTiming:
+    """Startup timing for a single plugin.
+
+    Attrs:
+        name: Plugin name.
+        start: Seconds from the start of the run until the plugin's init
+            started.
+        end: Seconds from the start of the run until the plugin's init
+            finished.
+        importTime: Seconds spent importing the plugin module, zero if the
+            plugin was already loaded.
+        error: The exception raised by the plugin, if any.
+    """
+    name: str
+    start: float = 0.0
+    end: float = 0.0
+    importTime: float = 0.0
+    error: Optional[BaseException] = None
+
+    @property
+    def initTime(self) -> float:
+        return self.end - self.start
+
+@dataclass
+class PluginStartupReport:
+    """Results of initPlugins() and loadPlugins().
+
+    Attrs:
+        timings: Per-plugin timings, in the order the plugins were given.
+        totalTime: Seconds until all plugins were initialized.
+    """
+    timings: List[PluginTiming] = field(default_factory=list)
+    totalTime: float = 0.0
+
+    def getErrors(self) -> List[PluginTiming]:
+        """Returns the timings of all plugins that failed."""
+        return [timing for timing in self.timings if timing.error]
+
+    def getSlowest(self, count: int = 5) -> List[PluginTiming]:
+        """Returns the 'count' plugins that took longest to start."""
+        return sorted(self.timings,
+                      key=lambda timing: timing.importTime + timing.initTime,
+                      reverse=True
+                      )[:count]
+
+    def __str__(self):
+        lines = ['plugins started in %.3fs' % self.totalTime]
+        for timing in self.getSlowest(len(self.timings)):
+            lines.append('  %s: import %.3fs, init %.3fs (%.3fs - %.3fs)%s' % (
+                timing.name, timing.importTime, timing.initTime,
+                timing.start, timing.end,
+                ', failed: %s' % timing.error if timing.error else ''
+            ))
+        return '\n'.join(lines)
+
+class PluginStartupError(Exception):
+    """Raised when some plugins failed to initialize.
+
+    Attrs:
+        report: [PluginStartupReport] The startup report, the failed
+            plugins are the ones with an error.
+    """
+
+    def __init__(self, report: PluginStartupReport):
+        super().__init__('; '.join('%s: %s' % (timing.name, timing.error)
+                                   for timing in report.getErrors()
+                                   ))
+        self.report = report
+
+def _getDependencies(plugins: Sequence[Any]) -> List[Set[int]]:
+    """Returns the indexes of the plugins that each plugin requires.
+
+    Requirements that aren't in 'plugins' are ignored, they're assumed to
+    have been initialized already.
+
+    Raises:
+        DependencyError: if there are circular dependencies.
+    """
+    indexes = defaultdict(list)
+    for i, plugin in enumerate(plugins):
+        indexes[getPluginName(plugin)].append(i)
+    deps = [{j for name in getattr(plugin, 'requires', ())
+             for j in indexes.get(name, ()) if j != i
+             }
+            for i, plugin in enumerate(plugins)
+            ]
+
+    # Check for cycles by repeatedly removing plugins with no outstanding
+    # dependencies.
+    remaining = {i: set(d) for i, d in enumerate(deps)}
+    while remaining:
+        ready = [i for i, d in remaining.items() if not d]
+        if not ready:
+            raise DependencyError(
+                'Circular plugin dependencies: %s' %
+                ', '.join(sorted(getPluginName(plugins[i])
+                                 for i in remaining
+                                 ))
+            )
+        for i in ready:
+            del remaining[i]
+        for d in remaining.values():
+            d.difference_update(ready)
+    return deps
+
+def initPlugins(plugins: Sequence[Any], init: Callable[[Any], None],
+                maxWorkers: Optional[int] = None
+                ) -> PluginStartupReport:
+    """Initialize 'plugins' concurrently, honoring their dependencies.
+
+    'init' is called for each plugin on a worker thread, so plugins must not
+    touch the UI from their init methods.  A plugin that raises doesn't
+    stop the others, its exception is recorded in the report and plugins
+    that require it are not initialized.
+
+    Args:
+        plugins: The plugins to initialize.
+        init: Function to initialize a single plugin.
+        maxWorkers: Size of the worker pool, defaults to the
+            ThreadPoolExecutor default.
+
+    Raises:
+        DependencyError: if there are circular dependencies (nothing is
+            initialized in this case).
+    """
+    deps = _getDependencies(plugins)
+    start = time.perf_counter()
+    report = PluginStartupReport([PluginTiming(getPluginName(plugin))
+                                  for plugin in plugins
+                                  ])
+    dependents = defaultdict(list)
+    for i, d in enumerate(deps):
+        for j in d:
+            dependents[j].append(i)
+
+    def run(i: int) -> None:
+        timing = report.timings[i]
+        timing.start = time.perf_counter() - start
+        try:
+            init(plugins[i])
+        except Exception as ex:
+            timing.error = ex
+        timing.end = time.perf_counter() - start
+
+    with ThreadPoolExecutor(maxWorkers,
+                            thread_name_prefix='plugin-init'
+                            ) as pool:
+        futures = {}
+        def finished(i: int) -> None:
+            error = report.timings[i].error
+            for j in dependents[i]:
+                if report.timings[j].error:
+                    # Already failed because of another requirement.
+                    continue
+                if error:
+                    report.timings[j].error = DependencyError(
+                        'requires failed plugin %s' % report.timings[i].name
+                    )
+                    finished(j)
+                else:
+                    deps[j].discard(i)
+                    if not deps[j]:
+                        futures[pool.submit(run, j)] = j
+
+        for i, d in enumerate(deps):
+            if not d:
+                futures[pool.submit(run, i)] = i
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                finished(futures.pop(future))
+
+    report.totalTime = time.perf_counter() - start
+    return report
+
+def loadPlugins(names: Sequence[str], init: Callable[[Any], None],
+                package: str = 'plugins',
+                maxWorkers: Optional[int] = None
+                ) -> Tuple[List[Any], PluginStartupReport]:
+    """Import, create and initialize the named plugins.
+
+    The plugin modules are imported concurrently, then the plugins are
+    initialized as with initPlugins().
+
+    Returns the plugins that were successfully created and initialized,
+    and the startup report for all of them.
+    """
+    start = time.perf_counter()
+
+    def create(name: str) -> Tuple[Any, PluginTiming]:
+        timing = PluginTiming(name)
+        t = time.perf_counter()
+        try:
+            mod = import_module(package + '.' + name)
+            pluginClass = getattr(mod, 'Plugin', None)
+            if not pluginClass:
+                raise Exception('No plugin class found in %s' % name)
+            return pluginClass(), timing
+        except Exception as ex:
+            timing.error = ex
+            return None, timing
+        finally:
+            timing.importTime = time.perf_counter() - t
+
+    with ThreadPoolExecutor(maxWorkers,
+                            thread_name_prefix='plugin-import'
+                            ) as pool:
+        created = list(pool.map(create, names))
+
+    plugins = [plugin for plugin, timing in created if plugin is not None]
+    initStart = time.perf_counter() - start
+    initReport = initPlugins(plugins, init, maxWorkers)
+    initTimings = iter(initReport.timings)
+
+    report = PluginStartupReport()
+    for plugin, timing in created:
+        if plugin is not None:
+            initTiming = next(initTimings)
+            timing.start = initTiming.start + initStart
+            timing.end = initTiming.end + initStart
+            timing.error = initTiming.error
+        report.timings.append(timing)
+    report.totalTime = time.perf_counter() - start
+    return ([plugin for plugin, timing in zip(plugins, initReport.timings)
+             if not timing.error
+             ],
+            report
+            )
@@ -0,0 +1,149 @@
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import main, TestCase
+from pluginloader import DependencyError, getPluginName, initPlugins, \
+    loadPlugins, PluginIndex, PluginStartupError
+
+def makePlugin(name, requires=(), delay=0.0, fail=False):
+    """Returns a plugin instance whose name (module) is 'name'."""
+    def init(self, log):
+        log.append(('start', name))
+        time.sleep(delay)
+        if fail:
+            raise Exception('%s failed' % name)
+        log.append(('end', name))
+    cls = type('Plugin', (), {'requires': requires, 'init': init,
+                              '__module__': 'plugins.' + name
+                              }
+               )
+    return cls()
+
+class InitPluginsTest(TestCase):
+
+    def testPluginName(self):
+        self.assertEqual(getPluginName(makePlugin('synth')), 'synth')
+
+    def testConcurrent(self):
+        log = []
+        plugins = [makePlugin('p%d' % i, delay=0.2) for i in range(4)]
+        report = initPlugins(plugins, lambda plugin: plugin.init(log))
+        self.assertLess(report.totalTime, 0.6)
+        self.assertEqual(len(log), 8)
+        self.assertEqual([timing.name for timing in report.timings],
+                         ['p0', 'p1', 'p2', 'p3']
+                         )
+        for timing in report.timings:
+            self.assertGreaterEqual(timing.initTime, 0.19)
+
+    def testDependencies(self):
+        log = []
+        plugins = [
+            makePlugin('mixer', requires=('synth', 'sampler')),
+            makePlugin('synth', delay=0.1),
+            makePlugin('sampler', delay=0.05),
+            makePlugin('external', requires=('notloaded',)),
+        ]
+        report = initPlugins(plugins, lambda plugin: plugin.init(log))
+        self.assertLess(log.index(('end', 'synth')),
+                        log.index(('start', 'mixer'))
+                        )
+        self.assertLess(log.index(('end', 'sampler')),
+                        log.index(('start', 'mixer'))
+                        )
+        self.assertIn(('end', 'external'), log)
+        self.assertEqual(report.getErrors(), [])
+
+    def testFailure(self):
+        log = []
+        plugins = [
+            makePlugin('synth', fail=True),
+            makePlugin('mixer', requires=('synth',)),
+            makePlugin('recorder', requires=('mixer',)),
+            makePlugin('other'),
+        ]
+        report = initPlugins(plugins, lambda plugin: plugin.init(log))
+        self.assertEqual([timing.name for timing in report.getErrors()],
+                         ['synth', 'mixer', 'recorder']
+                         )
+        self.assertIsInstance(report.timings[2].error, DependencyError)
+        self.assertNotIn(('start', 'mixer'), log)
+        self.assertIn(('end', 'other'), log)
+
+        error = PluginStartupError(report)
+        self.assertIs(error.report, report)
+        self.assertIn('synth failed', str(error))
+        self.assertNotIn('other', str(error))
+
+    def testCycle(self):
+        log = []
+        plugins = [makePlugin('a', requires=('b',)),
+                   makePlugin('b', requires=('a',)),
+                   makePlugin('c')
+                   ]
+        with self.assertRaises(DependencyError):
+            initPlugins(plugins, lambda plugin: plugin.init(log))
+        self.assertEqual(log, [])
+
+    def testReport(self):
+        plugins = [makePlugin('fast'), makePlugin('slow', delay=0.1)]
+        report = initPlugins(plugins, lambda plugin: plugin.init([]))
+        self.assertEqual(report.getSlowest(1)[0].name, 'slow')
+        self.assertIn('slow', str(report))
+
+class LoadPluginsTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.package = 'testplugins%d' % id(self)
+        self.pluginDir = os.path.join(self.dir, self.package)
+        os.mkdir(self.pluginDir)
+        open(os.path.join(self.pluginDir, '__init__.py'), 'w').close()
+        sys.path.insert(0, self.dir)
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        shutil.rmtree(self.dir)
+
+    def writePlugin(self, name, source):
+        with open(os.path.join(self.pluginDir, name + '.py'), 'w') as out:
+            out.write(source)
+
+    def testIndex(self):
+        index = PluginIndex(self.pluginDir)
+        self.writePlugin('a', '')
+        self.assertEqual(index.getNames(), ['a'])
+        self.writePlugin('b', '')
+
+        # Make sure the directory mtime changes even on coarse filesystems.
+        stat = os.stat(self.pluginDir)
+        os.utime(self.pluginDir, ns=(stat.st_atime_ns,
+                                     stat.st_mtime_ns + 1000000000
+                                     ))
+        self.assertEqual(index.getNames(), ['a', 'b'])
+        self.assertEqual(PluginIndex(os.path.join(self.dir, 'gone')).getNames(),
+                         []
+                         )
+
+    def testLoad(self):
+        self.writePlugin('good', 'class Plugin:\n'
+                                 '    def init(self, log): log.append(1)\n'
+                         )
+        self.writePlugin('noclass', '')
+        log = []
+        plugins, report = loadPlugins(['good', 'noclass', 'missing'],
+                                      lambda plugin: plugin.init(log),
+                                      package=self.package
+                                      )
+        self.assertEqual(len(plugins), 1)
+        self.assertEqual(log, [1])
+        self.assertEqual([timing.name for timing in report.getErrors()],
+                         ['noclass', 'missing']
+                         )
+        self.assertGreater(report.timings[0].importTime, 0)
+
+if __name__ == '__main__':
+    main()
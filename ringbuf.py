@@ -0,0 +1,92 @@
+"""Byte buffers for framed stream I/O.
+
+ByteRing is a FIFO byte buffer backed by a single bytearray.  Data is
+appended at the tail and consumed from the head without copying what
+remains (as slicing bytes objects would).  Rather than wrapping around, the
+unconsumed data is moved back to the front of the buffer when we run out
+of room at the end, so readers always get a contiguous memoryview that can
+be parsed in place.  When the buffer is drained (the usual case after
+parsing everything we've read) the head and tail just reset to zero.
+"""
+
+class ByteRing:
+    """A FIFO byte buffer.
+
+    Memoryviews returned by view() and reserve() are only valid until the
+    next call to write() or reserve().
+
+    Args:
+        capacity: Initial capacity, the buffer grows as needed.
+    """
+
+    def __init__(self, capacity: int = 65536):
+        self.__buf = bytearray(capacity)
+        self.__head = 0
+        self.__tail = 0
+
+    def __len__(self):
+        return self.__tail - self.__head
+
+    def __bool__(self):
+        return self.__tail != self.__head
+
+    @property
+    def capacity(self) -> int:
+        return len(self.__buf)
+
+    def __makeRoom(self, size: int) -> None:
+        """Make sure there are at least 'size' free bytes after the tail."""
+        buf = self.__buf
+        if self.__tail + size <= len(buf):
+            return
+        used = self.__tail - self.__head
+        if used + size <= len(buf):
+            # Move the unconsumed data to the front.  This is a same-size
+            # slice assignment, so it's allowed even if there are exported
+            # views of the buffer.
+            buf[:used] = buf[self.__head:self.__tail]
+        else:
+            # Grow into a new buffer (we can't resize the old one in place
+            # if a caller still holds a view of it).
+            newBuf = bytearray(max(len(buf) * 2, used + size))
+            newBuf[:used] = buf[self.__head:self.__tail]
+            self.__buf = newBuf
+        self.__head = 0
+        self.__tail = used
+
+    def write(self, data) -> None:
+        """Append 'data' (any bytes-like object) to the buffer."""
+        size = len(data)
+        self.__makeRoom(size)
+        tail = self.__tail
+        self.__buf[tail:tail + size] = data
+        self.__tail = tail + size
+
+    def reserve(self, size: int) -> memoryview:
+        """Returns a writable view of 'size' free bytes at the tail of the
+        buffer (e.g. for socket.recv_into()).  Call commit() with the number
+        of bytes actually written.
+        """
+        self.__makeRoom(size)
+        return memoryview(self.__buf)[self.__tail:self.__tail + size]
+
+    def commit(self, size: int) -> None:
+        """Add 'size' bytes written to the view returned by reserve() to the
+        buffer.
+        """
+        self.__tail += size
+
+    def view(self) -> memoryview:
+        """Returns a view of all of the unconsumed data."""
+        return memoryview(self.__buf)[self.__head:self.__tail]
+
+    def consume(self, size: int) -> None:
+        """Discard 'size' bytes from the head of the buffer."""
+        head = self.__head + size
+        if head >= self.__tail:
+            self.__head = self.__tail = 0
+        else:
+            self.__head = head
+
+    def clear(self) -> None:
+        self.__head = self.__tail = 0
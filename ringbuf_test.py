@@ -0,0 +1,52 @@
+
+from unittest import main, TestCase
+from ringbuf import ByteRing
+
+class ByteRingTest(TestCase):
+
+    def testWriteConsume(self):
+        ring = ByteRing(8)
+        ring.write(b'abcde')
+        self.assertEqual(len(ring), 5)
+        self.assertEqual(bytes(ring.view()), b'abcde')
+        ring.consume(2)
+        self.assertEqual(bytes(ring.view()), b'cde')
+
+        # Doesn't fit at the end, the data gets moved to the front.
+        ring.write(b'fgh')
+        self.assertEqual(bytes(ring.view()), b'cdefgh')
+        self.assertEqual(ring.capacity, 8)
+
+        ring.consume(6)
+        self.assertFalse(ring)
+
+    def testGrow(self):
+        ring = ByteRing(4)
+        ring.write(b'ab')
+
+        # An outstanding view doesn't prevent growing.
+        view = ring.view()
+        ring.write(b'cdefgh')
+        self.assertEqual(bytes(view), b'ab')
+        self.assertEqual(bytes(ring.view()), b'abcdefgh')
+        self.assertGreaterEqual(ring.capacity, 8)
+
+    def testReserveCommit(self):
+        ring = ByteRing(4)
+        ring.write(b'xy')
+        space = ring.reserve(10)
+        self.assertEqual(len(space), 10)
+        space[:3] = b'123'
+        ring.commit(3)
+        self.assertEqual(bytes(ring.view()), b'xy123')
+
+    def testConsumeAllResets(self):
+        ring = ByteRing(4)
+        ring.write(b'abc')
+        ring.consume(3)
+        ring.write(b'defg')
+        self.assertEqual(ring.capacity, 4)
+        self.assertEqual(bytes(ring.view()), b'defg')
+
+if __name__ == '__main__':
+    main()
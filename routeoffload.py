@@ -0,0 +1,95 @@
+"""Offloading of pass-through midi routing to kernel subscriptions.
+
+When all AWBClient does with its input is forward it to a single port, the
+sources connected to its input port can be connected straight to that
+port, so the kernel routes their events without involving python.  The
+RouteOffloader makes those connections and puts things back the way they
+were when the offload is no longer possible.
+"""
+
+from topology import Addr
+from typing import List, Optional, Set, Tuple
+
+class RouteOffloader(object):
+    """Moves the sources connected to an input port over to a destination
+    port and back.
+
+    Attrs:
+        seq: [amidi.Sequencer] The sequencer.
+        inputAddr: [topology.Addr] Address of the input port that offloaded
+            sources are disconnected from.
+    """
+
+    def __init__(self, seq, inputAddr: Addr):
+        self.seq = seq
+        self.inputAddr = inputAddr
+
+        # Routes currently offloaded to the kernel as (source, destination)
+        # port names, and the destination they were offloaded to.
+        self.__routes : List[Tuple[str, str]] = []
+        self.__dest : Optional[str] = None
+
+        # The subset of __routes for which we created the subscription from
+        # the source to the destination.  The others were already connected
+        # and are left alone when the routes are restored.
+        self.__created : Set[Tuple[str, str]] = set()
+
+    def update(self, dest: Optional[str]) -> List[Tuple[str, str]]:
+        """Offload routing to 'dest', or restore routing to the input port
+        if 'dest' is None.
+
+        Every source connected to the input port is connected directly to
+        'dest' and disconnected from the input port.  If 'dest' differs from
+        the last call, the routes offloaded then are restored first.
+
+        Returns the list of offloaded routes as (source, destination) port
+        names.
+        """
+        if dest != self.__dest and self.__routes:
+            self.restore()
+        self.__dest = dest
+        if dest is None:
+            return []
+
+        topology = self.seq.snapshot()
+        inputPort = topology.getPortByAddr(self.inputAddr)
+        destPort = topology.getPort(dest)
+        if inputPort is None or destPort is None:
+            return self.getRoutes()
+
+        alreadyConnected = set(topology.sendersTo(destPort))
+        for src in topology.sendersTo(inputPort):
+            route = (src.fullName, dest)
+            if src not in alreadyConnected:
+                self.seq.connect(src, destPort)
+                self.__created.add(route)
+            self.seq.disconnect(src, inputPort)
+            self.__routes.append(route)
+        return self.getRoutes()
+
+    def restore(self) -> None:
+        """Reconnect all offloaded sources to the input port.
+
+        Subscriptions from the sources to the destination are only removed
+        if update() created them.
+        """
+        topology = self.seq.snapshot()
+        inputPort = topology.getPortByAddr(self.inputAddr)
+        for route in self.__routes:
+            srcName, destName = route
+            src = topology.getPort(srcName)
+            if src is None:
+                continue
+            dest = topology.getPort(destName)
+            if dest is not None and route in self.__created:
+                self.seq.disconnect(src, dest)
+            if inputPort is not None:
+                self.seq.connect(src, inputPort)
+        self.__routes = []
+        self.__created = set()
+
+    def getRoutes(self) -> List[Tuple[str, str]]:
+        """Returns the routes currently being handled by the kernel, as a list
+        of (source, destination) port names.
+        """
+        return list(self.__routes)
@@ -0,0 +1,129 @@
+from unittest import main, TestCase
+from midihandlers import getForwardDest, PassThrough
+from routeoffload import RouteOffloader
+from topology import ClientSnapshot, PortSnapshot, Subscription, Topology
+
+mawb = ClientSnapshot(128, 'MAWB')
+synth = ClientSnapshot(129, 'synth')
+kbd = ClientSnapshot(20, 'kbd')
+
+midiIn = PortSnapshot(mawb, 0, 'in')
+synthIn = PortSnapshot(synth, 0, 'in')
+kbdOut = PortSnapshot(kbd, 0, 'out')
+kbdOut2 = PortSnapshot(kbd, 1, 'out2')
+
+class FakeSequencer(object):
+    """Keeps a set of subscriptions and produces topology snapshots of them.
+    """
+
+    def __init__(self, *subs):
+        self.subs = set(Subscription(src.addr, dest.addr)
+                        for src, dest in subs
+                        )
+        self.events = []
+
+    def snapshot(self):
+        return Topology((mawb, synth, kbd), (midiIn, synthIn, kbdOut, kbdOut2),
+                        frozenset(self.subs)
+                        )
+
+    def connect(self, src, dest):
+        self.events.append('connect %s, %s' % (src, dest))
+        self.subs.add(Subscription(src.addr, dest.addr))
+
+    def disconnect(self, src, dest):
+        self.events.append('disconnect %s, %s' % (src, dest))
+        self.subs.remove(Subscription(src.addr, dest.addr))
+
+class RouteOffloaderTest(TestCase):
+
+    def testOffloadAndRestore(self):
+        seq = FakeSequencer((kbdOut, midiIn), (kbdOut2, midiIn))
+        offloader = RouteOffloader(seq, midiIn.addr)
+        self.assertEqual(offloader.update('synth/in'),
+                         [('kbd/out', 'synth/in'), ('kbd/out2', 'synth/in')]
+                         )
+        self.assertEqual(seq.subs,
+                         {Subscription(kbdOut.addr, synthIn.addr),
+                          Subscription(kbdOut2.addr, synthIn.addr)
+                          }
+                         )
+
+        # Nothing changes if we're offloading to the same destination.
+        seq.events = []
+        offloader.update('synth/in')
+        self.assertEqual(seq.events, [])
+
+        self.assertEqual(offloader.update(None), [])
+        self.assertEqual(offloader.getRoutes(), [])
+        self.assertEqual(seq.subs,
+                         {Subscription(kbdOut.addr, midiIn.addr),
+                          Subscription(kbdOut2.addr, midiIn.addr)
+                          }
+                         )
+
+    def testAlreadyConnected(self):
+        seq = FakeSequencer((kbdOut, midiIn), (kbdOut, synthIn))
+        offloader = RouteOffloader(seq, midiIn.addr)
+        self.assertEqual(offloader.update('synth/in'),
+                         [('kbd/out', 'synth/in')]
+                         )
+        self.assertEqual(seq.events, ['disconnect kbd/out, MAWB/in'])
+
+        # The subscription to the synth existed before the offload, so it
+        # survives the restore.
+        offloader.update(None)
+        self.assertEqual(seq.subs,
+                         {Subscription(kbdOut.addr, midiIn.addr),
+                          Subscription(kbdOut.addr, synthIn.addr)
+                          }
+                         )
+
+    def testMissingDestination(self):
+        seq = FakeSequencer((kbdOut, midiIn))
+        offloader = RouteOffloader(seq, midiIn.addr)
+        self.assertEqual(offloader.update('nosuch/port'), [])
+        self.assertEqual(seq.events, [])
+
+class FilteringPassThrough(PassThrough):
+
+    def __call__(self, client, event):
+        if event.channel == 0:
+            PassThrough.__call__(self, client, event)
+
+class CompiledPassThrough(PassThrough):
+
+    def compileFor(self, client, eventType, channel, controller):
+        return None
+
+class RenamedPassThrough(PassThrough):
+    """Doesn't change what is done with events."""
+
+    name = 'renamed'
+
+class OptInPassThrough(FilteringPassThrough):
+
+    def getForwardDest(self):
+        return 'other/in'
+
+class GetForwardDestTest(TestCase):
+
+    def testForwardDest(self):
+        self.assertEqual(getForwardDest(PassThrough('synth/in')), 'synth/in')
+        self.assertEqual(getForwardDest(RenamedPassThrough('synth/in')),
+                         'synth/in'
+                         )
+        self.assertEqual(getForwardDest(OptInPassThrough('synth/in')),
+                         'other/in'
+                         )
+
+    def testSubclassesThatChangeDispatchArentForwards(self):
+        self.assertIsNone(getForwardDest(FilteringPassThrough('synth/in')))
+        self.assertIsNone(getForwardDest(CompiledPassThrough('synth/in')))
+
+    def testOtherHandlers(self):
+        self.assertIsNone(getForwardDest(None))
+        self.assertIsNone(getForwardDest(lambda client, event: None))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Benchmark for RPC round trips through comm.Comm.
+
+Runs a stand-in daemon on a local socket that answers every RPC with an
+empty Response, then measures round trips per second for sequential calls
+(waiting for each response before sending the next one) and for pipelined
+calls (up to Comm's maxInFlight calls outstanding at once).
+
+Comm is run on an event loop, so this doesn't need the proactor.
+"""
+
+import socket
+import struct
+from threading import Thread
+import time
+from comm import Comm
+from eventloop import EventLoop
+from mawb_pb2 import Response, RPC
+
+CALLS = 20000
+
+def serve(listener):
+    """The stand-in daemon."""
+    conn, addr = listener.accept()
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    data = b''
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+        out = []
+        while len(data) >= 4:
+            size, = struct.unpack_from('<I', data)
+            if len(data) < size + 4:
+                break
+            rpc = RPC()
+            rpc.ParseFromString(data[4:size + 4])
+            data = data[size + 4:]
+            resp = Response()
+            resp.msg_id = rpc.msg_id
+            parcel = resp.SerializeToString()
+            out.append(struct.pack('<I', len(parcel)) + parcel)
+        conn.sendall(b''.join(out))
+    conn.close()
+
+def run(name, func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print('%-12s %10.0f round trips/sec' % (name, CALLS / elapsed))
+
+def main():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    server = Thread(target=serve, args=(listener,))
+    server.start()
+
+    loop = EventLoop()
+    comm = Comm(*listener.getsockname(), loop=loop)
+    loopThread = Thread(target=loop.run)
+    loopThread.start()
+
+    def sequential():
+        for i in range(CALLS):
+            comm.call(timeout=5, echo="x").result()
+
+    def pipelined():
+        futures = [comm.call(timeout=5, echo="x") for i in range(CALLS)]
+        for future in futures:
+            future.result()
+
+    run('sequential', sequential)
+    run('pipelined', pipelined)
+
+    comm.close()
+    loop.stop()
+    loopThread.join()
+    server.join()
+    listener.close()
+
+if __name__ == '__main__':
+    main()
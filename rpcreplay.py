@@ -0,0 +1,277 @@
+"""Capture and replay of the RPC stream that a session sends to awbd.
+
+To capture a session, give its Comm a recorder before it sends anything
+(for AWBClient, that's client.comm):
+
+    comm.recorder = RPCRecorder(open('session.rpcs', 'wb'))
+
+Every RPC frame the Comm sends is written to the capture along with the
+time it was sent.  RPCs passed through shared memory (Comm.callShared())
+are captured with their payload inline, since the segment is gone by the
+time we replay them.
+
+To replay a capture against a running daemon:
+
+    python3 rpcreplay.py session.rpcs [-a address] [-s speed] [-c count]
+
+Each of 'count' connections replays the whole capture, with the original
+timing sped up by a factor of 'speed' (0 sends everything as fast as
+possible).  Every replayed RPC gets a msg_id so we can measure its latency,
+and shutdown requests are dropped.  Latency and throughput are reported
+for each type of RPC (the set of fields present in it).
+"""
+
+import argparse
+from concurrent.futures import wait
+from dataclasses import dataclass, field
+from functools import partial
+import struct
+from threading import Lock, Thread
+import time
+from typing import Any, BinaryIO, Dict, Iterator, List, Tuple
+from comm import Comm, parseAddress
+from eventloop import EventLoop
+from mawb_pb2 import RPC
+
+# Captures start with this, followed by a record for each frame: the seconds
+# since the first frame (a double) and the size of the serialized RPC, then
+# the RPC.
+MAGIC = b'AWBRPC1\n'
+_RECORD = struct.Struct('<dI')
+
+# Fields that we don't replay.
+_SKIPPED_FIELDS = {'msg_id', 'shutdown'}
+
+class RPCRecorder:
+    """Writes the RPCs sent by a Comm to a capture (see Comm.recorder).
+
+    Args:
+        out: The file to write the capture to.  It's closed by close().
+    """
+
+    def __init__(self, out: BinaryIO):
+        self.__out = out
+        self.__lock = Lock()
+        self.__start = None
+        out.write(MAGIC)
+
+    def record(self, rpc: RPC) -> None:
+        """Write an RPC to the capture, called by Comm as it's sent."""
+        if rpc.HasField('shm_payload'):
+            rpc = _inlineShmPayload(rpc)
+        data = rpc.SerializeToString()
+        now = time.perf_counter()
+        with self.__lock:
+            if self.__start is None:
+                self.__start = now
+            self.__out.write(_RECORD.pack(now - self.__start, len(data)) +
+                             data
+                             )
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__out.close()
+
+def _inlineShmPayload(rpc: RPC) -> RPC:
+    """Returns a copy of 'rpc' with its shared memory payload merged in.
+
+    The segment still exists while the RPC is being sent (Comm removes it
+    when the call completes).  POSIX shared memory segments live in
+    /dev/shm.
+    """
+    desc = rpc.shm_payload
+    result = RPC()
+    result.CopyFrom(rpc)
+    result.ClearField('shm_payload')
+    with open('/dev/shm' + desc.name, 'rb') as src:
+        src.seek(desc.offset)
+        result.MergeFromString(src.read(desc.size))
+    return result
+
+def readCapture(src: BinaryIO) -> Iterator[Tuple[float, RPC]]:
+    """Generates the (time, rpc) records of a capture.
+
+    Raises ValueError if 'src' isn't a capture.
+    """
+    if src.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not an RPC capture')
+    while True:
+        header = src.read(_RECORD.size)
+        if len(header) < _RECORD.size:
+            return
+        timestamp, size = _RECORD.unpack(header)
+        rpc = RPC()
+        rpc.ParseFromString(src.read(size))
+        yield timestamp, rpc
+
+def getRPCType(rpc: RPC) -> str:
+    """Returns the type of an RPC for reporting: the names of the fields we
+    replay.
+    """
+    return '+'.join(field.name for field, val in rpc.ListFields()
+                    if field.name not in _SKIPPED_FIELDS
+                    ) or 'empty'
+
+def _getFields(rpc: RPC) -> Dict[str, Any]:
+    """Returns the fields of an RPC to replay, as arguments for Comm.call().
+    """
+    return {field.name: list(val)
+                if field.label == field.LABEL_REPEATED else val
+            for field, val in rpc.ListFields()
+            if field.name not in _SKIPPED_FIELDS
+            }
+
+@dataclass
+class RPCTypeStats:
+    """Replay results for one type of RPC.
+
+    Attrs:
+        count: Number of RPCs sent.
+        errors: Number that failed or timed out.
+        latencies: Seconds from sending each successful RPC until its
+            response arrived.
+    """
+    count: int = 0
+    errors: int = 0
+    latencies: List[float] = field(default_factory=list)
+
+    def getPercentile(self, percent: float) -> float:
+        """Returns the latency at the given percentile (0 to 100)."""
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        index = min(int(len(latencies) * percent / 100), len(latencies) - 1)
+        return latencies[index]
+
+@dataclass
+class ReplayReport:
+    """Results of replay().
+
+    Attrs:
+        types: Stats by RPC type (see getRPCType()).
+        elapsed: Seconds from the start of the replay until the last
+            response.
+    """
+    types: Dict[str, RPCTypeStats] = field(default_factory=dict)
+    elapsed: float = 0
+
+    def __str__(self):
+        lines = ['%-32s %7s %6s %9s %8s %8s %8s %8s' % (
+            'type', 'count', 'errors', 'RPCs/sec', 'mean ms', 'p50 ms',
+            'p99 ms', 'max ms'
+        )]
+        for name, stats in sorted(self.types.items()):
+            latencies = stats.latencies
+            lines.append('%-32s %7d %6d %9.0f %8.2f %8.2f %8.2f %8.2f' % (
+                name, stats.count, stats.errors,
+                stats.count / self.elapsed if self.elapsed else 0,
+                sum(latencies) / len(latencies) * 1000 if latencies else 0,
+                stats.getPercentile(50) * 1000,
+                stats.getPercentile(99) * 1000,
+                max(latencies, default=0) * 1000
+            ))
+        return '\n'.join(lines)
+
+def replay(records: List[Tuple[float, RPC]], addr: str = '127.0.0.1',
+           port: int = 8193,
+           speed: float = 1.0,
+           connections: int = 1,
+           timeout: float = 10.0
+           ) -> ReplayReport:
+    """Replay captured RPCs against a daemon.
+
+    Args:
+        records: The (time, rpc) records of a capture (see readCapture()).
+        addr: The daemon's address (a host or UNIX_PREFIX path).
+        port: The daemon's port.
+        speed: Divide the recorded times by this, 0 to send the RPCs as
+            fast as possible.
+        connections: Number of concurrent connections, each of which
+            replays all of the records.
+        timeout: Seconds to wait for each response.
+
+    Latencies include time spent waiting for one of the connection's
+    in-flight slots (see Comm's maxInFlight), which only happens when the
+    daemon isn't keeping up.
+    """
+    rpcs = []
+    for timestamp, rpc in records:
+        fields = _getFields(rpc)
+        if fields or not rpc.HasField('shutdown'):
+            rpcs.append((timestamp, getRPCType(rpc), fields))
+
+    report = ReplayReport()
+    lock = Lock()
+
+    def done(name, sent, future):
+        latency = time.perf_counter() - sent
+        with lock:
+            stats = report.types.setdefault(name, RPCTypeStats())
+            stats.count += 1
+            if future.exception():
+                stats.errors += 1
+            else:
+                stats.latencies.append(latency)
+
+    def run(comm):
+        start = time.perf_counter()
+        futures = []
+        for timestamp, name, fields in rpcs:
+            if speed:
+                delay = start + timestamp / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.perf_counter()
+            future = comm.call(timeout, **fields)
+            future.add_done_callback(partial(done, name, sent))
+            futures.append(future)
+        wait(futures)
+
+    loop = EventLoop()
+    loopThread = Thread(target=loop.run)
+    loopThread.start()
+    comms = [Comm(addr, port, loop=loop) for i in range(connections)]
+    try:
+        start = time.perf_counter()
+        threads = [Thread(target=run, args=(comm,)) for comm in comms]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report.elapsed = time.perf_counter() - start
+    finally:
+        for comm in comms:
+            comm.close()
+        loop.stop()
+        loopThread.join()
+        loop.close()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a capture of RPCs against awbd.'
+    )
+    parser.add_argument('capture', help='capture file (see RPCRecorder)')
+    parser.add_argument('-a', '--address', default='127.0.0.1:8193',
+                        help='daemon address: unix:<path> or host[:port]'
+                        )
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='speedup factor, 0 for as fast as possible'
+                        )
+    parser.add_argument('-c', '--connections', type=int, default=1,
+                        help='number of concurrent connections'
+                        )
+    parser.add_argument('-t', '--timeout', type=float, default=10.0,
+                        help='seconds to wait for each response'
+                        )
+    args = parser.parse_args()
+
+    with open(args.capture, 'rb') as src:
+        records = list(readCapture(src))
+    addr, port = parseAddress(args.address)
+    print(replay(records, addr, port, args.speed, args.connections,
+                 args.timeout
+                 ))
+
+if __name__ == '__main__':
+    main()
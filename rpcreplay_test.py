@@ -0,0 +1,152 @@
+import io
+import socket
+import struct
+from threading import Thread
+import time
+from unittest import main, TestCase
+from comm import Comm
+from eventloop import EventLoop
+from mawb_pb2 import ChangeJackStateRequest, Response, RPC, SetInitialState, \
+    ShutdownRequest, PLAY
+from rpcreplay import getRPCType, readCapture, replay, RPCRecorder
+
+class FakeDaemon:
+    """Accepts any number of connections and answers every RPC with a
+    msg_id.  The RPCs received on each connection are stored in 'rpcs'.
+    """
+
+    def __init__(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.rpcs = []
+        self.threads = []
+        self.thread = Thread(target=self.accept)
+        self.thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            rpcs = []
+            self.rpcs.append(rpcs)
+            thread = Thread(target=self.serve, args=(conn, rpcs))
+            thread.start()
+            self.threads.append(thread)
+
+    def serve(self, conn, rpcs):
+        data = b''
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            while len(data) >= 4:
+                size, = struct.unpack_from('<I', data)
+                if len(data) < size + 4:
+                    break
+                rpc = RPC()
+                rpc.ParseFromString(data[4:size + 4])
+                data = data[size + 4:]
+                rpcs.append(rpc)
+                if rpc.HasField('msg_id'):
+                    parcel = Response(msg_id=rpc.msg_id).SerializeToString()
+                    conn.sendall(struct.pack('<I', len(parcel)) + parcel)
+        conn.close()
+
+    def close(self):
+        self.listener.shutdown(socket.SHUT_RDWR)
+        self.listener.close()
+        self.thread.join()
+        for thread in self.threads:
+            thread.join()
+
+class RecordReplayTest(TestCase):
+
+    def setUp(self):
+        self.daemon = FakeDaemon()
+        self.address = self.daemon.listener.getsockname()
+
+    def tearDown(self):
+        self.daemon.close()
+
+    def record(self):
+        """Record a session, returns the capture."""
+        loop = EventLoop()
+        loopThread = Thread(target=loop.run)
+        loopThread.start()
+        comm = Comm(*self.address, loop=loop)
+        out = io.BytesIO()
+        out.close = lambda: None
+        comm.recorder = RPCRecorder(out)
+        try:
+            comm.sendRPC(echo='first')
+            time.sleep(0.1)
+            comm.call(timeout=5,
+                      change_jack_state=ChangeJackStateRequest(state=PLAY)
+                      ).result()
+            comm.callShared(timeout=5,
+                            set_initial_state=SetInitialState(
+                                events=b'x' * 1000
+                            )
+                            ).result()
+            comm.sendRPC(shutdown=ShutdownRequest())
+            comm.call(timeout=5).result()
+        finally:
+            comm.close()
+            loop.stop()
+            loopThread.join()
+            loop.close()
+        return out.getvalue()
+
+    def testRecord(self):
+        records = list(readCapture(io.BytesIO(self.record())))
+        self.assertEqual([getRPCType(rpc) for t, rpc in records], [
+            'echo', 'change_jack_state', 'set_initial_state', 'empty',
+            'empty'
+        ])
+        self.assertEqual(records[0][0], 0)
+        self.assertGreaterEqual(records[1][0], 0.1)
+
+        # The shared memory payload is inline.
+        rpc = records[2][1]
+        self.assertFalse(rpc.HasField('shm_payload'))
+        self.assertEqual(rpc.set_initial_state[0].events, b'x' * 1000)
+        self.assertTrue(records[3][1].HasField('shutdown'))
+
+    def testReplay(self):
+        records = list(readCapture(io.BytesIO(self.record())))
+        start = time.perf_counter()
+        report = replay(records, *self.address, speed=0, connections=3,
+                        timeout=5
+                        )
+        self.assertLess(time.perf_counter() - start, 1)
+
+        # The first connection was the recording.
+        replayed = self.daemon.rpcs[1:]
+        self.assertEqual(len(replayed), 3)
+        for rpcs in replayed:
+            self.assertTrue(all(rpc.HasField('msg_id') for rpc in rpcs))
+            self.assertFalse(any(rpc.HasField('shutdown') for rpc in rpcs))
+            self.assertEqual(list(rpcs[0].echo), ['first'])
+            self.assertEqual(rpcs[2].set_initial_state[0].events,
+                             b'x' * 1000
+                             )
+
+        # The shutdown-only RPC is dropped.
+        self.assertEqual(report.types['empty'].count, 3)
+        self.assertEqual(report.types['echo'].count, 3)
+        self.assertEqual(report.types['echo'].errors, 0)
+        self.assertEqual(len(report.types['echo'].latencies), 3)
+        self.assertIn('change_jack_state', str(report))
+
+    def testReplayTiming(self):
+        records = [(0, RPC(echo=['a'])), (0.2, RPC(echo=['b']))]
+        start = time.perf_counter()
+        replay(records, *self.address, speed=2, timeout=5)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,15 @@
 
 import subprocess
-import time
-import socket
+
+from comm import launchDaemon
 
 awbdCommand = ['awbd']
 
 debug = False
 if debug:
-    awbdCommand.insert(0, 'gdb')
+    awbdCommand[:0] = ['gdb', '--args']
 
-daemon = subprocess.Popen(awbdCommand)
-time.sleep(1)
-if debug:
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-    s.bind(('localhost', 9191))
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.listen(5)
-    s.accept()
+daemon = launchDaemon(awbdCommand, None if debug else 10)
 
 subprocess.call(['aconnect', '130:0', '129:1'])
 subprocess.call(['jack_connect', 'fluidsynth:l_00', 'system:playback_1'])
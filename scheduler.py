@@ -0,0 +1,632 @@
+"""Event scheduler for AWBClient.
+
+The scheduler is a priority queue of events keyed by absolute time in ticks.
+Scheduling returns a Handle that can be used to cancel or reschedule the
+event, and events can be tagged so that a whole group of them (for example,
+all of the events from a given loop) can be cancelled at once.
+
+Events are stored by reference.  Unlike the old list-merging approach, the
+event's own "time" attribute is never modified (the absolute time lives in
+the queue entry) so the same event objects can be scheduled over and over
+without being copied.
+
+Loops are handled by periodic sources (see addPeriodic()).  A periodic
+source holds a single queue entry for its next event and walks its event
+sequence with an index and a cycle counter, so a loop of any length costs
+one queue operation per event and nothing is ever re-queued or copied.
+
+OutputThread dispatches events from a scheduler on a dedicated thread.
+Other threads hand it new events, cancellations and reschedules through a
+lock-free Handoff, so they never contend with it for the scheduler.
+"""
+
+from clock import DispatchStats, NS_PER_SEC, TickClock
+from heapq import heappop, heappush, heapreplace
+from itertools import count
+import select
+from spsc import Handoff
+from threading import RLock, Thread
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, \
+    Sequence, Set, Tuple, Union
+
+# Queue entry sequence number for handles that have been created but not yet
+# inserted into the queue.
+_PENDING = -2
+
+class Handle:
+    """A handle to a scheduled event.
+
+    Attrs:
+        time: [int] The absolute time (in ticks) that the event is scheduled
+            for.
+        event: [midi.Event] The event.
+        tag: [Hashable or None] The tag the event was scheduled with.
+        cancelled: [bool] True if the event has been cancelled.
+    """
+
+    __slots__ = ('time', 'event', 'tag', 'cancelled', '_seq', '_owner')
+
+    def __init__(self, owner: Union['Scheduler', 'OutputThread'], time: int,
+                 event: Any,
+                 tag: Optional[Hashable]
+                 ):
+        self.time = time
+        self.event = event
+        self.tag = tag
+        self.cancelled = False
+
+        # Sequence number of the live queue entry for this handle.  Entries
+        # with a different sequence number are stale (left over from a
+        # reschedule) and are discarded when they reach the top of the queue.
+        # -1 if the handle is no longer scheduled.
+        self._seq = _PENDING
+
+        # The Scheduler, or the OutputThread that created the handle, which
+        # cancel() and reschedule() go through.
+        self._owner = owner
+
+    def cancel(self) -> None:
+        """Cancel the event.  Does nothing if it's already been dispatched or
+        cancelled.
+
+        For handles from an OutputThread, this is applied on the output
+        thread (see OutputThread.cancel()).
+        """
+        self._owner.cancel(self)
+
+    def reschedule(self, time: int) -> None:
+        """Move the event to a new absolute time (in ticks).
+
+        For handles from an OutputThread, this is applied on the output
+        thread (see OutputThread.reschedule()).
+        """
+        self._owner.reschedule(self, time)
+
+    def __repr__(self):
+        return 'Handle(%s, %r, tag=%r%s)' % (
+            self.time, self.event, self.tag,
+            ', cancelled' if self.cancelled else ''
+        )
+
+class PeriodicSource:
+    """A sequence of events that repeats every 'period' ticks.
+
+    The events must be sorted by time.  Each event is played at
+    cycleStart + phase + event.time, where cycleStart advances by 'period'
+    ticks every cycle.
+
+    Muting and period changes take effect at the next cycle boundary, so
+    they stay in sync with the other loops.
+
+    Attrs:
+        events: [Sequence[midi.Event]] The events (stored by reference).
+        period: [int] The length of a cycle in ticks.
+        phase: [int] Offset (in ticks) of the events from the start of each
+            cycle.
+        tag: [Hashable or None] The tag the source was registered with.
+        cycle: [int] The number of the current cycle, starting from zero.
+        cycleStart: [int] The absolute start time of the current cycle.
+        time: [int] The absolute time of the next queue entry for the
+            source.
+        cancelled: [bool] True if the source has been cancelled.
+    """
+
+    def __init__(self, owner: Union['Scheduler', 'OutputThread'],
+                 events: Sequence[Any],
+                 period: int,
+                 start: int,
+                 phase: int,
+                 tag: Optional[Hashable]
+                 ):
+        if period <= 0:
+            raise ValueError('Period must be positive, got %r' % period)
+        self.events = events
+        self.period = period
+        self.phase = phase
+        self.tag = tag
+        self.cycle = 0
+        self.cycleStart = start
+        self.cancelled = False
+        self.__muted = False
+
+        # Changes to be applied at the next cycle boundary.
+        self.__pendingPeriod : Optional[int] = None
+        self.__pendingMuted : Optional[bool] = None
+
+        # Index of the next event to play, -1 if we're just waiting for the
+        # next boundary (the source is muted or empty).
+        self.__index = -1
+        self.time = start
+        self._seq = _PENDING
+        self._owner = owner
+        self.__beginCycle()
+
+    @property
+    def muted(self) -> bool:
+        """True if the current cycle is muted."""
+        return self.__muted
+
+    def mute(self) -> None:
+        """Mute the source starting at the next cycle boundary."""
+        self.__pendingMuted = True
+
+    def unmute(self) -> None:
+        """Unmute the source starting at the next cycle boundary."""
+        self.__pendingMuted = False
+
+    def setPeriod(self, period: int) -> None:
+        """Change the period starting at the next cycle boundary.
+
+        The current cycle keeps its original length.
+        """
+        if period <= 0:
+            raise ValueError('Period must be positive, got %r' % period)
+        self.__pendingPeriod = period
+
+    def cancel(self) -> None:
+        """Stop the source altogether."""
+        self._owner.cancel(self)
+
+    def __beginCycle(self) -> None:
+        if self.__muted or not self.events:
+            self.__index = -1
+            self.time = self.cycleStart + self.period
+        else:
+            self.__index = 0
+            self.time = self.cycleStart + self.phase + self.events[0].time
+
+    def __nextCycle(self) -> None:
+        self.cycleStart += self.period
+        self.cycle += 1
+        if self.__pendingPeriod is not None:
+            self.period = self.__pendingPeriod
+            self.__pendingPeriod = None
+        if self.__pendingMuted is not None:
+            self.__muted = self.__pendingMuted
+            self.__pendingMuted = None
+        self.__beginCycle()
+
+    def _fire(self) -> Optional[Any]:
+        """Called by the scheduler when the source's entry is due.
+
+        Returns the event to dispatch (None if this was just a cycle
+        boundary) and advances 'time' to the next entry.
+        """
+        index = self.__index
+        if index < 0:
+            self.__nextCycle()
+            return None
+
+        event = self.events[index]
+        index += 1
+        if index < len(self.events):
+            self.__index = index
+            self.time = self.cycleStart + self.phase + self.events[index].time
+        else:
+            self.__nextCycle()
+        return event
+
+    def __repr__(self):
+        return 'PeriodicSource(%d events, period=%s, phase=%s, tag=%r%s)' % (
+            len(self.events), self.period, self.phase, self.tag,
+            ', cancelled' if self.cancelled else ''
+        )
+
+class Scheduler:
+    """A priority queue of timed events.
+
+    Insertion, cancellation and removal of due events are O(log n).
+    Cancelled and rescheduled entries are removed lazily as they reach the
+    front of the queue.
+
+    All methods are thread-safe.
+    """
+
+    def __init__(self):
+        # The heap: a list of [time, seq, handle] entries ("handle" may also
+        # be a PeriodicSource).  "seq" preserves
+        # scheduling order for events at the same time.
+        self.__heap : List[list] = []
+        self.__seq = count()
+        self.__tags : Dict[Hashable, Set[Union[Handle, PeriodicSource]]] = {}
+        self.__lock = RLock()
+
+        # Number of live (not cancelled, not dispatched) events and periodic
+        # sources.
+        self.__size = 0
+
+    def __len__(self):
+        return self.__size
+
+    def __push(self, handle: Union[Handle, PeriodicSource]) -> None:
+        handle._seq = seq = next(self.__seq)
+        heappush(self.__heap, [handle.time, seq, handle])
+
+    def __untag(self, handle: Union[Handle, PeriodicSource]) -> None:
+        if handle.tag is not None:
+            handles = self.__tags.get(handle.tag)
+            if handles is not None:
+                handles.discard(handle)
+                if not handles:
+                    del self.__tags[handle.tag]
+
+    def makeHandle(self, event: Any, time: int,
+                   tag: Optional[Hashable] = None,
+                   owner: Optional['OutputThread'] = None
+                   ) -> Handle:
+        """Create a handle for 'event' at absolute time 'time' (in ticks)
+        without scheduling it.
+
+        The handle must be passed to insert() to schedule it.  It may be
+        cancelled before then, in which case insert() ignores it.  This
+        doesn't touch the scheduler's state, so it can be called from any
+        thread.
+
+        If 'owner' is given, the handle's cancel() and reschedule() go
+        through it rather than directly to the scheduler.
+        """
+        return Handle(owner or self, time, event, tag)
+
+    def insert(self, handle: Union[Handle, PeriodicSource]) -> None:
+        """Schedule a handle created by makeHandle() or a source created by
+        makePeriodic().
+        """
+        with self.__lock:
+            if handle.cancelled or handle._seq != _PENDING:
+                return
+            self.__push(handle)
+            if handle.tag is not None:
+                self.__tags.setdefault(handle.tag, set()).add(handle)
+            self.__size += 1
+
+    def insertAll(self, handles: Iterable[Union[Handle, PeriodicSource]]
+                  ) -> None:
+        with self.__lock:
+            for handle in handles:
+                self.insert(handle)
+
+    def schedule(self, event: Any, time: int,
+                 tag: Optional[Hashable] = None
+                 ) -> Handle:
+        """Schedule 'event' at absolute time 'time' (in ticks).
+
+        Returns a handle for the scheduled event.
+        """
+        handle = Handle(self, time, event, tag)
+        self.insert(handle)
+        return handle
+
+    def scheduleAll(self, events: Iterable[Any], time: int,
+                    tag: Optional[Hashable] = None
+                    ) -> List[Handle]:
+        """Schedule all 'events' relative to absolute time 'time'.
+
+        Each event is scheduled at 'time' plus its own "time" attribute.
+        Returns the list of handles.
+        """
+        handles = [Handle(self, time + event.time, event, tag)
+                   for event in events
+                   ]
+        self.insertAll(handles)
+        return handles
+
+    def addPeriodic(self, events: Sequence[Any], period: int, start: int,
+                    phase: int = 0,
+                    tag: Optional[Hashable] = None
+                    ) -> PeriodicSource:
+        """Add a periodic source that plays 'events' every 'period' ticks.
+
+        Args:
+            events: The events, sorted by time.  These are stored by
+                reference and never modified.
+            period: Length of each cycle in ticks.
+            start: Absolute start time of the first cycle.
+            phase: Offset of the events from the start of each cycle.
+            tag: If provided, the source is cancelled by cancelTag().
+        """
+        source = self.makePeriodic(events, period, start, phase, tag)
+        self.insert(source)
+        return source
+
+    def makePeriodic(self, events: Sequence[Any], period: int, start: int,
+                     phase: int = 0,
+                     tag: Optional[Hashable] = None,
+                     owner: Optional['OutputThread'] = None
+                     ) -> PeriodicSource:
+        """Create a periodic source without scheduling it.
+
+        This is to addPeriodic() what makeHandle() is to schedule().
+        """
+        return PeriodicSource(owner or self, events, period, start, phase,
+                              tag
+                              )
+
+    def cancel(self, handle: Union[Handle, PeriodicSource]) -> None:
+        """Cancel a scheduled event or periodic source."""
+        with self.__lock:
+            if handle.cancelled or handle._seq == -1:
+                return
+            pending = handle._seq == _PENDING
+            handle.cancelled = True
+            handle._seq = -1
+            if not pending:
+                self.__untag(handle)
+                self.__size -= 1
+
+    def reschedule(self, handle: Handle, time: int) -> None:
+        """Move a pending event to a new time.
+
+        Raises ValueError if the event was cancelled or already dispatched.
+        """
+        with self.__lock:
+            if handle.cancelled or handle._seq == -1:
+                raise ValueError('Event is no longer scheduled.')
+            handle.time = time
+
+            # Just push a new entry, the old one is now stale.  Pending
+            # handles will be pushed with the new time when they're inserted.
+            if handle._seq != _PENDING:
+                self.__push(handle)
+
+    def cancelTag(self, tag: Hashable) -> int:
+        """Cancel all pending events and periodic sources with the given tag.
+
+        Returns the number of events cancelled.
+        """
+        with self.__lock:
+            handles = self.__tags.pop(tag, ())
+            for handle in handles:
+                handle.cancelled = True
+                handle._seq = -1
+            self.__size -= len(handles)
+            return len(handles)
+
+    def __discardStale(self) -> None:
+        """Remove stale entries from the front of the queue."""
+        heap = self.__heap
+        while heap and heap[0][1] != heap[0][2]._seq:
+            heappop(heap)
+
+    def nextTime(self) -> Optional[int]:
+        """Returns the time of the next pending event, None if there is
+        none.
+        """
+        with self.__lock:
+            self.__discardStale()
+            return self.__heap[0][0] if self.__heap else None
+
+    def popDue(self, time: int, times: Optional[List[int]] = None
+               ) -> List[Any]:
+        """Remove and return all events due at or before 'time', in time
+        order.
+
+        If 'times' is provided, the time that each event was scheduled for is
+        appended to it.
+        """
+        result = []
+        with self.__lock:
+            heap = self.__heap
+            while heap:
+                entry = heap[0]
+                handle = entry[2]
+                if entry[1] != handle._seq:
+                    heappop(heap)
+                    continue
+                if entry[0] > time:
+                    break
+
+                if isinstance(handle, PeriodicSource):
+                    # Periodic sources stay in the queue, just move them to
+                    # their next time.
+                    event = handle._fire()
+                    handle._seq = seq = next(self.__seq)
+                    heapreplace(heap, [handle.time, seq, handle])
+                    if event is not None:
+                        result.append(event)
+                        if times is not None:
+                            times.append(entry[0])
+                    continue
+
+                heappop(heap)
+                handle._seq = -1
+                self.__untag(handle)
+                self.__size -= 1
+                result.append(handle.event)
+                if times is not None:
+                    times.append(entry[0])
+        return result
+
+    def clear(self) -> None:
+        """Cancel all pending events."""
+        with self.__lock:
+            for entry in self.__heap:
+                entry[2]._seq = -1
+                entry[2].cancelled = True
+            self.__heap = []
+            self.__tags = {}
+            self.__size = 0
+
+class OutputThread:
+    """Dispatches scheduled events on a dedicated thread.
+
+    Other threads schedule events through the schedule*() methods of this
+    class, which create pending handles and pass them to the output thread
+    through a lock-free Handoff.  The output thread inserts them into the
+    scheduler and sleeps until the next event is due (or it's woken up by a
+    new handoff).  Cancelling or rescheduling the handles goes through the
+    handoff too, so only the output thread ever takes the scheduler's lock.
+
+    Instead of starting a thread, the dispatcher can also be attached to an
+    eventloop.EventLoop, in which case everything that's described as
+    happening on the output thread happens on the loop thread.
+
+    Args:
+        scheduler: The scheduler to dispatch from.  Only the output thread
+            should insert into it.
+        clock: The clock that event times are measured against.
+        dispatch: Called on the output thread with each due event.
+        stats: If provided, the dispatch error for every event is recorded
+            here.
+    """
+
+    def __init__(self, scheduler: Scheduler, clock: TickClock,
+                 dispatch: Callable[[Any], None],
+                 stats: Optional[DispatchStats] = None
+                 ):
+        self.__scheduler = scheduler
+        self.__clock = clock
+        self.__dispatch = dispatch
+        self.__stats = stats
+        self.__handoff = Handoff()
+        self.__thread : Optional[Thread] = None
+        self.__loop : Optional['EventLoop'] = None
+        self.__timer : Optional['Timer'] = None
+
+    def start(self) -> None:
+        self.__thread = Thread(target=self.run, name='midi-output')
+        self.__thread.start()
+
+    def attach(self, loop: 'EventLoop') -> None:
+        """Dispatch events from 'loop' instead of a dedicated thread."""
+        self.__loop = loop
+        loop.addReader(self.__handoff.wakeup.fd, self.__runOnLoop)
+        loop.callSoon(self.__runOnLoop)
+
+    def stop(self) -> None:
+        """Stop the thread (if running) and wait for it to terminate.
+
+        When attached to an event loop, this detaches from the loop the next
+        time it runs.
+        """
+        if self.__thread:
+            self.__handoff.put((None, None))
+            self.__thread.join()
+            self.__thread = None
+        elif self.__loop:
+            self.__handoff.put((None, None))
+
+    def wake(self) -> None:
+        """Wake the thread so it recomputes the time of the next event (for
+        example, after a tempo change).
+        """
+        self.__handoff.wakeup.signal()
+
+    def schedule(self, event: Any, time: int,
+                 tag: Optional[Hashable] = None
+                 ) -> Handle:
+        """Schedule 'event' at absolute time 'time'.  See
+        Scheduler.schedule().
+        """
+        handle = self.__scheduler.makeHandle(event, time, tag, self)
+        self.__handoff.put((self.__scheduler.insert, handle))
+        return handle
+
+    def scheduleAll(self, events: Iterable[Any], time: int,
+                    tag: Optional[Hashable] = None
+                    ) -> List[Handle]:
+        """Schedule 'events' relative to 'time'.  See
+        Scheduler.scheduleAll().
+        """
+        makeHandle = self.__scheduler.makeHandle
+        handles = [makeHandle(event, time + event.time, tag, self)
+                   for event in events
+                   ]
+        self.__handoff.put((self.__scheduler.insertAll, handles))
+        return handles
+
+    def addPeriodic(self, events: Sequence[Any], period: int, start: int,
+                    phase: int = 0,
+                    tag: Optional[Hashable] = None
+                    ) -> PeriodicSource:
+        """Add a periodic source.  See Scheduler.addPeriodic()."""
+        source = self.__scheduler.makePeriodic(events, period, start, phase,
+                                               tag, self
+                                               )
+        self.__handoff.put((self.__scheduler.insert, source))
+        return source
+
+    def cancel(self, handle: Union[Handle, PeriodicSource]) -> None:
+        """Cancel a handle or periodic source created by this object.
+
+        Like the other requests, this is processed on the output thread in
+        order with the calling thread's other requests, so 'handle.cancelled'
+        isn't set until then.
+        """
+        self.__handoff.put((self.__scheduler.cancel, handle))
+
+    def reschedule(self, handle: Handle, time: int) -> None:
+        """Move an event scheduled through this object to a new time.
+
+        This is processed on the output thread, which then recomputes when
+        it has to wake up.  Requests for events that have already been
+        dispatched or cancelled by then are ignored.
+        """
+        self.__handoff.put((self.__reschedule, (handle, time)))
+
+    def __reschedule(self, args: Tuple[Handle, int]) -> None:
+        handle, time = args
+        if not handle.cancelled and handle._seq != -1:
+            self.__scheduler.reschedule(handle, time)
+
+    def cancelTag(self, tag: Hashable) -> None:
+        """Cancel all events with the given tag.
+
+        This is processed in order with the calling thread's other requests,
+        so it cancels everything the thread has scheduled with the tag so
+        far.
+        """
+        self.__handoff.put((self.__scheduler.cancelTag, tag))
+
+    def __timeout(self) -> Optional[float]:
+        next = self.__scheduler.nextTime()
+        if next is None:
+            return None
+        delta = self.__clock.nsForTick(next) - self.__clock.nowNs()
+        return 0 if delta <= 0 else delta / NS_PER_SEC
+
+    def __process(self) -> bool:
+        """Apply all handed off requests and dispatch all due events.
+
+        Returns False if we've been stopped.
+        """
+        for func, arg in self.__handoff.drain():
+            if func is None:
+                return False
+            func(arg)
+
+        scheduler = self.__scheduler
+        if scheduler:
+            clock = self.__clock
+            stats = self.__stats
+            dispatch = self.__dispatch
+            times = []
+            events = scheduler.popDue(clock.getTicks(), times)
+            for event, t in zip(events, times):
+                if stats is not None:
+                    stats.record(clock.nowNs() - clock.nsForTick(t))
+                dispatch(event)
+        return True
+
+    def run(self) -> None:
+        """The body of the output thread."""
+        wakeup = self.__handoff.wakeup.fd
+        timeout = None
+        while True:
+            select.select([wakeup], [], [], timeout)
+            if not self.__process():
+                return
+            timeout = self.__timeout()
+
+    def __runOnLoop(self) -> None:
+        """Event loop callback for handoffs and timers."""
+        if self.__timer:
+            self.__timer.cancel()
+            self.__timer = None
+        loop = self.__loop
+        if not self.__process():
+            loop.removeReader(self.__handoff.wakeup.fd)
+            self.__loop = None
+            return
+        timeout = self.__timeout()
+        if timeout is not None:
+            self.__timer = loop.callLater(timeout, self.__runOnLoop)
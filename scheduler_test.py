@@ -0,0 +1,330 @@
+
+from threading import Event as ThreadEvent, Thread
+import time
+from unittest import main, TestCase
+from clock import DispatchStats, TickClock
+from eventloop import EventLoop
+from midi import ControlChange, NoteOn, NoteOff
+from midihandlers import ChannelFilter, ControlMap, PassThrough
+from pipeline import Pipeline
+from scheduler import OutputThread, Scheduler
+
+class SchedulerTest(TestCase):
+
+    def testOrdering(self):
+        sched = Scheduler()
+        a = NoteOn(0, 0, 1, 127)
+        b = NoteOn(0, 0, 2, 127)
+        c = NoteOn(0, 0, 3, 127)
+        d = NoteOn(0, 0, 4, 127)
+        sched.schedule(c, 30)
+        sched.schedule(a, 10)
+        sched.schedule(b, 20)
+
+        # Same time as 'b', should come after it.
+        sched.schedule(d, 20)
+
+        self.assertEqual(len(sched), 4)
+        self.assertEqual(sched.nextTime(), 10)
+        self.assertEqual(sched.popDue(5), [])
+        self.assertEqual(sched.popDue(20), [a, b, d])
+        self.assertEqual(sched.nextTime(), 30)
+        self.assertEqual(sched.popDue(100), [c])
+        self.assertIsNone(sched.nextTime())
+        self.assertFalse(sched)
+
+    def testScheduleAllDoesNotCopy(self):
+        sched = Scheduler()
+        events = [NoteOn(0, 0, 1, 127), NoteOff(10, 0, 1, 0)]
+        handles = sched.scheduleAll(events, 100)
+        self.assertEqual([h.time for h in handles], [100, 110])
+
+        # The events are unmodified and are the same objects.
+        self.assertEqual([e.time for e in events], [0, 10])
+        self.assertEqual(sched.popDue(200), events)
+        self.assertEqual(sched.popDue(200), [])
+
+    def testCancel(self):
+        sched = Scheduler()
+        a = NoteOn(0, 0, 1, 127)
+        b = NoteOn(0, 0, 2, 127)
+        ha = sched.schedule(a, 10)
+        sched.schedule(b, 20)
+        ha.cancel()
+        self.assertTrue(ha.cancelled)
+        self.assertEqual(len(sched), 1)
+        self.assertEqual(sched.nextTime(), 20)
+
+        # Cancelling twice is harmless.
+        ha.cancel()
+        self.assertEqual(len(sched), 1)
+        self.assertEqual(sched.popDue(100), [b])
+
+    def testReschedule(self):
+        sched = Scheduler()
+        a = NoteOn(0, 0, 1, 127)
+        b = NoteOn(0, 0, 2, 127)
+        ha = sched.schedule(a, 10)
+        sched.schedule(b, 20)
+        ha.reschedule(30)
+        self.assertEqual(len(sched), 2)
+        self.assertEqual(sched.popDue(25), [b])
+        self.assertEqual(sched.popDue(30), [a])
+
+        # Can't reschedule a dispatched event.
+        with self.assertRaises(ValueError):
+            ha.reschedule(40)
+
+    def testCancelTag(self):
+        sched = Scheduler()
+        loop1 = [NoteOn(i, 0, i, 127) for i in range(5)]
+        loop2 = [NoteOn(i, 1, i, 127) for i in range(5)]
+        sched.scheduleAll(loop1, 0, tag='loop1')
+        sched.scheduleAll(loop2, 0, tag='loop2')
+        self.assertEqual(sched.cancelTag('loop1'), 5)
+        self.assertEqual(sched.cancelTag('loop1'), 0)
+        self.assertEqual(len(sched), 5)
+        self.assertEqual(sched.popDue(100), loop2)
+
+    def testClear(self):
+        sched = Scheduler()
+        handle = sched.schedule(NoteOn(0, 0, 1, 127), 10, tag='x')
+        sched.clear()
+        self.assertTrue(handle.cancelled)
+        self.assertFalse(sched)
+        self.assertEqual(sched.cancelTag('x'), 0)
+        self.assertEqual(sched.popDue(100), [])
+
+class PeriodicSourceTest(TestCase):
+
+    def setUp(self):
+        self.sched = Scheduler()
+        self.events = [NoteOn(0, 0, 1, 127), NoteOff(10, 0, 1, 0)]
+
+    def testLoops(self):
+        source = self.sched.addPeriodic(self.events, 100, 1000, tag='loop')
+        self.assertEqual(self.sched.nextTime(), 1000)
+        self.assertEqual(self.sched.popDue(1005), self.events[:1])
+        self.assertEqual(self.sched.popDue(1099), self.events[1:])
+        self.assertEqual(source.cycle, 1)
+        self.assertEqual(self.sched.nextTime(), 1100)
+
+        # Catch up across several cycles at once.
+        self.assertEqual(self.sched.popDue(1310), self.events * 3)
+        self.assertEqual(source.cycle, 4)
+
+        # The events are never copied or modified.
+        self.assertEqual([e.time for e in self.events], [0, 10])
+
+        self.assertEqual(self.sched.cancelTag('loop'), 1)
+        self.assertTrue(source.cancelled)
+        self.assertIsNone(self.sched.nextTime())
+
+    def testPhase(self):
+        self.sched.addPeriodic(self.events, 100, 0, phase=50)
+        self.assertEqual(self.sched.nextTime(), 50)
+        self.assertEqual(self.sched.popDue(60), self.events)
+        self.assertEqual(self.sched.nextTime(), 150)
+
+    def testInterleaving(self):
+        other = [NoteOn(5, 1, 2, 127)]
+        self.sched.addPeriodic(self.events, 100, 0)
+        self.sched.addPeriodic(other, 50, 0)
+        self.sched.schedule('x', 7)
+        self.assertEqual(self.sched.popDue(60),
+                         [self.events[0], other[0], 'x', self.events[1],
+                          other[0]
+                          ]
+                         )
+
+    def testMuteAtBoundary(self):
+        source = self.sched.addPeriodic(self.events, 100, 0)
+        self.assertEqual(self.sched.popDue(0), self.events[:1])
+
+        # The rest of the current cycle still plays.
+        source.mute()
+        self.assertFalse(source.muted)
+        self.assertEqual(self.sched.popDue(99), self.events[1:])
+        self.assertTrue(source.muted)
+        self.assertEqual(self.sched.popDue(250), [])
+
+        # Unmuting waits for the next boundary too.
+        source.unmute()
+        self.assertEqual(self.sched.popDue(299), [])
+        self.assertEqual(self.sched.popDue(300), self.events[:1])
+        self.assertFalse(source.muted)
+        self.assertEqual(source.cycleStart, 300)
+
+    def testSetPeriod(self):
+        source = self.sched.addPeriodic(self.events, 100, 0)
+        self.sched.popDue(0)
+        source.setPeriod(200)
+        self.assertEqual(source.period, 100)
+        self.sched.popDue(10)
+        self.assertEqual(source.period, 200)
+
+        # The current cycle keeps its length, the new one is longer.
+        self.assertEqual(self.sched.nextTime(), 100)
+        self.sched.popDue(110)
+        self.assertEqual(self.sched.nextTime(), 300)
+
+        with self.assertRaises(ValueError):
+            source.setPeriod(0)
+
+    def testEmpty(self):
+        source = self.sched.addPeriodic([], 100, 0)
+        self.assertEqual(self.sched.popDue(1000), [])
+        self.assertEqual(source.cycle, 10)
+        source.cancel()
+        self.assertFalse(self.sched)
+
+class OutputThreadTest(TestCase):
+
+    def setUp(self):
+        # One tick per millisecond.
+        self.clock = TickClock(bpm=60, ppb=1000)
+        self.scheduler = Scheduler()
+        self.dispatched = []
+        self.stats = DispatchStats()
+        self.output = OutputThread(self.scheduler, self.clock,
+                                   self.dispatched.append,
+                                   self.stats
+                                   )
+        self.output.start()
+
+    def tearDown(self):
+        self.output.stop()
+
+    def testHandoff(self):
+        a = NoteOn(0, 0, 1, 127)
+        b = NoteOn(5, 0, 2, 127)
+        c = NoteOn(0, 0, 3, 127)
+        now = self.clock.getTicks()
+        self.output.scheduleAll([a, b], now)
+        handle = self.output.schedule(c, now + 1000, tag='x')
+
+        # Cancel through the handoff, it's handled after the schedule.
+        self.output.cancelTag('x')
+        time.sleep(0.05)
+        self.assertEqual(self.dispatched, [a, b])
+        self.assertTrue(handle.cancelled)
+        self.assertEqual(self.stats.getSnapshot()['count'], 2)
+
+    def testRescheduleEarlier(self):
+        a = NoteOn(0, 0, 1, 127)
+        b = NoteOn(0, 0, 2, 127)
+        now = self.clock.getTicks()
+        ha = self.output.schedule(a, now + 100000)
+        hb = self.output.schedule(b, now + 100000)
+        time.sleep(0.02)
+
+        # The output thread is sleeping until the old time, the reschedule
+        # has to wake it up.
+        ha.reschedule(self.clock.getTicks())
+        hb.cancel()
+        time.sleep(0.05)
+        self.assertEqual(self.dispatched, [a])
+        self.assertTrue(hb.cancelled)
+
+        # Rescheduling a dispatched event is ignored.
+        ha.reschedule(0)
+        time.sleep(0.02)
+        self.assertEqual(self.dispatched, [a])
+
+    def testCancelBeforeInsert(self):
+        handle = self.scheduler.makeHandle(NoteOn(0, 0, 1, 127), 0)
+        handle.cancel()
+        self.scheduler.insert(handle)
+        self.assertFalse(self.scheduler)
+
+class AttachedOutputTest(TestCase):
+
+    def testDispatchFromLoop(self):
+        clock = TickClock(bpm=60, ppb=1000)
+        loop = EventLoop()
+        dispatched = []
+        output = OutputThread(Scheduler(), clock, dispatched.append)
+        output.attach(loop)
+
+        a = NoteOn(0, 0, 1, 127)
+        b = NoteOn(20, 0, 2, 127)
+        start = clock.getTicks()
+        output.scheduleAll([a, b], start)
+        loop.callLater(0.05, loop.stop)
+        loop.run()
+        self.assertEqual(dispatched, [a, b])
+
+        # Stopping detaches from the loop.
+        output.stop()
+        loop.runOnce(0)
+        output.schedule(NoteOn(0, 0, 3, 127), clock.getTicks())
+        loop.runOnce(0.01)
+        self.assertEqual(dispatched, [a, b])
+        loop.close()
+
+class FakeSequencer:
+
+    def getPort(self, name):
+        return name
+
+    def sendEvent(self, event, port):
+        pass
+
+class FakeClient:
+    seq = FakeSequencer()
+
+class OutputJitterLoadTest(TestCase):
+    """Verify that scheduled output stays on time during an input burst."""
+
+    def testJitterDuringInputBurst(self):
+        clock = TickClock(bpm=60, ppb=1000)
+        scheduler = Scheduler()
+        stats = DispatchStats()
+        output = OutputThread(scheduler, clock, lambda event: None, stats)
+        output.start()
+
+        # The "input thread": push a heavy burst of events through a
+        # dispatch pipeline as fast as possible.
+        handler = ControlMap(ChannelFilter('synth/in', 1))
+        handler.addControlHandler(7, PassThrough('synth/in'))
+        pipeline = Pipeline(FakeClient())
+        pipeline.configure([lambda client, event: False], handler)
+        events = [NoteOn(0, 0, i % 128, 100) for i in range(1000)] + \
+                 [ControlChange(0, 0, 7, i % 128) for i in range(1000)]
+        stop = ThreadEvent()
+        burstTimes = []
+        def burst():
+            start = time.perf_counter()
+            while not stop.is_set():
+                for event in events:
+                    pipeline.dispatchInput(event)
+            burstTimes.append(time.perf_counter() - start)
+        inputThread = Thread(target=burst)
+
+        try:
+            # Play a loop with an event every 5ms, starting a little in the
+            # future, and schedule one-shot events from this thread too.
+            loop = [NoteOn(t, 0, 60, 100) for t in range(0, 100, 5)]
+            output.addPeriodic(loop, 100, clock.getTicks() + 10)
+            inputThread.start()
+            for i in range(100):
+                output.schedule(NoteOff(0, 0, 60, 0), clock.getTicks() + 3)
+                time.sleep(0.01)
+        finally:
+            stop.set()
+            inputThread.join()
+            output.stop()
+
+        snap = stats.getSnapshot()
+        print('\nscheduled output during a %.2fs input burst: %s' %
+              (burstTimes[0], stats)
+              )
+        self.assertGreater(snap['count'], 200)
+
+        # Dispatch is at the mercy of the GIL switch interval, but must not
+        # wait for the burst to finish.
+        self.assertLessEqual(snap['p99Us'], 32768)
+        self.assertLess(snap['maxUs'], burstTimes[0] * 1000000 / 10)
+
+if __name__ == '__main__':
+    main()
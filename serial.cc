@@ -8,9 +8,6 @@
 using namespace awb;
 using namespace std;
 
-static int sectionCount = 1;
-static int sectionIndex = 0;
-
 void Serial::handleRead(spug::Reactor &reactor) {
     char buffer[1024];
     int amtRead = read(fd, buffer, sizeof(buffer));
@@ -20,18 +17,15 @@ void Serial::handleRead(spug::Reactor &reactor) {
         cerr << "serial: " << int(ch) << "\r" << endl;
 
         if (ch == 9) {
-            if (sectionIndex + 1 == sectionCount) {
+            // Start a new section if we're on the last one.
+            if (jackEngine.getSectionIndex() + 1 ==
+                 jackEngine.getSectionCount())
                 jackEngine.startNewSection();
-                sectionIndex++;
-                sectionCount++;
-            } else {
+            else
                 jackEngine.startNextSection();
-                sectionIndex++;
-            }
             continue;
         } else if (ch == 8) {
             jackEngine.startPrevSection();
-            sectionIndex = (sectionIndex - 1) % sectionCount;
             continue;
         }
 
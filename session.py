@@ -0,0 +1,357 @@
+"""Session files.
+
+Sessions are stored in a versioned binary format (see session.proto): a
+protobuf header describing the voices, plugins, midi registers and loops,
+followed by a blob area containing their event lists.
+
+Events are stored as fixed size records, which are much smaller and faster
+to load than pickled event objects.  Event blobs are decoded lazily (see
+LazyEvents), so loading a session with a lot of recorded material only
+costs as much as decoding the material that's actually used.
+
+Files written by older versions (a pickled awb_client.AWBClientState) can
+still be read.
+"""
+
+from dataclasses import dataclass, field
+import pickle
+import struct
+from typing import Any, Dict, IO, Iterator, List, Sequence, Union
+
+from midi import ControlChange, Event, NoteOff, NoteOn, PitchWheel, \
+    ProgramChange, SysContinue, SysEx, SysStart, SysStop
+import modes
+from session_pb2 import BlobRef, PluginRec, SessionHeader
+
+MAGIC = b'MAWBSESS'
+VERSION = 1
+
+# Magic, version and header size.
+_PREAMBLE = struct.Struct('<8sII')
+
+# Event record: time, status byte, data 1, data 2.  data 2 is signed so that
+# it can hold alsa's pitchbend values (-8192 to 8191) as well as the
+# unsigned 14 bit ones from midi files.
+_RECORD = struct.Struct('<qBBh')
+
+# SysEx length prefix.
+_LENGTH = struct.Struct('<I')
+
+_SYSEX = 0xF0
+_START = 0xFA
+_CONTINUE = 0xFB
+_STOP = 0xFC
+
+class UnsupportedEvent(Exception):
+    """Raised when trying to encode an event that we don't have a record
+    format for.
+    """
+
+def encodeEvents(events: Sequence[Event]) -> bytes:
+    """Encode a list of events as fixed size records.
+
+    Only the midi content of the events is stored: extra attributes (like
+    "source" on received events) are dropped and subclasses of the standard
+    event types (e.g. AllNotesOff) are read back as their base type.
+
+    Raises:
+        UnsupportedEvent: if there's an event that can't be encoded.
+    """
+    records = bytearray(_RECORD.size * len(events))
+    sysex = []
+    pack = _RECORD.pack_into
+    offset = 0
+    for event in events:
+        # Check NoteOn and NoteOff first, they're the most common.
+        if isinstance(event, NoteOn):
+            pack(records, offset, event.time, 0x90 | event.channel,
+                 event.note, event.velocity)
+        elif isinstance(event, NoteOff):
+            pack(records, offset, event.time, 0x80 | event.channel,
+                 event.note, event.velocity)
+        elif isinstance(event, ControlChange):
+            pack(records, offset, event.time, 0xB0 | event.channel,
+                 event.controller, event.value)
+        elif isinstance(event, ProgramChange):
+            pack(records, offset, event.time, 0xC0 | event.channel,
+                 event.program, 0)
+        elif isinstance(event, PitchWheel):
+            pack(records, offset, event.time, 0xE0 | event.channel, 0,
+                 event.value)
+        elif isinstance(event, SysEx):
+            data = event.data
+            if isinstance(data, str):
+                data = data.encode('latin-1')
+            pack(records, offset, event.time, _SYSEX, 0, 0)
+            sysex.append(_LENGTH.pack(len(data)))
+            sysex.append(bytes(data))
+        elif isinstance(event, SysStart):
+            pack(records, offset, event.time, _START, 0, 0)
+        elif isinstance(event, SysContinue):
+            pack(records, offset, event.time, _CONTINUE, 0, 0)
+        elif isinstance(event, SysStop):
+            pack(records, offset, event.time, _STOP, 0, 0)
+        else:
+            raise UnsupportedEvent(event)
+        offset += _RECORD.size
+    return bytes(records) + b''.join(sysex)
+
+def decodeEvents(data: Union[bytes, memoryview], count: int) -> List[Event]:
+    """Decode 'count' events encoded by encodeEvents()."""
+    # Events are created without calling their constructors, which is about
+    # three times faster for the common channel events.
+    # Sysex, realtime and program change events are rare enough that we just
+    # use the constructors.
+    new = object.__new__
+    end = count * _RECORD.size
+    sysexOffset = end
+    result = []
+    append = result.append
+    for time, status, data1, data2 in _RECORD.iter_unpack(data[:end]):
+        kind = status & 0xF0
+        if kind == 0x90 or kind == 0x80:
+            event = new(NoteOn if kind == 0x90 else NoteOff)
+            event.time = time
+            event.channel = status & 0xF
+            event.note = data1
+            event.velocity = data2
+        elif kind == 0xB0:
+            event = new(ControlChange)
+            event.time = time
+            event.channel = status & 0xF
+            event.controller = data1
+            event.value = data2
+        elif kind == 0xE0:
+            event = new(PitchWheel)
+            event.time = time
+            event.channel = status & 0xF
+            event.value = data2
+        elif kind == 0xC0:
+            event = ProgramChange(time, status & 0xF, data1)
+        elif status == _SYSEX:
+            size, = _LENGTH.unpack_from(data, sysexOffset)
+            sysexOffset += _LENGTH.size
+            event = SysEx(time, bytes(data[sysexOffset:sysexOffset + size]))
+            sysexOffset += size
+        elif status == _START:
+            event = SysStart(time)
+        elif status == _CONTINUE:
+            event = SysContinue(time)
+        elif status == _STOP:
+            event = SysStop(time)
+        else:
+            raise ValueError('Bad event record status %x' % status)
+        append(event)
+    return result
+
+class LazyEvents(Sequence[Event]):
+    """A sequence of events that is decoded from a blob on first access.
+
+    The length is available without decoding.
+    """
+
+    def __init__(self, data: memoryview, count: int,
+                 encoding: int = BlobRef.EVENTS
+                 ):
+        self.__data = data
+        self.__count = count
+        self.__encoding = encoding
+        self.__events = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.__events is not None
+
+    def __load(self) -> List[Event]:
+        if self.__events is None:
+            if self.__encoding == BlobRef.PICKLE:
+                self.__events = pickle.loads(self.__data)
+            else:
+                self.__events = decodeEvents(self.__data, self.__count)
+
+            # Release the reference to the file data.
+            self.__data = None
+        return self.__events
+
+    def __len__(self):
+        return self.__count
+
+    def __getitem__(self, index):
+        return self.__load()[index]
+
+    def __iter__(self) -> Iterator[Event]:
+        return iter(self.__load())
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return 'LazyEvents(%d events%s)' % (self.__count,
+                                            '' if self.loaded else ', unloaded'
+                                            )
+
+@dataclass
+class SavedLoop:
+    """The contents of a loop register.
+
+    Attrs:
+        events: The loop events, sorted by time relative to the start of the
+            loop.
+        period: Length of the loop in ticks.
+    """
+    events: Sequence[Event]
+    period: int
+
+@dataclass
+class Session:
+    """Everything stored in a session file."""
+    voices: List[modes.StateVec] = field(default_factory=list)
+    plugins: List[Any] = field(default_factory=list)
+    registers: Dict[str, Sequence[Event]] = field(default_factory=dict)
+    loops: Dict[int, SavedLoop] = field(default_factory=dict)
+
+class _BlobWriter:
+    """Accumulates the blob area."""
+
+    def __init__(self):
+        self.blobs = []
+        self.size = 0
+
+    def addEvents(self, ref: BlobRef, events: Sequence[Event]) -> None:
+        try:
+            data = encodeEvents(events)
+            ref.encoding = BlobRef.EVENTS
+        except UnsupportedEvent:
+            data = pickle.dumps(list(events))
+            ref.encoding = BlobRef.PICKLE
+        ref.offset = self.size
+        ref.size = len(data)
+        ref.event_count = len(events)
+        self.blobs.append(data)
+        self.size += len(data)
+
+def _writeVoice(rec, voice: modes.StateVec) -> None:
+    for name in sorted(dir(voice)):
+        state = getattr(voice, name)
+        sub = rec.sub_states.add()
+        sub.name = name
+        if type(state) is modes.MidiState:
+            sub.midi.port_name = state.portName
+            sub.midi.bank = state.bank
+            sub.midi.program = state.program
+            sub.midi.channel = state.channel
+        elif type(state) is modes.Routing and \
+                all(type(route) in (modes.MidiRoute, modes.JackRoute)
+                    for route in state.routes):
+            sub.routing.SetInParent()
+            for route in state.routes:
+                routeRec = sub.routing.routes.add()
+                routeRec.kind = routeRec.MIDI \
+                    if type(route) is modes.MidiRoute else routeRec.JACK
+                routeRec.src = route.src
+                routeRec.dst = route.dst
+        else:
+            sub.pickled = pickle.dumps(state)
+
+def _readVoice(rec) -> modes.StateVec:
+    states = {}
+    for sub in rec.sub_states:
+        which = sub.WhichOneof('state')
+        if which == 'midi':
+            states[sub.name] = modes.MidiState(sub.midi.port_name,
+                                               sub.midi.bank,
+                                               sub.midi.program,
+                                               sub.midi.channel
+                                               )
+        elif which == 'routing':
+            states[sub.name] = modes.Routing(*[
+                (modes.MidiRoute if route.kind == route.MIDI
+                 else modes.JackRoute)(route.src, route.dst)
+                for route in sub.routing.routes
+            ])
+        else:
+            states[sub.name] = pickle.loads(sub.pickled)
+    return modes.StateVec(**states)
+
+def _writePlugin(rec: PluginRec, plugin: Any) -> None:
+    rec.module = type(plugin).__module__
+    rec.class_name = type(plugin).__qualname__
+    rec.state = pickle.dumps(plugin)
+
+def _readPlugin(rec: PluginRec) -> Any:
+    return pickle.loads(rec.state)
+
+def write(session: Session, out: IO[bytes]) -> None:
+    """Write a session to 'out'."""
+    header = SessionHeader()
+    blobs = _BlobWriter()
+    for voice in session.voices:
+        _writeVoice(header.voices.add(), voice)
+    for plugin in session.plugins:
+        _writePlugin(header.plugins.add(), plugin)
+    for name, events in session.registers.items():
+        rec = header.registers.add()
+        rec.name = name
+        blobs.addEvents(rec.events, events)
+    for index, loop in sorted(session.loops.items()):
+        rec = header.loops.add()
+        rec.index = index
+        rec.period = loop.period
+        blobs.addEvents(rec.events, loop.events)
+
+    headerData = header.SerializeToString()
+    out.write(_PREAMBLE.pack(MAGIC, VERSION, len(headerData)))
+    out.write(headerData)
+    for blob in blobs.blobs:
+        out.write(blob)
+
+def read(src: IO[bytes]) -> Session:
+    """Read a session from 'src'.
+
+    Plugins whose classes can no longer be loaded are skipped (with a
+    warning) rather than failing the whole session.
+
+    Raises:
+        ValueError: if the session was written by a newer, incompatible
+            version.
+    """
+    # The whole file is read into memory rather than mapped: the lazy event
+    # lists refer to it, and sessions are commonly saved back to the file
+    # they were loaded from.
+    data = src.read()
+    if data[:len(MAGIC)] != MAGIC:
+        # An old pickled AWBClientState.
+        state = pickle.loads(data)
+        return Session(state.voices, state.plugins)
+
+    magic, version, headerSize = _PREAMBLE.unpack_from(data, 0)
+    if version > VERSION:
+        raise ValueError('Session file version %d is newer than the '
+                         'supported version %d' % (version, VERSION)
+                         )
+    header = SessionHeader()
+    header.ParseFromString(data[_PREAMBLE.size:_PREAMBLE.size + headerSize])
+    blobArea = memoryview(data)[_PREAMBLE.size + headerSize:]
+
+    def lazyEvents(ref: BlobRef) -> LazyEvents:
+        return LazyEvents(blobArea[ref.offset:ref.offset + ref.size],
+                          ref.event_count,
+                          ref.encoding
+                          )
+
+    session = Session()
+    session.voices = [_readVoice(voice) for voice in header.voices]
+    for rec in header.plugins:
+        try:
+            session.plugins.append(_readPlugin(rec))
+        except Exception as ex:
+            print('unable to load plugin %s.%s: %s' %
+                  (rec.module, rec.class_name, ex)
+                  )
+    session.registers = {rec.name: lazyEvents(rec.events)
+                         for rec in header.registers
+                         }
+    session.loops = {rec.index: SavedLoop(lazyEvents(rec.events), rec.period)
+                     for rec in header.loops
+                     }
+    return session
@@ -0,0 +1,112 @@
+"""Benchmark for session loading.
+
+Builds a session with a few voices, 32 midi registers and 4 loops (about
+400k events in all) and compares the size and load time of the old pickled
+format with the session format.  For the session format, the time to load
+the session is reported separately from the time to decode all of the
+events, since event blobs are only decoded when they're used.
+"""
+
+import os
+import pickle
+import tempfile
+import time
+from midi import ControlChange, NoteOff, NoteOn, PitchWheel
+import modes
+import session
+
+REGISTERS = 32
+LOOPS = 4
+EVENTS_PER_REGISTER = 12000
+
+class State:
+    """Stand-in for awb_client.AWBClientState (which we can't import without
+    jack).
+    """
+
+    def __init__(self, voices, plugins, registers, loops):
+        self.voices = voices
+        self.plugins = plugins
+        self.registers = registers
+        self.loops = loops
+
+def makeEvents(count):
+    events = []
+    for i in range(count // 4):
+        note = 36 + i % 48
+        events.append(NoteOn(i * 64, 0, note, 100))
+        events.append(ControlChange(i * 64 + 8, 0, 7, i % 128))
+        events.append(PitchWheel(i * 64 + 16, 0, 8192 - i % 1000))
+        events.append(NoteOff(i * 64 + 32, 0, note, 0))
+    return events
+
+def makeSession():
+    voices = []
+    for i in range(16):
+        voices.append(modes.StateVec(
+            synth=modes.MidiState('synth/in', 0, i, i),
+            routing=modes.Routing(
+                modes.MidiRoute('keyboard/out', 'synth/in'),
+                modes.JackRoute('synth:out_l', 'system:playback_1'),
+            )
+        ))
+    registers = {'r%d' % i: makeEvents(EVENTS_PER_REGISTER)
+                 for i in range(REGISTERS)
+                 }
+    loops = {i: session.SavedLoop(makeEvents(EVENTS_PER_REGISTER), 512 * 16)
+             for i in range(LOOPS)
+             }
+    return session.Session(voices, [], registers, loops)
+
+def timeIt(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+def main():
+    data = makeSession()
+    tmpdir = tempfile.mkdtemp()
+    pickleFile = os.path.join(tmpdir, 'session.pickle')
+    sessionFile = os.path.join(tmpdir, 'session.mawb')
+
+    with open(pickleFile, 'wb') as out:
+        pickle.dump(State(data.voices, data.plugins, data.registers,
+                          data.loops
+                          ),
+                    out
+                    )
+    with open(sessionFile, 'wb') as out:
+        session.write(data, out)
+
+    def loadPickle():
+        with open(pickleFile, 'rb') as src:
+            return pickle.load(src)
+
+    def loadSession():
+        with open(sessionFile, 'rb') as src:
+            return session.read(src)
+
+    _, pickleTime = timeIt(loadPickle)
+    loaded, sessionTime = timeIt(loadSession)
+
+    def decodeAll():
+        for events in loaded.registers.values():
+            len(events[0:1])
+        for loop in loaded.loops.values():
+            len(loop.events[0:1])
+    _, decodeTime = timeIt(decodeAll)
+
+    print('pickle:  %8d bytes, load %7.1fms' %
+          (os.path.getsize(pickleFile), pickleTime * 1000)
+          )
+    print('session: %8d bytes, load %7.1fms, decode all events %7.1fms' %
+          (os.path.getsize(sessionFile), sessionTime * 1000,
+           decodeTime * 1000)
+          )
+
+    os.remove(pickleFile)
+    os.remove(sessionFile)
+    os.rmdir(tmpdir)
+
+if __name__ == '__main__':
+    main()
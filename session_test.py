@@ -0,0 +1,170 @@
+
+import io
+import pickle
+import struct
+import tempfile
+from unittest import main, TestCase
+from midi import AllNotesOff, ControlChange, NoteOff, NoteOn, PitchWheel, \
+    ProgramChange, SetTempo, SysEx, SysStart, SysStop
+import modes
+import session
+
+class FakePlugin:
+
+    def __init__(self, value):
+        self.value = value
+
+class StatefulPlugin:
+    """Doesn't pickle its cache."""
+
+    def __init__(self, value):
+        self.value = value
+        self.cache = {}
+
+    def __getstate__(self):
+        return {'value': self.value}
+
+    def __setstate__(self, state):
+        self.value = state['value']
+        self.cache = {'restored': True}
+
+class LegacyState:
+
+    def __init__(self, voices, plugins):
+        self.voices = voices
+        self.plugins = plugins
+
+def makeEvents():
+    return [
+        NoteOn(0, 1, 60, 100),
+        ControlChange(10, 1, 7, 127),
+        PitchWheel(20, 1, -8192),
+        ProgramChange(30, 2, 5),
+        SysEx(40, b'\x7e\x7f\x09\x01'),
+        SysStart(50),
+        NoteOff(60, 1, 60, 0),
+        SysStop(1 << 40),
+    ]
+
+def makeVoice():
+    return modes.StateVec(
+        synth=modes.MidiState('synth/in', 1, 2, 3),
+        routing=modes.Routing(modes.MidiRoute('kbd/out', 'synth/in'),
+                              modes.JackRoute('synth:out', 'system:in')
+                              )
+    )
+
+class SessionTest(TestCase):
+
+    def roundTrip(self, data: session.Session) -> session.Session:
+        out = io.BytesIO()
+        session.write(data, out)
+        return session.read(io.BytesIO(out.getvalue()))
+
+    def testEventEncoding(self):
+        events = makeEvents()
+        data = session.encodeEvents(events)
+        self.assertEqual(session.decodeEvents(data, len(events)), events)
+
+    def testSubclassesDecodeAsBase(self):
+        data = session.encodeEvents([AllNotesOff(0, 3)])
+        self.assertEqual(session.decodeEvents(data, 1),
+                         [ControlChange(0, 3, 123, 0)]
+                         )
+
+    def testUnsupportedEvent(self):
+        with self.assertRaises(session.UnsupportedEvent):
+            session.encodeEvents([SetTempo(0, 500000)])
+
+    def testRoundTrip(self):
+        events = makeEvents()
+        result = self.roundTrip(session.Session(
+            [makeVoice()],
+            [FakePlugin(100)],
+            {'a': events, 'tempo': [SetTempo(0, 500000)]},
+            {2: session.SavedLoop(events, 2048)}
+        ))
+
+        self.assertEqual(len(result.voices), 1)
+        self.assertEqual(result.voices[0].synth,
+                         modes.MidiState('synth/in', 1, 2, 3)
+                         )
+        self.assertEqual(result.voices[0].routing, makeVoice().routing)
+
+        self.assertIsInstance(result.plugins[0], FakePlugin)
+        self.assertEqual(result.plugins[0].value, 100)
+
+        self.assertEqual(list(result.registers['a']), events)
+
+        # Unsupported events get pickled.
+        self.assertEqual(list(result.registers['tempo']),
+                         [SetTempo(0, 500000)]
+                         )
+
+        self.assertEqual(list(result.loops), [2])
+        self.assertEqual(result.loops[2].period, 2048)
+        self.assertEqual(list(result.loops[2].events), events)
+
+    def testLazyLoading(self):
+        events = makeEvents()
+        result = self.roundTrip(session.Session(registers={'a': events}))
+        register = result.registers['a']
+        self.assertFalse(register.loaded)
+        self.assertEqual(len(register), len(events))
+        self.assertFalse(register.loaded)
+        self.assertEqual(register[0], events[0])
+        self.assertTrue(register.loaded)
+
+    def testRealFile(self):
+        events = makeEvents()
+        with tempfile.TemporaryFile() as file:
+            session.write(session.Session(registers={'a': events}), file)
+            file.seek(0)
+            result = session.read(file)
+        self.assertEqual(list(result.registers['a']), events)
+
+    def testSaveToLoadedFile(self):
+        events = makeEvents()
+        with tempfile.NamedTemporaryFile() as file:
+            session.write(session.Session(registers={'a': events}), file)
+            file.flush()
+            with open(file.name, 'rb') as src:
+                result = session.read(src)
+            with open(file.name, 'wb') as out:
+                session.write(result, out)
+            with open(file.name, 'rb') as src:
+                result = session.read(src)
+        self.assertEqual(list(result.registers['a']), events)
+
+    def testPluginPickleHooks(self):
+        result = self.roundTrip(session.Session(plugins=[StatefulPlugin(1)]))
+        self.assertEqual(result.plugins[0].value, 1)
+        self.assertEqual(result.plugins[0].cache, {'restored': True})
+
+    def testMissingPluginClass(self):
+        out = io.BytesIO()
+        session.write(session.Session(plugins=[FakePlugin(1)]), out)
+        data = out.getvalue().replace(b'FakePlugin', b'GonePlugin')
+        result = session.read(io.BytesIO(data))
+        self.assertEqual(result.plugins, [])
+
+    def testNewerVersion(self):
+        out = io.BytesIO()
+        session.write(session.Session(), out)
+        data = bytearray(out.getvalue())
+        struct.pack_into('<I', data, len(session.MAGIC), session.VERSION + 1)
+        with self.assertRaises(ValueError):
+            session.read(io.BytesIO(bytes(data)))
+
+    def testLegacyPickle(self):
+        data = pickle.dumps(LegacyState([makeVoice()], [FakePlugin(1)]))
+        result = session.read(io.BytesIO(data))
+        self.assertEqual(result.voices[0].synth,
+                         modes.MidiState('synth/in', 1, 2, 3)
+                         )
+        self.assertEqual(result.plugins[0].value, 1)
+        self.assertEqual(result.registers, {})
+        self.assertEqual(result.loops, {})
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,20 @@ setup(
         'amidi',
         'amixer',
         'awb_client',
+        'clock',
+        'eventloop',
+        'latency',
         'lilv',
         'midi',
+        'pipeline',
+        'pluginloader',
+        'ringbuf',
+        'routeoffload',
+        'scheduler',
+        'session',
         'shorthand',
+        'spsc',
+        'topology',
     ],
     install_requires = [
         'typing', # typing-3.6.6
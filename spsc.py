@@ -0,0 +1,183 @@
+"""Lock-free handoff between threads.
+
+SPSCRing is a bounded single-producer/single-consumer queue.  The producer
+only ever writes the tail index and the consumer only ever writes the head
+index, so neither side needs a lock.
+
+Handoff gives every producing thread its own SPSCRing feeding a single
+consumer, and wakes the consumer through an eventfd.
+"""
+
+import os
+from threading import current_thread, local, Lock, Thread
+import time
+from typing import Any, List, Tuple
+
+class SPSCRing:
+    """A bounded single-producer/single-consumer queue.
+
+    Args:
+        capacity: Number of slots, must be a power of two.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError('Capacity must be a power of two, got %r' %
+                             capacity
+                             )
+        self.__buf : List[Any] = [None] * capacity
+        self.__mask = capacity - 1
+
+        # Index of the next slot to read (only written by the consumer).
+        self.__head = 0
+
+        # Index of the next slot to write (only written by the producer).
+        self.__tail = 0
+
+    def __len__(self):
+        return self.__tail - self.__head
+
+    def push(self, item: Any) -> bool:
+        """Add an item to the ring.  Returns False if the ring is full.
+
+        Must only be called from the producer thread.
+        """
+        tail = self.__tail
+        if tail - self.__head > self.__mask:
+            return False
+        self.__buf[tail & self.__mask] = item
+
+        # Publish the item only after it has been stored.
+        self.__tail = tail + 1
+        return True
+
+    def popAll(self, out: List[Any]) -> None:
+        """Move all available items to 'out'.
+
+        Must only be called from the consumer thread.
+        """
+        head = self.__head
+        tail = self.__tail
+        buf = self.__buf
+        mask = self.__mask
+        while head != tail:
+            slot = head & mask
+            out.append(buf[slot])
+            buf[slot] = None
+            head += 1
+        self.__head = head
+
+class EventFD:
+    """A wakeup flag that can be waited on with select()/poll().
+
+    Uses an eventfd where available, a pipe otherwise.
+    """
+
+    def __init__(self):
+        if hasattr(os, 'eventfd'):
+            self.fd = self.__writeFd = \
+                os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self.fd, self.__writeFd = os.pipe()
+            os.set_blocking(self.fd, False)
+            os.set_blocking(self.__writeFd, False)
+
+    def signal(self) -> None:
+        """Wake up anything waiting on the fd."""
+        try:
+            os.write(self.__writeFd, b'\x01\0\0\0\0\0\0\0')
+        except BlockingIOError:
+            # The counter (or pipe) is full, which means we're already
+            # signaled.
+            pass
+
+    def clear(self) -> None:
+        """Reset the signaled state."""
+        try:
+            if self.fd == self.__writeFd:
+                # Reading an eventfd resets it.
+                os.read(self.fd, 8)
+            else:
+                while os.read(self.fd, 4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def close(self) -> None:
+        os.close(self.fd)
+        if self.__writeFd != self.fd:
+            os.close(self.__writeFd)
+
+class Handoff:
+    """Passes items from any number of producer threads to a single
+    consumer thread without locking.
+
+    Each producer thread gets its own SPSCRing the first time it calls
+    put(), so items from a given thread are always received in order.  The
+    ring is dropped once the thread has exited and the ring is drained.
+
+    Args:
+        capacity: Capacity of each producer's ring.  When a ring is full,
+            put() waits for the consumer to drain it.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self.__capacity = capacity
+        self.__local = local()
+
+        # The rings for all producers and the producer threads.  This is
+        # replaced (not modified) when a producer is added or removed, so the
+        # consumer can iterate over it without locking.
+        self.__rings : List[Tuple[SPSCRing, Thread]] = []
+        self.__lock = Lock()
+        self.wakeup = EventFD()
+
+    def __getRing(self) -> SPSCRing:
+        ring = getattr(self.__local, 'ring', None)
+        if ring is None:
+            ring = self.__local.ring = SPSCRing(self.__capacity)
+            with self.__lock:
+                self.__rings = self.__rings + [(ring, current_thread())]
+        return ring
+
+    def put(self, item: Any) -> None:
+        """Pass an item to the consumer and wake it up."""
+        ring = self.__getRing()
+        while not ring.push(item):
+            self.wakeup.signal()
+            time.sleep(0.001)
+        self.wakeup.signal()
+
+    def drain(self) -> List[Any]:
+        """Returns all pending items.  Must only be called from the consumer
+        thread.
+
+        Items from each producer are in the order they were put, there is no
+        ordering between producers.
+        """
+        # Clear before reading so that a put() that happens after we've
+        # checked its ring still leaves us signaled.
+        self.wakeup.clear()
+        items = []
+        exited = []
+        for entry in self.__rings:
+            ring, thread = entry
+
+            # Check the thread before draining: if it had already exited,
+            # nothing can be added to its ring after we've drained it.
+            if not thread.is_alive():
+                exited.append(entry)
+            ring.popAll(items)
+        if exited:
+            with self.__lock:
+                self.__rings = [entry for entry in self.__rings
+                                if entry not in exited
+                                ]
+        return items
+
+    def getProducerCount(self) -> int:
+        """Returns the number of producer rings currently allocated."""
+        return len(self.__rings)
+
+    def close(self) -> None:
+        self.wakeup.close()
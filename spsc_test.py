@@ -0,0 +1,92 @@
+
+import select
+from threading import Thread
+from unittest import main, TestCase
+from spsc import EventFD, Handoff, SPSCRing
+
+class SPSCRingTest(TestCase):
+
+    def testPushPop(self):
+        ring = SPSCRing(4)
+        for i in range(4):
+            self.assertTrue(ring.push(i))
+        self.assertFalse(ring.push(4))
+        self.assertEqual(len(ring), 4)
+        out = []
+        ring.popAll(out)
+        self.assertEqual(out, [0, 1, 2, 3])
+
+        # Wrap around.
+        for i in range(3):
+            ring.push(i + 10)
+        out = []
+        ring.popAll(out)
+        self.assertEqual(out, [10, 11, 12])
+        self.assertEqual(len(ring), 0)
+
+    def testCapacity(self):
+        with self.assertRaises(ValueError):
+            SPSCRing(3)
+
+class EventFDTest(TestCase):
+
+    def testSignal(self):
+        efd = EventFD()
+        try:
+            self.assertEqual(select.select([efd.fd], [], [], 0)[0], [])
+            efd.signal()
+            efd.signal()
+            self.assertEqual(select.select([efd.fd], [], [], 0)[0], [efd.fd])
+            efd.clear()
+            self.assertEqual(select.select([efd.fd], [], [], 0)[0], [])
+        finally:
+            efd.close()
+
+class HandoffTest(TestCase):
+
+    def testProducers(self):
+        # Small rings so that producers have to wait for the consumer.
+        handoff = Handoff(16)
+        def produce(name):
+            for i in range(1000):
+                handoff.put((name, i))
+
+        threads = [Thread(target=produce, args=(name,)) for name in 'abc']
+        for thread in threads:
+            thread.start()
+
+        received = {'a': [], 'b': [], 'c': []}
+        total = 0
+        while total < 3000:
+            select.select([handoff.wakeup.fd], [], [], 1)
+            for name, i in handoff.drain():
+                received[name].append(i)
+                total += 1
+        for thread in threads:
+            thread.join()
+
+        # Each producer's items arrive in order.
+        for items in received.values():
+            self.assertEqual(items, list(range(1000)))
+        handoff.close()
+
+    def testExitedProducersAreReclaimed(self):
+        handoff = Handoff(16)
+        for i in range(10):
+            thread = Thread(target=handoff.put, args=(i,))
+            thread.start()
+            thread.join()
+        self.assertEqual(handoff.getProducerCount(), 10)
+
+        # The rings are drained before they're dropped.
+        self.assertEqual(sorted(handoff.drain()), list(range(10)))
+        self.assertEqual(handoff.getProducerCount(), 0)
+
+        # Live producers keep their rings.
+        handoff.put('x')
+        self.assertEqual(handoff.drain(), ['x'])
+        self.assertEqual(handoff.getProducerCount(), 1)
+        handoff.close()
+
+if __name__ == '__main__':
+    main()
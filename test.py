@@ -2,13 +2,14 @@
 from io import StringIO
 
 from mawb_pb2 import PBTrack, RPC, RECORD, IDLE, PLAY
-import socket
 import struct
 import subprocess
 import sys
 import time
 import unittest
 
+from comm import connectWithBackoff, launchDaemon
+
 import midi as m
 import midifile as mf
 
@@ -18,37 +19,30 @@ class Test(unittest.TestCase):
     def startDaemon(self):
         awbdCommand = ['./awbd']
         if debug:
-            awbdCommand.insert(0, 'gdb')
+            awbdCommand[:0] = ['gdb', '--args']
 
-        self.daemon = subprocess.Popen(awbdCommand)
-        time.sleep(1)
-        if debug:
-            # Bind to a socket so the user can notify us when the daemon has
-            # been started.
-            self.debug_socket = s = \
-                socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
-            s.bind(('localhost', 9191))
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.listen(5)
-            s.accept()
+        # Under the debugger, wait for as long as it takes the user to start
+        # the daemon.
+        self.daemon = launchDaemon(awbdCommand, None if debug else 10)
         subprocess.call(['jack_connect', 'fluidsynth:l_00', 'system:playback_1'])
         subprocess.call(['jack_connect', 'fluidsynth:r_00', 'system:playback_2'])
 
         # Create the connection to the server.
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
+        self.sock = connectWithBackoff()
 
     def setUp(self):
         self.startDaemon()
 
     def tearDown(self):
+        self.sock.close()
         self.daemon.kill()
+        self.daemon.wait()
 
     def sendCommand(self, rpc):
         parcel = rpc.SerializeToString()
         data = struct.pack('<I', len(parcel)) + parcel
 
-        self.sock.connect(('127.0.0.1', 8193))
-        self.sock.send(data)
+        self.sock.sendall(data)
 
     def makeMidiTrack(self):
         track = m.Track()
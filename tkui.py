@@ -5,12 +5,14 @@ from heapq import merge
 from midi import Event
 from modes import MidiState
 from tkinter import Button, Entry, Frame, Label, Listbox, Menu, Menubutton, \
-    Text, Tk, Toplevel, Widget, BOTH, LEFT, NORMAL, NSEW, RAISED, W
-from typing import Callable, List, Tuple
-from awb_client import offsetEventTimes, AWBClient, CallableEvent, ACTIVE, \
+    Text, Tk, Toplevel, Widget, BOTH, END, LEFT, NORMAL, NSEW, RAISED, W
+from typing import Callable, List, Optional, Tuple
+from awb_client import offsetEventTimes, AWBClient, ACTIVE, \
     NONEMPTY, RECORD, STICKY
 from commands import Program, ProgramCommands, ScriptInterpreter
-import time
+from pluginloader import PluginStartupError
+from scheduler import PeriodicSource
+from session import SavedLoop
 import traceback
 
 class Channel(Frame):
@@ -384,15 +386,17 @@ class EventRecorder:
         self.name = name
         self.events = []
 
-        # __startTime is the time of the first event (seconds since the epoch).
-        self.__startTime : float = 0
+        # __startTime is the time of the first event (ticks since the client's
+        # start of time).
+        self.__startTime : Optional[int] = None
 
     def __call__(self, client: AWBClient, event: Event) -> bool:
-        if self.__startTime:
-            event.time = client.getTicks(time.time() - self.__startTime)
-        else:
-            self.__startTime = time.time()
-            event.time = 0
+        # Use the kernel's receive time so the recording doesn't pick up
+        # input thread latency.
+        t = client.getEventTicks(event)
+        if self.__startTime is None:
+            self.__startTime = t
+        event.time = t - self.__startTime
         self.events.append(event)
         return False
 
@@ -469,6 +473,22 @@ f'''xxx record end, start time:
     duration: {self.__duration}''')
             return self.__duration - (t - startTime), self.__duration
 
+    def alignLoop(self, duration: int) -> int:
+        """Returns the time (relative to now) to start playing an existing
+        loop of length 'duration' so that it is in phase with the other
+        loops.
+
+        If there are no other loops, the loop starts now and becomes the
+        master loop.
+        """
+        t = self.__client.getTicks()
+        if self.__startTime is None:
+            self.__startTime = t
+            self.__duration = duration
+            return 0
+        period = self.__duration or duration
+        return (period - (t - self.__startTime) % period) % period
+
 
 class LoopRegister:
     """Stores a set of events as a loop.
@@ -476,46 +496,46 @@ class LoopRegister:
     The loop register has three states: recording, playing and idle.  It
     transitions from recording to playing and then from playing to idle and
     then from idle to playing, which works well for a single button control.
+
+    A loop register restored from a saved loop starts out idle.
     """
 
-    def __init__(self, client: AWBClient, master: LoopMaster):
+    def __init__(self, client: AWBClient, master: LoopMaster,
+                 saved: Optional[SavedLoop] = None):
         self.__client = client
         self.__master = master
-        self.__events = []
-        self.__state = LRState.RECORD
+        self.__events = saved.events if saved else []
+        self.__period : Optional[int] = saved.period if saved else None
+        self.__state = LRState.IDLE if saved else LRState.RECORD
         self.__start : Optional[int] = None
+        self.__source : Optional[PeriodicSource] = None
 
     def nextState(self):
-        def reschedule(client: AWBClient):
-            if self.__state == LRState.PLAYING:
-                print(f'xxx rescheduling events at {self.__client.getTicks()}')
-                self.__client.scheduleMidiEvents(self.__events)
-            else:
-                print(f'xxx not rescheduling events')
-
         if self.__state == LRState.RECORD:
-            restartTime, duration = self.__master.recordEndTime(self.__start)
-            print(f'xxx adding reschedule event at +{duration}')
-            self.__events.append(CallableEvent(duration, reschedule))
+            restartTime, self.__period = \
+                self.__master.recordEndTime(self.__start)
             self.__state = LRState.PLAYING
 
-            # schedule an event to kick off the first replay loop.  If
-            # restartTime is now just do it without scheduling a CallableEvent.
-            if not restartTime:
-                print(f'xxx restarting loop immediately')
-                reschedule(self.__client)
-            else:
-                print(f'xxx restarting loop in +{restartTime}')
-                self.__client.scheduleMidiEvent(
-                    CallableEvent(restartTime, reschedule)
-                )
+            # Play the loop as a periodic source starting at the beginning of
+            # the next master cycle (which may be now).
+            self.__source = self.__client.schedulePeriodic(
+                self.__events, self.__period, restartTime, tag=self
+            )
         elif self.__state == LRState.PLAYING:
             self.__state = LRState.IDLE
+            self.__source.mute()
         elif self.__state == LRState.IDLE:
             self.__state = LRState.PLAYING
-            # TODO: need to schedule this for the next period if any loops are
-            # currently playing
-            reschedule(self.__events)
+            if self.__source is None:
+                # A restored loop that hasn't been played yet.
+                self.__source = self.__client.schedulePeriodic(
+                    self.__events, self.__period,
+                    self.__master.alignLoop(self.__period), tag=self
+                )
+            else:
+                # Unmuting takes effect at the next period, so we stay in
+                # sync with the other loops.
+                self.__source.unmute()
 
     def addEvents(self, events):
         # Ignore events added when not recording.
@@ -539,6 +559,14 @@ class LoopRegister:
     def state(self):
         return self.__state
 
+    def getSavedLoop(self) -> Optional[SavedLoop]:
+        """Returns the loop contents for persistence, None if the loop is
+        still being recorded.
+        """
+        if self.__state == LRState.RECORD:
+            return None
+        return SavedLoop(self.__events, self.__period)
+
 
 class MidiRegisters(Toplevel):
     """Window containing and controlling a set of midi registers.
@@ -552,7 +580,6 @@ class MidiRegisters(Toplevel):
         super().__init__()
         self.client = client
         self.__recorder : Optional[EventRecorder] = None
-        self.__registers : Dict[str, RecordingInfo] = {}
         self.__loopers : List[Optional[LoopRegister]] = [None] * 4
         self.__recordingLooper : Optional[int] = None
         self.__master = LoopMaster(client)
@@ -562,10 +589,21 @@ class MidiRegisters(Toplevel):
         self.list = Listbox(self.frame)
         self.list.pack(expand=True, fill=BOTH)
 
-        # Create the looper status controls
+        # The registers are stored in the client so they get saved with the
+        # session.
+        for name in client.registers:
+            self.list.insert(END, name)
+
+        # Create the looper status controls, restoring any saved loops.
         self.__loopStats = []
         for i in range(4):
-            stat = Label(self.frame, text=f'Loop {i + 1}: EMPTY')
+            saved = client.loops.get(i)
+            if saved:
+                self.__loopers[i] = LoopRegister(client, self.__master, saved)
+            stat = Label(self.frame,
+                         text=f'Loop {i + 1}: ' +
+                            (str(LRState.IDLE) if saved else 'EMPTY')
+                         )
             self.__loopStats.append(stat)
             stat.pack()
 
@@ -585,7 +623,7 @@ class MidiRegisters(Toplevel):
                 sel = self.list.curselection()
                 if sel:
                     key = self.list.get(sel[0])
-                    del self.__registers[key]
+                    del self.client.registers[key]
                     self.list.delete(sel[0])
             elif event.keysym in ('F1', 'F2', 'F3', 'F4'):
                 index = int(event.keysym[1]) - 1
@@ -595,6 +633,9 @@ class MidiRegisters(Toplevel):
                     looper.nextState()
                     self.__loopStats[index].configure(
                         text=f'Loop {index + 1}: {looper.state}')
+                    saved = looper.getSavedLoop()
+                    if saved:
+                        self.client.loops[index] = saved
                 else:
                     print(f'xxx creating looper at {index}')
                     self.__loopers[index] = \
@@ -604,7 +645,7 @@ class MidiRegisters(Toplevel):
 
         # play an existing register.
         try:
-            events = self.__registers[event.keysym].events
+            events = self.client.registers[event.keysym]
             self.client.scheduleMidiEvents(events)
             if self.__recordingLooper is not None:
                 self.__loopers[self.__recordingLooper].addEvents(events)
@@ -615,10 +656,10 @@ class MidiRegisters(Toplevel):
         # If the key we're recording was pressed again, end record.
         if self.__recorder and self.__recorder.name == event.keysym:
             trackInfo = self.__recorder.getRecordingInfo()
-            self.client.inputProcessors.remove(self.__recorder)
+            self.client.removeInputProcessor(self.__recorder)
             self.__recorder = None
-            self.list.insert(len(self.__registers), str(trackInfo))
-            self.__registers[trackInfo.name] = trackInfo
+            self.list.insert(END, str(trackInfo))
+            self.client.registers[trackInfo.name] = trackInfo.events
             self.status.configure(text=self.STATUS_TEXT)
 
         # If we're not recording, start recording on that key.
@@ -627,7 +668,7 @@ class MidiRegisters(Toplevel):
             self.status.configure(
                 text=f'Recording on {event.keysym}: press again to finish'
             )
-            self.client.inputProcessors.append(self.__recorder)
+            self.client.addInputProcessor(self.__recorder)
 
 class MainWin(Tk):
 
@@ -719,7 +760,10 @@ class MainWin(Tk):
 
     def __load(self, *args):
         # TODO: display a file selector.
-        self.client.readFrom(open('noname.mawb', 'rb'))
+        try:
+            self.client.readFrom(open('noname.mawb', 'rb'))
+        except PluginStartupError as ex:
+            print('error initializing plugins: %s' % ex)
 
     def __plugins(self, *args):
         top = Toplevel()
@@ -742,11 +786,12 @@ class MainWin(Tk):
                                   )
 
     def togglePause(self, event):
-        self.client.togglePause()
+        # The client doesn't see the new state until the daemon pushes it.
         if self.client.paused:
-            self.status.configure(text = 'Paused')
-        else:
             self.status.configure(text = 'Playing')
+        else:
+            self.status.configure(text = 'Paused')
+        self.client.togglePause()
 
     def clearAllState(self, event):
         self.client.clearAllState()
@@ -938,10 +983,7 @@ class TextSelect(Frame):
         return 'break'
 
 def _getPorts(client: 'AWBClient') -> List[str]:
-    result = []
-    for port in client.seq.iterPortInfos():
-        result.append(port.fullName)
-    return result
+    return [port.fullName for port in client.seq.snapshot().ports]
 
 class ProgramPanel(Frame):
     """Lets you configure the program."""
@@ -994,7 +1036,7 @@ class ProgramPanel(Frame):
         anchor = None
         anchor = Frame(self.text)
         self.text.window_create('insert', window=anchor)
-        selector = TextSelect(self, anchor, _getPorts(self.__client),
+        selector = TextSelect(self, anchor, _getPorts(self.client),
                               destroyAnchor = True)
         return 'break'
 
@@ -1058,7 +1100,19 @@ class Plugins(Frame):
         sel = self.__availList.curselection()
         if len(sel) != 1:
             return
-        plugin = self.__client.loadPlugin(self.__availList.get(sel[0]))
+        # Load the plugin in the background so a slow plugin doesn't freeze
+        # the UI, and poll for it to finish.
+        future = self.__client.loadPluginAsync(self.__availList.get(sel[0]))
+        def poll():
+            if not future.done():
+                self.after(50, poll)
+            elif future.exception():
+                print('error loading plugin: %s' % future.exception())
+            else:
+                self.__added(future.result())
+        poll()
+
+    def __added(self, plugin):
         ui = plugin.getUI()
         if ui:
             # TODO: replace Toplevel with PluginFrame above.  When the frame
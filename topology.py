@@ -0,0 +1,136 @@
+"""Immutable snapshots of the ALSA sequencer topology.
+
+A Topology is a frozen picture of all of the clients, ports and subscriptions
+in the system at a given point in time.  They are produced by
+amidi.Sequencer.snapshot() in a single pass over the sequencer and, unlike the
+ClientInfo/PortInfo wrappers, never go back to ALSA when you look at them.
+Two snapshots can be compared with Topology.diff().
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+@dataclass(frozen=True)
+class Addr:
+    """A sequencer address (client and port number)."""
+    client: int
+    port: int
+
+@dataclass(frozen=True)
+class ClientSnapshot:
+    id: int
+    name: str
+
+@dataclass(frozen=True)
+class PortSnapshot:
+    client: ClientSnapshot
+    port: int
+    name: str
+
+    # Capability bits (SND_SEQ_PORT_CAP_*) and port type bits
+    # (SND_SEQ_PORT_TYPE_*).
+    caps: int = 0
+    type: int = 0
+
+    @property
+    def addr(self) -> Addr:
+        return Addr(self.client.id, self.port)
+
+    @property
+    def fullName(self) -> str:
+        return '%s/%s' % (self.client.name, self.name)
+
+    def __str__(self):
+        return self.fullName
+
+@dataclass(frozen=True)
+class Subscription:
+    """A connection from a sender port to a destination port."""
+    sender: Addr
+    dest: Addr
+
+@dataclass(frozen=True)
+class TopologyDiff:
+    """The changes between two topology snapshots."""
+    addedPorts: Tuple[PortSnapshot, ...] = ()
+    removedPorts: Tuple[PortSnapshot, ...] = ()
+    addedSubs: Tuple[Subscription, ...] = ()
+    removedSubs: Tuple[Subscription, ...] = ()
+
+    def __bool__(self):
+        return bool(self.addedPorts or self.removedPorts or self.addedSubs or
+                    self.removedSubs
+                    )
+
+@dataclass(frozen=True)
+class Topology:
+    """A snapshot of the sequencer's clients, ports and subscriptions."""
+
+    clients: Tuple[ClientSnapshot, ...] = ()
+    ports: Tuple[PortSnapshot, ...] = ()
+    subscriptions: FrozenSet[Subscription] = frozenset()
+
+    # Lookup indexes, built from the fields above.
+    __byName: Dict[str, PortSnapshot] = \
+        field(init=False, repr=False, compare=False)
+    __byAddr: Dict[Addr, PortSnapshot] = \
+        field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, '_Topology__byName',
+                           dict((port.fullName, port) for port in self.ports)
+                           )
+        object.__setattr__(self, '_Topology__byAddr',
+                           dict((port.addr, port) for port in self.ports)
+                           )
+
+    def getPort(self, name: str) -> Optional[PortSnapshot]:
+        """Returns the port with the given "client/port" name, None if there
+        is no such port.
+        """
+        return self.__byName.get(name)
+
+    def getPortByAddr(self, addr: Addr) -> Optional[PortSnapshot]:
+        return self.__byAddr.get(addr)
+
+    def subscribersOf(self, port: PortSnapshot) -> List[PortSnapshot]:
+        """Returns the ports that 'port' sends to."""
+        addr = port.addr
+        return sorted((self.__byAddr[sub.dest] for sub in self.subscriptions
+                       if sub.sender == addr and sub.dest in self.__byAddr
+                       ),
+                      key=lambda p: (p.client.id, p.port)
+                      )
+
+    def sendersTo(self, port: PortSnapshot) -> List[PortSnapshot]:
+        """Returns the ports that send to 'port'."""
+        addr = port.addr
+        return sorted((self.__byAddr[sub.sender] for sub in self.subscriptions
+                       if sub.dest == addr and sub.sender in self.__byAddr
+                       ),
+                      key=lambda p: (p.client.id, p.port)
+                      )
+
+    def diff(self, other: 'Topology') -> TopologyDiff:
+        """Returns the changes required to get from this snapshot to 'other'.
+
+        So for an older snapshot 'old' and a newer snapshot 'new',
+        old.diff(new).addedPorts are the ports that have appeared since 'old'
+        was taken.
+        """
+        ours = set(self.ports)
+        theirs = set(other.ports)
+        return TopologyDiff(
+            addedPorts=tuple(port for port in other.ports
+                             if port not in ours),
+            removedPorts=tuple(port for port in self.ports
+                               if port not in theirs),
+            addedSubs=tuple(sorted(other.subscriptions - self.subscriptions,
+                                   key=_subKey)),
+            removedSubs=tuple(sorted(self.subscriptions - other.subscriptions,
+                                     key=_subKey))
+        )
+
+def _subKey(sub: Subscription):
+    return (sub.sender.client, sub.sender.port, sub.dest.client,
+            sub.dest.port)
@@ -0,0 +1,68 @@
+
+from dataclasses import FrozenInstanceError
+from unittest import main, TestCase
+from topology import Addr, ClientSnapshot, PortSnapshot, Subscription, \
+    Topology
+
+system = ClientSnapshot(0, 'System')
+synth = ClientSnapshot(128, 'synth')
+kbd = ClientSnapshot(20, 'kbd')
+
+timer = PortSnapshot(system, 0, 'Timer')
+synthIn = PortSnapshot(synth, 0, 'in')
+kbdOut = PortSnapshot(kbd, 0, 'out')
+kbdOut2 = PortSnapshot(kbd, 1, 'out2')
+
+class TopologyTest(TestCase):
+
+    def testLookup(self):
+        topo = Topology((system, synth, kbd), (timer, synthIn, kbdOut),
+                        frozenset([Subscription(kbdOut.addr, synthIn.addr)])
+                        )
+        self.assertIs(topo.getPort('synth/in'), synthIn)
+        self.assertIsNone(topo.getPort('synth/out'))
+        self.assertIs(topo.getPortByAddr(Addr(20, 0)), kbdOut)
+        self.assertEqual(topo.subscribersOf(kbdOut), [synthIn])
+        self.assertEqual(topo.sendersTo(synthIn), [kbdOut])
+        self.assertEqual(topo.subscribersOf(synthIn), [])
+        self.assertEqual(str(kbdOut), 'kbd/out')
+
+    def testImmutable(self):
+        with self.assertRaises(FrozenInstanceError):
+            synthIn.name = 'foo'
+        topo = Topology()
+        with self.assertRaises(FrozenInstanceError):
+            topo.ports = (synthIn,)
+
+    def testEquality(self):
+        self.assertEqual(Topology((synth,), (synthIn,)),
+                         Topology((synth,), (PortSnapshot(synth, 0, 'in'),))
+                         )
+
+    def testDiff(self):
+        old = Topology((system, synth, kbd), (timer, synthIn, kbdOut),
+                       frozenset([Subscription(kbdOut.addr, synthIn.addr)])
+                       )
+        self.assertFalse(old.diff(old))
+
+        new = Topology((system, synth, kbd), (timer, synthIn, kbdOut2),
+                       frozenset([Subscription(kbdOut2.addr, synthIn.addr)])
+                       )
+        diff = old.diff(new)
+        self.assertTrue(diff)
+        self.assertEqual(diff.addedPorts, (kbdOut2,))
+        self.assertEqual(diff.removedPorts, (kbdOut,))
+        self.assertEqual(diff.addedSubs,
+                         (Subscription(Addr(20, 1), Addr(128, 0)),)
+                         )
+        self.assertEqual(diff.removedSubs,
+                         (Subscription(Addr(20, 0), Addr(128, 0)),)
+                         )
+
+        # The reverse diff swaps additions and removals.
+        reverse = new.diff(old)
+        self.assertEqual(reverse.addedPorts, diff.removedPorts)
+        self.assertEqual(reverse.removedSubs, diff.addedSubs)
+
+if __name__ == '__main__':
+    main()
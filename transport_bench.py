@@ -0,0 +1,131 @@
+"""Benchmark for the transports between comm.Comm and the daemon.
+
+Compares loopback TCP, a unix domain socket, and passing the RPC through
+shared memory (Comm.callShared() over the unix domain socket) for 1KB
+control messages and 100MB wave payloads.
+
+A stand-in daemon parses every RPC (mapping shared memory payloads the way
+awbd does) and answers with an empty Response.  Comm is run on an event
+loop, so this doesn't need the proactor.
+"""
+
+import mmap
+import os
+import socket
+import struct
+import tempfile
+from threading import Thread
+import time
+from comm import Comm, UNIX_PREFIX
+from eventloop import EventLoop
+from mawb_pb2 import Response, RPC, SetInitialState
+from ringbuf import ByteRing
+
+CONTROL_CALLS = 10000
+CONTROL_SIZE = 1024
+WAVE_CALLS = 5
+WAVE_SIZE = 100 * 1024 * 1024
+
+_SIZE = struct.Struct('<I')
+
+def serve(listener):
+    """The stand-in daemon."""
+    conn, addr = listener.accept()
+    if conn.family != socket.AF_UNIX:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    input = ByteRing(1024 * 1024)
+    while True:
+        size = conn.recv_into(input.reserve(1024 * 1024))
+        if not size:
+            break
+        input.commit(size)
+        out = []
+        while len(input) >= 4:
+            view = input.view()
+            size, = _SIZE.unpack_from(view)
+            if len(view) < size + 4:
+                break
+            rpc = RPC()
+            rpc.ParseFromString(view[4:size + 4])
+            input.consume(size + 4)
+            if rpc.HasField('shm_payload'):
+                # POSIX shared memory segments live in /dev/shm.
+                desc = rpc.shm_payload
+                with open('/dev/shm' + desc.name, 'rb') as src, \
+                        mmap.mmap(src.fileno(), 0,
+                                  access = mmap.ACCESS_READ
+                                  ) as shm:
+                    payload = RPC()
+                    payload.ParseFromString(
+                        memoryview(shm)[desc.offset:desc.offset + desc.size]
+                    )
+            resp = Response()
+            resp.msg_id = rpc.msg_id
+            parcel = resp.SerializeToString()
+            out.append(_SIZE.pack(len(parcel)) + parcel)
+        del view
+        conn.sendall(b''.join(out))
+    conn.close()
+
+def measure(call, fields, count):
+    """Returns the average seconds per round trip of 'count' calls."""
+    start = time.perf_counter()
+    for i in range(count):
+        call(timeout = 60, **fields).result()
+    return (time.perf_counter() - start) / count
+
+def main():
+    tempDir = tempfile.TemporaryDirectory()
+    path = os.path.join(tempDir.name, 'awbd.sock')
+
+    tcpListener = socket.socket()
+    tcpListener.bind(('127.0.0.1', 0))
+    tcpListener.listen(1)
+    unixListener = socket.socket(socket.AF_UNIX)
+    unixListener.bind(path)
+    unixListener.listen(1)
+
+    loop = EventLoop()
+    loopThread = Thread(target = loop.run)
+    loopThread.start()
+
+    servers = []
+    for listener in (tcpListener, unixListener):
+        server = Thread(target = serve, args = (listener,))
+        server.start()
+        servers.append(server)
+    tcpComm = Comm(*tcpListener.getsockname(), loop = loop)
+    unixComm = Comm(UNIX_PREFIX + path, loop = loop)
+    comms = [tcpComm, unixComm]
+
+    # Shared memory descriptors go over the unix domain socket.
+    cases = [('tcp', tcpComm.call),
+             ('uds', unixComm.call),
+             ('shm', unixComm.callShared),
+             ]
+
+    control = {'echo': 'x' * CONTROL_SIZE}
+    wave = {'set_initial_state':
+                SetInitialState(events = bytes(WAVE_SIZE))
+            }
+    print('%-6s %18s %18s' % ('', '1KB control', '100MB wave'))
+    for name, call in cases:
+        controlTime = measure(call, control, CONTROL_CALLS)
+        waveTime = measure(call, wave, WAVE_CALLS)
+        print('%-6s %11.0f calls/s %13.0f MB/s' % (
+            name, 1 / controlTime, WAVE_SIZE / waveTime / (1024 * 1024)
+        ))
+
+    for comm in comms:
+        comm.close()
+    for server in servers:
+        server.join()
+    loop.stop()
+    loopThread.join()
+    loop.close()
+    tcpListener.close()
+    unixListener.close()
+    tempDir.cleanup()
+
+if __name__ == '__main__':
+    main()
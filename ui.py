@@ -1,8 +1,8 @@
 # Initial command-line user-interface.
 # Will turn this into a real UI at some point.
 
-from mawb_pb2 import PBTrack, SetInitialState, SetInputParams, Response, RPC, \
-    RECORD, IDLE, PLAY
+from mawb_pb2 import LoadState, PBTrack, SetInitialState, SetInputParams, \
+    Response, RPC, RECORD, IDLE, PLAY
 import socket
 import struct
 import subprocess
@@ -218,13 +218,16 @@ class Commands:
 
     def load(self, event):
 
-        def loaded(resp):
-            self.__restoreInitializers(resp.project)
-            self.out.info('loaded project')
+        def loaded(future):
+            try:
+                self.__restoreInitializers(future.result().project)
+                self.out.info('loaded project')
+            except Exception as ex:
+                self.out.info('load failed: %s' % ex)
 
-        self.comm.sendRPC(load_state = self.filename,
-                          callback = loaded
-                          )
+        self.comm.call(timeout = 10,
+                       load_state = LoadState(filename = self.filename)
+                       ).add_done_callback(loaded)
 
     def restart(self, event):
         self.comm.sendRPC(set_ticks = 0)
@@ -6,6 +6,33 @@
 
 using namespace std;
 
+namespace {
+
+// WaveBuf counters.  These are cheap enough to maintain from the audio
+// thread.
+atomic<size_t> liveBuffers(0);
+thread_local size_t threadAllocations = 0;
+
+} // anonymous namespace
+
+WaveBuf::WaveBuf(size_t size) : size(size), buffer(new float[size]) {
+    liveBuffers.fetch_add(1, memory_order_relaxed);
+    ++threadAllocations;
+}
+
+WaveBuf::~WaveBuf() {
+    delete [] buffer;
+    liveBuffers.fetch_sub(1, memory_order_relaxed);
+}
+
+size_t WaveBuf::getLiveCount() {
+    return liveBuffers.load(memory_order_relaxed);
+}
+
+size_t WaveBuf::getThreadAllocations() {
+    return threadAllocations;
+}
+
 class WaveTreeNode {
     protected:
         // The position of the wave node relative to the parent measured in
@@ -138,6 +165,9 @@ WaveTreeNode *WaveTreeNode::makeNewRoot()  {
 }
 
 WaveBuf *WaveTree::get(int pos, bool create) {
+    // Count the buffers we create.
+    size_t allocations = WaveBuf::getThreadAllocations();
+
     if (!root) {
         if (create)
             root = new WaveTreeLeaf(pos, framesPerBuffer);
@@ -155,7 +185,11 @@ WaveBuf *WaveTree::get(int pos, bool create) {
         }
     }
 
-    return root->get(pos, create);
+    WaveBuf *buf = root->get(pos, create);
+    allocations = WaveBuf::getThreadAllocations() - allocations;
+    if (allocations)
+        bufferCount.fetch_add(allocations, memory_order_relaxed);
+    return buf;
 }
 
 WaveTree::~WaveTree() {
@@ -2,6 +2,7 @@
 #define awb_wavetree_h_
 
 #include <unistd.h>
+#include <atomic>
 #include <spug/RCBase.h>
 #include <spug/RCPtr.h>
 
@@ -11,12 +12,15 @@ struct WaveBuf {
     size_t size;
     float *buffer;
 
-    WaveBuf(size_t size) :
-        size(size),
-        buffer(new float[size]) {
-    }
+    WaveBuf(size_t size);
+    ~WaveBuf();
 
-    ~WaveBuf() { delete buffer; }
+    // Returns the number of WaveBufs that currently exist.
+    static size_t getLiveCount();
+
+    // Returns the number of WaveBufs that have been allocated by the
+    // calling thread.
+    static size_t getThreadAllocations();
 };
 
 SPUG_RCPTR(WaveTree);
@@ -27,10 +31,19 @@ class WaveTree : public spug::RCBase {
     private:
         WaveTreeNode *root;
 
+        // Number of buffers in the tree.  This is atomic so the audio
+        // thread can report it while another thread is writing the tree.
+        std::atomic<size_t> bufferCount;
+
     public:
-        WaveTree() : root(0) {}
+        WaveTree() : root(0), bufferCount(0) {}
         virtual ~WaveTree();
-        virtual WaveBuf *get(int pos, bool create = false);\
+        virtual WaveBuf *get(int pos, bool create = false);
+
+        // Returns the number of buffers in the tree.
+        size_t getBufferCount() const {
+            return bufferCount.load(std::memory_order_relaxed);
+        }
 
         // Set the number of samples in a buffer.
         static void setBufferSize(int nframes);